@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# Allocation tracking without debugger stops. A small library, compiled
+# at runtime with the local C compiler and preloaded into the target with
+# LD_PRELOAD, wraps malloc, calloc, realloc, free and the aligned
+# allocators (memalign, posix_memalign, aligned_alloc, valloc, pvalloc).
+# glibc routes strdup, getline and the other functions that allocate
+# through them. Every call is logged to a ring buffer in a shared memory
+# file:
+#
+#   header   magic, capacity, head (next record written), tail (next read)
+#   records  seq, op, pid, ptr, size, old ptr, return address
+#
+# A record is complete once its seq is its index + 1. ProgramState drains
+# the ring into the memory model at every step. When the ring is full the
+# library calls tpdb_ring_full, which has a breakpoint, so the debugger
+# only stops when a step made more than capacity calls. Without a
+# compiler, or on other platforms, allocations are tracked with the
+# malloc/free breakpoints as before.
+#
+# The library is used when TPDB_ALLOC_SHIM=1 is set, or when ProgramState
+# is created with alloc_shim=True.
+#----------------------------------------------------------------------
+import hashlib
+import mmap
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+
+from cache import cache_enabled, get_cache_dir
+
+ring_magic = 0x74706462616c6c63
+header_format = struct.Struct("<QQQQ")
+record_format = struct.Struct("<QIIQQQQ")
+tail_offset = 24
+
+op_malloc = 1
+op_calloc = 2
+op_realloc = 3
+op_free = 4
+op_memalign = 5
+
+shim_source = r"""
+#define _GNU_SOURCE
+#include <errno.h>
+#include <fcntl.h>
+#include <stdint.h>
+#include <stdlib.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+extern void* __libc_malloc(size_t size);
+extern void* __libc_calloc(size_t n, size_t size);
+extern void* __libc_realloc(void* ptr, size_t size);
+extern void __libc_free(void* ptr);
+extern void* __libc_memalign(size_t alignment, size_t size);
+extern void* __libc_valloc(size_t size);
+extern void* __libc_pvalloc(size_t size);
+
+struct header { uint64_t magic, capacity, head, tail; };
+struct record { uint64_t seq; uint32_t op, pid; uint64_t ptr, size, old_ptr, ret; };
+
+static struct header* ring;
+static struct record* records;
+static int state;
+
+/* the debugger drains the ring at a breakpoint here */
+__attribute__((noinline, visibility("default"))) void tpdb_ring_full(void) { __asm__ volatile(""); }
+
+/* called after every record, the debugger breaks here to run to the next call */
+__attribute__((noinline, visibility("default"))) void tpdb_alloc_logged(void) { __asm__ volatile(""); }
+
+/* map the ring on the first call, without allocating */
+static void init(void)
+{
+    int expected = 0;
+    if (!__atomic_compare_exchange_n(&state, &expected, 1, 0, __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE))
+        return;
+    const char* path = getenv("TPDB_ALLOC_RING");
+    int fd = path != NULL ? open(path, O_RDWR) : -1;
+    struct stat st;
+    if (fd >= 0 && fstat(fd, &st) == 0 && st.st_size >= (off_t)sizeof(struct header)) {
+        void* p = mmap(NULL, st.st_size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+        if (p != MAP_FAILED && ((struct header*)p)->magic == %(magic)dULL) {
+            records = (struct record*)((struct header*)p + 1);
+            ring = (struct header*)p;
+        }
+    }
+    if (fd >= 0)
+        close(fd);
+    __atomic_store_n(&state, 2, __ATOMIC_RELEASE);
+}
+
+static void log_call(uint32_t op, void* ptr, size_t size, void* old_ptr, void* ret)
+{
+    if (__atomic_load_n(&state, __ATOMIC_ACQUIRE) != 2)
+        init();
+    if (ring == NULL)
+        return;
+    uint64_t i = __atomic_fetch_add(&ring->head, 1, __ATOMIC_ACQ_REL);
+    if (i - __atomic_load_n(&ring->tail, __ATOMIC_ACQUIRE) >= ring->capacity)
+        tpdb_ring_full();
+    struct record* r = &records[i %% ring->capacity];
+    r->op = op;
+    r->pid = (uint32_t)getpid();
+    r->ptr = (uintptr_t)ptr;
+    r->size = size;
+    r->old_ptr = (uintptr_t)old_ptr;
+    r->ret = (uintptr_t)ret;
+    __atomic_store_n(&r->seq, i + 1, __ATOMIC_RELEASE);
+    tpdb_alloc_logged();
+}
+
+void* malloc(size_t size)
+{
+    void* p = __libc_malloc(size);
+    log_call(%(malloc)d, p, size, NULL, __builtin_return_address(0));
+    return p;
+}
+
+void* calloc(size_t n, size_t size)
+{
+    void* p = __libc_calloc(n, size);
+    log_call(%(calloc)d, p, n * size, NULL, __builtin_return_address(0));
+    return p;
+}
+
+void* realloc(void* old_ptr, size_t size)
+{
+    void* p = __libc_realloc(old_ptr, size);
+    log_call(%(realloc)d, p, size, old_ptr, __builtin_return_address(0));
+    return p;
+}
+
+void* memalign(size_t alignment, size_t size)
+{
+    void* p = __libc_memalign(alignment, size);
+    log_call(%(memalign)d, p, size, NULL, __builtin_return_address(0));
+    return p;
+}
+
+void* aligned_alloc(size_t alignment, size_t size)
+{
+    void* p = __libc_memalign(alignment, size);
+    log_call(%(memalign)d, p, size, NULL, __builtin_return_address(0));
+    return p;
+}
+
+int posix_memalign(void** ptr, size_t alignment, size_t size)
+{
+    if (alignment %% sizeof(void*) != 0 || (alignment & (alignment - 1)) != 0)
+        return EINVAL;
+    void* p = __libc_memalign(alignment, size);
+    if (p == NULL)
+        return ENOMEM;
+    log_call(%(memalign)d, p, size, NULL, __builtin_return_address(0));
+    *ptr = p;
+    return 0;
+}
+
+void* valloc(size_t size)
+{
+    void* p = __libc_valloc(size);
+    log_call(%(memalign)d, p, size, NULL, __builtin_return_address(0));
+    return p;
+}
+
+void* pvalloc(size_t size)
+{
+    void* p = __libc_pvalloc(size);
+    log_call(%(memalign)d, p, size, NULL, __builtin_return_address(0));
+    return p;
+}
+
+/* logged before the block is released so that a malloc in another thread
+   can't reuse the address before the free is in the ring */
+void free(void* ptr)
+{
+    if (ptr == NULL)
+        return;
+    log_call(%(free)d, ptr, 0, NULL, __builtin_return_address(0));
+    __libc_free(ptr);
+}
+""" % { "magic": ring_magic, "malloc": op_malloc, "calloc": op_calloc, "realloc": op_realloc, "free": op_free,
+    "memalign": op_memalign }
+
+def shim_enabled():
+    return os.environ.get("TPDB_ALLOC_SHIM", "") not in ("", "0")
+
+# compile the library, or return the one compiled earlier from the same
+# source. Returns None if it can't be built here
+def build_shim():
+    if not sys.platform.startswith("linux"):
+        return None
+    key = hashlib.sha1(shim_source.encode("utf-8")).hexdigest()[0:16]
+    build_dir = get_cache_dir() if cache_enabled() else tempfile.mkdtemp(prefix="tpdb-shim-")
+    path = os.path.join(build_dir, "alloc-shim-%s.so" % key)
+    if os.path.exists(path):
+        return path
+
+    try:
+        os.makedirs(build_dir, exist_ok=True)
+        (fd, source_path) = tempfile.mkstemp(suffix=".c", dir=build_dir)
+        with os.fdopen(fd, "w") as fh:
+            fh.write(shim_source)
+        tmp_path = source_path[0:-2] + ".so"
+        compiler = os.environ.get("CC", "cc")
+        with open(os.devnull, "w") as fnull:
+            subprocess.check_call([ compiler, "-shared", "-fPIC", "-O2", "-Wl,-z,defs", "-o", tmp_path, source_path ],
+                stdout=fnull, stderr=fnull)
+        os.unlink(source_path)
+        os.replace(tmp_path, path)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return path
+
+# The reading end of the ring, owned by a ProgramState
+class AllocLog:
+    def __init__(self, library_path, capacity=64 * 1024):
+        self.library_path = library_path
+        self.capacity = capacity
+        shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+        (fd, self.path) = tempfile.mkstemp(prefix="tpdb-alloc-", dir=shm_dir)
+        size = header_format.size + capacity * record_format.size
+        os.ftruncate(fd, size)
+        self.map = mmap.mmap(fd, size)
+        os.close(fd)
+        header_format.pack_into(self.map, 0, ring_magic, capacity, 0, 0)
+        self.tail = 0
+        self.pid = None
+        self.full_bp = None
+        self.logged_bp = None
+
+        # records overwritten before they were drained
+        self.n_lost = 0
+
+    # environment entries that load the library into the target
+    def get_environment(self):
+        preload = [ self.library_path ]
+        if os.environ.get("LD_PRELOAD", "") != "":
+            preload.append(os.environ["LD_PRELOAD"])
+        return [ "LD_PRELOAD=" + " ".join(preload), "TPDB_ALLOC_RING=" + self.path ]
+
+    # called once the target was launched. Returns false if the library
+    # wasn't loaded, in which case the caller falls back to breakpoints
+    def attach(self, target, process):
+        self.full_bp = target.BreakpointCreateByName("tpdb_ring_full")
+        self.logged_bp = target.BreakpointCreateByName("tpdb_alloc_logged")
+        self.logged_bp.SetEnabled(False)
+        if self.full_bp.GetNumLocations() == 0:
+            target.BreakpointDelete(self.full_bp.GetID())
+            target.BreakpointDelete(self.logged_bp.GetID())
+            return False
+        self.pid = process.GetProcessID()
+        # calls made before main aren't tracked, as with the breakpoints
+        self.skip()
+        return True
+
+    def get_head(self):
+        return struct.unpack_from("<Q", self.map, 16)[0]
+
+    def set_tail(self, tail):
+        self.tail = tail
+        struct.pack_into("<Q", self.map, tail_offset, tail)
+
+    def skip(self):
+        self.set_tail(self.get_head())
+
+    # apply the calls logged since the last drain to the memory model.
+    # The target is stopped while this runs
+    def drain(self, memory_model):
+        head = self.get_head()
+        pos = self.tail
+        while pos < head:
+            offset = header_format.size + (pos % self.capacity) * record_format.size
+            (seq, op, pid, ptr, size, old_ptr, ret) = record_format.unpack_from(self.map, offset)
+            if seq < pos + 1:
+                # still being written
+                break
+            pos += 1
+            if seq > pos:
+                self.n_lost += 1
+                continue
+            # children of the target inherit the library
+            if pid != self.pid:
+                continue
+            apply_call(memory_model, op, ptr, size, old_ptr)
+        self.set_tail(pos)
+
+    def close(self):
+        self.map.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+def apply_call(memory_model, op, ptr, size, old_ptr):
+    if op == op_free:
+        memory_model.free_heap_alloc(ptr)
+    elif op == op_realloc:
+        # a block that moved was freed, realloc(p, 0) may free it as well
+        if old_ptr != 0 and old_ptr != ptr and (ptr != 0 or size == 0):
+            memory_model.free_heap_alloc(old_ptr)
+        if ptr != 0:
+            memory_model.add_heap_alloc(ptr, size)
+    elif ptr != 0:
+        memory_model.add_heap_alloc(ptr, size)
+
+# an AllocLog if the library can be used, otherwise None
+def create_alloc_log():
+    library_path = build_shim()
+    if library_path is None:
+        return None
+    return AllocLog(library_path)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# Run meminspect over many (program, stdin, steps) jobs in parallel.
+#
+# The manifest has one job per line, blank lines and lines starting with
+# # are ignored:
+#
+#   <program> [stdin file or -] [step spec, default all]
+#
+# For each job <name>.tsv holds the memory dump and <name>.json the
+# status and timings. summary.json holds the throughput of the batch.
+#----------------------------------------------------------------------
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+class Job:
+    def __init__(self, index, program, stdin_path, steps):
+        self.index = index
+        self.program = program
+        self.stdin_path = stdin_path
+        self.steps = steps
+
+        name = os.path.basename(program)
+        if stdin_path is not None:
+            name += "-" + os.path.basename(stdin_path)
+        self.name = "%04d-%s" % (index, name)
+
+def read_manifest(fp):
+    jobs = list()
+    for line in fp:
+        fields = line.split()
+        if len(fields) == 0 or fields[0].startswith("#"):
+            continue
+        program = fields[0]
+        stdin_path = fields[1] if len(fields) > 1 and fields[1] != "-" else None
+        steps = fields[2] if len(fields) > 2 else "all"
+        jobs.append(Job(len(jobs), program, stdin_path, steps))
+    return jobs
+
+# Wraps a memory dump writer to record how long each step took, measured
+# as the time between snapshots divided by the number of steps taken
+class TimingWriter:
+    def __init__(self, writer):
+        self.writer = writer
+        self.step_latencies = list()
+        self.last_step = None
+        self.last_time = None
+
+    def write_step(self, step, memory_model, output=None, graph=None):
+        now = time.time()
+        if self.last_step is not None and step > self.last_step:
+            per_step = (now - self.last_time) / (step - self.last_step)
+            self.step_latencies.extend([per_step] * (step - self.last_step))
+        self.writer.write_step(step, memory_model, output, graph)
+        self.last_step = step
+        self.last_time = time.time()
+
+    def close(self):
+        self.writer.close()
+
+def write_result(path, result):
+    with open(path, "w") as fh:
+        json.dump(result, fh, indent=1)
+
+# runs in a worker process, each of which has its own lldb debugger
+def run_job(job, out_dir, max_steps):
+    from memory_model import TsvDeltaWriter
+    from meminspect import dump_steps, parse_step_spec
+    from tracefile import open_program
+
+    start = time.time()
+    with open(os.path.join(out_dir, job.name + ".tsv"), "w") as fh:
+        program = open_program(job.program, job.stdin_path)
+        launched = time.time()
+        writer = TimingWriter(TsvDeltaWriter(fh))
+        n_snapshots = dump_steps(program, parse_step_spec(job.steps), writer, max_steps)
+
+    result = dict()
+    if program.has_exited():
+        result["status"] = "ok"
+    elif max_steps is not None and program.step_count >= max_steps:
+        result["status"] = "step-limit"
+    else:
+        # the step spec ended before the program did
+        result["status"] = "steps-done"
+    result["steps"] = program.step_count
+    result["snapshots"] = n_snapshots
+    result["launch_seconds"] = launched - start
+    result["elapsed_seconds"] = time.time() - start
+    result["step_latencies"] = writer.step_latencies
+    write_result(os.path.join(out_dir, job.name + ".json"), result)
+
+def collect_result(job, process, out_dir, elapsed, timed_out):
+    path = os.path.join(out_dir, job.name + ".json")
+    if process.exitcode == 0 and os.path.exists(path):
+        with open(path) as fh:
+            return json.load(fh)
+
+    result = dict()
+    result["status"] = "timeout" if timed_out else "error"
+    result["exitcode"] = process.exitcode
+    result["elapsed_seconds"] = elapsed
+    result["step_latencies"] = list()
+    write_result(path, result)
+    return result
+
+# Run jobs with at most n_workers at a time. Each job gets its own
+# process so that it can be killed when it runs over its time budget.
+def run_batch(jobs, out_dir, n_workers, timeout, max_steps):
+    ctx = multiprocessing.get_context("spawn")
+    pending = list(jobs)
+    running = dict()
+    results = dict()
+
+    start = time.time()
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < n_workers:
+            job = pending.pop(0)
+            p = ctx.Process(target=run_job, args=(job, out_dir, max_steps))
+            p.start()
+            running[job.name] = (job, p, time.time())
+
+        for name, (job, p, job_start) in list(running.items()):
+            elapsed = time.time() - job_start
+            timed_out = p.is_alive() and timeout is not None and elapsed > timeout
+            if timed_out:
+                p.kill()
+            elif p.is_alive():
+                continue
+            p.join()
+
+            result = collect_result(job, p, out_dir, elapsed, timed_out)
+            results[name] = result
+            del running[name]
+            sys.stderr.write("%s\t%s\t%.2fs\n" % (name, result["status"], elapsed))
+
+        time.sleep(0.05)
+
+    return results, time.time() - start
+
+def summarize(results, wall_seconds):
+    latencies = list()
+    status_counts = dict()
+    for r in results.values():
+        latencies.extend(r["step_latencies"])
+        status_counts[r["status"]] = status_counts.get(r["status"], 0) + 1
+
+    summary = dict()
+    summary["jobs"] = len(results)
+    summary["status"] = status_counts
+    summary["wall_seconds"] = wall_seconds
+    summary["jobs_per_second"] = len(results) / wall_seconds if wall_seconds > 0 else 0.0
+    summary["steps"] = len(latencies)
+    summary["median_step_seconds"] = statistics.median(latencies) if len(latencies) > 0 else None
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="run meminspect over a manifest of jobs in parallel")
+    parser.add_argument("manifest", help="file listing <program> [stdin] [steps] per line")
+    parser.add_argument("out_dir", help="directory to write the results to")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--timeout", type=float, default=60.0, help="wall-clock budget per job in seconds")
+    parser.add_argument("--max-steps", type=int, default=10000, help="step budget per job")
+    args = parser.parse_args()
+
+    with open(args.manifest) as fh:
+        jobs = read_manifest(fh)
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    results, wall_seconds = run_batch(jobs, args.out_dir, args.jobs, args.timeout, args.max_steps)
+    summary = summarize(results, wall_seconds)
+    write_result(os.path.join(args.out_dir, "summary.json"), summary)
+
+    median = summary["median_step_seconds"]
+    sys.stderr.write("%d jobs in %.1fs (%.2f jobs/s), median step latency %s\n" %
+        (summary["jobs"], wall_seconds, summary["jobs_per_second"],
+         "n/a" if median is None else "%.1fms" % (median * 1000)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# Benchmark the debugger on the example programs and on generated C
+# programs that scale one feature at a time (recursion depth, number and
+# size of mallocs, array and struct sizes, length of a circular doubly
+# linked list, amount of output). Every
+# program is compiled with the local gcc and run once per stepping engine
+# and way of tracking allocations (breakpoints or the preloaded library).
+# Launch time, per-step latency, debugger stops per step, the size of the
+# memory model and the bytes it retains (with the snapshots the UI keeps),
+# the cost of copying it for the UI, of laying it out and redrawing it in
+# tpdb's panes (on an offscreen pseudo terminal) and of exporting it are
+# written to a JSON file so that runs on different commits can be
+# compared, e.g.
+#   python3 src/benchmark.py -o results.json
+#   python3 src/benchmark.py --no-synthetic --engines breakpoint
+#   python3 src/benchmark.py --alloc-tracking shim
+#----------------------------------------------------------------------
+from import_lldb import *
+
+import argparse
+import collections
+import curses
+import fcntl
+import gc
+import glob
+import io
+import json
+import os
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import termios
+import threading
+import time
+
+from memory_model import *
+from program_state import ProgramState
+from stepping import steppers
+from tpdb import Layout
+from worker import Snapshot
+
+# knobs of the generated programs
+base_workload = {
+    "depth": 4,
+    "mallocs": 4,
+    "malloc_size": 8,
+    "array_size": 8,
+    "struct_size": 4,
+    "list_nodes": 4,
+    "prints": 4,
+}
+
+# the values each knob is scaled through, the others keep their base value
+scaling = {
+    "depth": [ 16, 64 ],
+    "mallocs": [ 32, 128 ],
+    "malloc_size": [ 256, 4096 ],
+    "array_size": [ 256, 4096 ],
+    "struct_size": [ 64, 512 ],
+    "list_nodes": [ 64, 512 ],
+    "prints": [ 64, 512 ],
+}
+
+synthetic_template = """#include <stdio.h>
+#include <stdlib.h>
+
+#define DEPTH %(depth)d
+#define N_MALLOCS %(mallocs)d
+#define MALLOC_SIZE %(malloc_size)d
+#define ARRAY_SIZE %(array_size)d
+#define STRUCT_SIZE %(struct_size)d
+#define LIST_NODES %(list_nodes)d
+#define N_PRINTS %(prints)d
+
+struct record
+{
+    int id;
+    double values[STRUCT_SIZE];
+};
+
+struct node
+{
+    int value;
+    struct node* next;
+    struct node* prev;
+};
+
+int recurse(int depth)
+{
+    int local = depth;
+    if (depth == 0)
+        return 0;
+    return local + recurse(depth - 1);
+}
+
+int main()
+{
+    int array[ARRAY_SIZE];
+    struct record r;
+    int* blocks[N_MALLOCS];
+    struct node* head;
+    struct node* n;
+    int i;
+
+    for (i = 0; i < ARRAY_SIZE; i++)
+        array[i] = i;
+    for (i = 0; i < STRUCT_SIZE; i++)
+        r.values[i] = i * 0.5;
+    r.id = recurse(DEPTH);
+
+    for (i = 0; i < N_MALLOCS; i++)
+    {
+        blocks[i] = malloc(MALLOC_SIZE * sizeof(int));
+        blocks[i][0] = array[i %% ARRAY_SIZE];
+    }
+    head = malloc(sizeof(struct node));
+    head->value = 0;
+    head->next = head;
+    head->prev = head;
+    for (i = 1; i < LIST_NODES; i++)
+    {
+        n = malloc(sizeof(struct node));
+        n->value = i;
+        n->next = head;
+        n->prev = head->prev;
+        head->prev->next = n;
+        head->prev = n;
+    }
+    for (i = 0; i < N_PRINTS; i++)
+        printf("line %%d of output\\n", i);
+    for (i = 0; i < N_MALLOCS; i++)
+        free(blocks[i]);
+    while (head->next != head)
+    {
+        n = head->next;
+        head->next = n->next;
+        free(n);
+    }
+    free(head);
+    return r.id;
+}
+"""
+
+def get_workload_name(workload):
+    return "synthetic-" + "-".join([ "%s%d" % (k, workload[k]) for k in sorted(workload) ])
+
+# the base workload and each knob scaled on its own
+def get_workloads():
+    workloads = [ dict(base_workload) ]
+    for knob in sorted(scaling):
+        for value in scaling[knob]:
+            w = dict(base_workload)
+            w[knob] = value
+            workloads.append(w)
+    return workloads
+
+def generate_program(workload):
+    return synthetic_template % dict([ (k, max(1, v)) for (k, v) in workload.items() ])
+
+def compile_program(source_path, binary_path):
+    subprocess.check_call([ "gcc", "-g", "-O0", "-o", binary_path, source_path ])
+
+# the programs to benchmark as (name, binary, workload or None)
+def build_programs(example_dir, build_dir, synthetic):
+    programs = list()
+    for source_path in sorted(glob.glob(os.path.join(example_dir, "*.c"))):
+        name = os.path.splitext(os.path.basename(source_path))[0]
+        binary_path = os.path.join(build_dir, name)
+        compile_program(source_path, binary_path)
+        programs.append((name, binary_path, None))
+
+    if synthetic:
+        for workload in get_workloads():
+            name = get_workload_name(workload)
+            source_path = os.path.join(build_dir, name + ".c")
+            with open(source_path, "w") as fh:
+                fh.write(generate_program(workload))
+            binary_path = os.path.join(build_dir, name)
+            compile_program(source_path, binary_path)
+            programs.append((name, binary_path, workload))
+    return programs
+
+def summarize_latencies(latencies):
+    if len(latencies) == 0:
+        return None
+    ordered = sorted(latencies)
+    summary = dict()
+    summary["mean_ms"] = statistics.mean(ordered) * 1000
+    summary["median_ms"] = statistics.median(ordered) * 1000
+    summary["p95_ms"] = ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))] * 1000
+    summary["max_ms"] = ordered[-1] * 1000
+    return summary
+
+# bytes retained by the given objects and everything they reference,
+# objects shared between them are counted once
+def get_retained_bytes(roots):
+    seen = set()
+    pending = list(roots)
+    total = 0
+    while len(pending) > 0:
+        o = pending.pop()
+        if id(o) in seen or isinstance(o, type):
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        pending.extend(gc.get_referents(o))
+    return total
+
+# A curses screen on a pseudo terminal, so that tpdb's layout and redraw
+# can be timed without a terminal. stdin and stdout are pointed at the
+# pty while it is open, a thread reads and discards what curses writes.
+class OffscreenTerminal:
+    def __init__(self, lines=50, columns=200):
+        (self.master, slave) = os.openpty()
+        fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack("HHHH", lines, columns, 0, 0))
+        sys.stdout.flush()
+        self.saved = [ os.dup(0), os.dup(1) ]
+        os.dup2(slave, 0)
+        os.dup2(slave, 1)
+        os.close(slave)
+
+        self.reader = threading.Thread(target=self.drain)
+        self.reader.daemon = True
+        self.reader.start()
+
+        if os.environ.get("TERM", "dumb") == "dumb":
+            os.environ["TERM"] = "xterm"
+        self.stdscr = curses.initscr()
+
+    def drain(self):
+        try:
+            while len(os.read(self.master, 65536)) > 0:
+                pass
+        except OSError:
+            pass
+
+    def close(self):
+        curses.endwin()
+        sys.stdout.flush()
+        os.dup2(self.saved[0], 0)
+        os.dup2(self.saved[1], 1)
+        for fd in self.saved:
+            os.close(fd)
+        os.close(self.master)
+
+# terminal is an OffscreenTerminal to time redraws on, or None
+def bench_program(name, binary_path, engine, alloc_tracking, max_steps, terminal=None):
+    start = time.time()
+    program = ProgramState(binary_path, engine=engine, alloc_shim=(alloc_tracking == "shim"))
+    launch_seconds = time.time() - start
+    start_stop_id = program.process.GetStopID()
+
+    step_latencies = list()
+    snapshot_latencies = list()
+    export_latencies = list()
+    redraw_latencies = list()
+    layout = Layout(terminal.stdscr, True, False) if terminal is not None else None
+    max_rows = len(program.memory_model.memory)
+    max_retained = 0
+    # the snapshots the UI holds on to, see StepWorker
+    snapshots = collections.deque(maxlen=5)
+    writer = TsvDeltaWriter(io.StringIO())
+    while not program.has_exited() and program.step_count < max_steps:
+        t0 = time.time()
+        program.step()
+        t1 = time.time()
+        # the copy the UI gets after every step
+        snapshots.append(Snapshot(program))
+        t2 = time.time()
+        writer.write_step(program.step_count, program.memory_model, program.output, program.get_heap_graph())
+        t3 = time.time()
+        # what tpdb does with the snapshot: lay out and repaint the panes
+        if layout is not None:
+            layout.update(snapshots[-1], "step %d" % program.step_count)
+            layout.draw(0)
+            redraw_latencies.append(time.time() - t3)
+
+        step_latencies.append(t1 - t0)
+        snapshot_latencies.append(t2 - t1)
+        export_latencies.append(t3 - t2)
+        if len(program.memory_model.memory) > max_rows:
+            max_rows = len(program.memory_model.memory)
+            model = program.memory_model
+            max_retained = get_retained_bytes([ model.memory, model.owner_ids, model.owned, writer.prev ] +
+                [ s.memory_model.memory for s in snapshots ])
+
+    n = max(program.step_count, 1)
+    result = dict()
+    result["program"] = name
+    result["engine"] = engine
+    # the shim falls back to breakpoints if it can't be built
+    result["alloc_tracking"] = "shim" if program.alloc_log is not None else "breakpoint"
+    result["steps"] = program.step_count
+    result["exited"] = program.has_exited()
+    result["launch_seconds"] = launch_seconds
+    result["startup_seconds"] = program.startup_seconds
+    result["static_info_cached"] = program.static_info["cached"]
+    result["step"] = summarize_latencies(step_latencies)
+    result["snapshot"] = summarize_latencies(snapshot_latencies)
+    result["export"] = summarize_latencies(export_latencies)
+    result["redraw"] = summarize_latencies(redraw_latencies)
+    result["export_bytes"] = writer.fp.tell()
+    result["stops_per_step"] = (program.process.GetStopID() - start_stop_id) / float(n)
+    result["max_memory_rows"] = max_rows
+    result["retained_bytes_per_row"] = max_retained / float(max(max_rows, 1))
+    result["allocator_calls"] = program.memory_model.n_allocator_calls
+
+    program.close()
+    return result
+
+def get_commit():
+    try:
+        with open(os.devnull, "w") as fnull:
+            return subprocess.check_output([ "git", "rev-parse", "HEAD" ], stderr=fnull).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the debugger on the example and generated programs")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="JSON file to write the results to")
+    parser.add_argument("--examples", default="example", help="directory of C programs to benchmark")
+    parser.add_argument("--build-dir", default=None, help="directory to compile the programs into")
+    parser.add_argument("--engines", default=",".join(sorted(steppers)), help="comma separated stepping engines")
+    parser.add_argument("--alloc-tracking", default="breakpoint,shim", help="comma separated ways of tracking allocations")
+    parser.add_argument("--max-steps", type=int, default=1000, help="step budget per program")
+    parser.add_argument("--no-synthetic", action="store_true", help="only benchmark the example programs")
+    parser.add_argument("--no-redraw", action="store_true", help="don't time tpdb's layout and redraw")
+    args = parser.parse_args()
+
+    build_dir = args.build_dir if args.build_dir is not None else tempfile.mkdtemp(prefix="tpdb-bench-")
+    os.makedirs(build_dir, exist_ok=True)
+    programs = build_programs(args.examples, build_dir, not args.no_synthetic)
+
+    terminal = OffscreenTerminal() if not args.no_redraw else None
+    results = list()
+    for (name, binary_path, workload) in programs:
+        for engine in args.engines.split(","):
+            for alloc_tracking in args.alloc_tracking.split(","):
+                result = bench_program(name, binary_path, engine, alloc_tracking, args.max_steps, terminal)
+                result["workload"] = workload
+                results.append(result)
+                sys.stderr.write("%s\t%s\t%s\t%d steps\t%.2fms/step\t%.1f stops/step\n" % (name, engine,
+                    result["alloc_tracking"], result["steps"],
+                    0.0 if result["step"] is None else result["step"]["median_ms"], result["stops_per_step"]))
+
+    if terminal is not None:
+        terminal.close()
+
+    out = dict()
+    out["commit"] = get_commit()
+    out["date"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+    out["max_steps"] = args.max_steps
+    out["results"] = results
+    with open(args.output, "w") as fh:
+        json.dump(out, fh, indent=1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# A persistent on-disk cache for work that only depends on files that
+# rarely change: where lldb's python module lives and the static data
+# read out of a program binary. Entries are json files keyed on the path,
+# mtime, size and content hash of the files they were computed from.
+#
+# The cache lives in $TPDB_CACHE_DIR, or $XDG_CACHE_HOME/tpdb, or
+# ~/.cache/tpdb. Setting TPDB_NO_CACHE=1 disables it.
+#----------------------------------------------------------------------
+import hashlib
+import json
+import os
+import tempfile
+
+def cache_enabled():
+    return os.environ.get("TPDB_NO_CACHE", "") in ("", "0")
+
+def get_cache_dir():
+    if "TPDB_CACHE_DIR" in os.environ:
+        return os.environ["TPDB_CACHE_DIR"]
+    base = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "tpdb")
+
+# a key identifying the exact contents of a set of files
+def get_file_key(*paths):
+    h = hashlib.sha1()
+    for path in paths:
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        h.update(("%s\0%d\0%d\0" % (path, st.st_mtime_ns, st.st_size)).encode("utf-8"))
+        with open(path, "rb") as fh:
+            for block in iter(lambda: fh.read(1 << 20), b""):
+                h.update(block)
+    return h.hexdigest()
+
+def get_entry_path(kind, key):
+    return os.path.join(get_cache_dir(), "%s-%s.json" % (kind, key))
+
+# returns the cached object, or None on a miss
+def cache_load(kind, key):
+    if not cache_enabled():
+        return None
+    try:
+        with open(get_entry_path(kind, key)) as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+
+def cache_store(kind, key, obj):
+    if not cache_enabled():
+        return
+    try:
+        os.makedirs(get_cache_dir(), exist_ok=True)
+        # write to a temporary file first so readers never see a partial entry
+        (fd, tmp_path) = tempfile.mkstemp(dir=get_cache_dir())
+        with os.fdopen(fd, "w") as fh:
+            json.dump(obj, fh)
+        os.replace(tmp_path, get_entry_path(kind, key))
+    except (IOError, OSError):
+        pass
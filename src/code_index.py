@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# Which code is the user's: the source files of the program and the
+# address ranges their line table entries cover, built from the line
+# tables in the static info. Checking whether a pc is in user code is a
+# binary search over the merged ranges.
+#----------------------------------------------------------------------
+import bisect
+import os
+
+# sources under these directories belong to the system (libc, headers)
+system_prefixes = ( "/usr/", "/lib/", "/lib64/", "/opt/homebrew/", "/Applications/", "/Library/" )
+
+def is_user_file(path):
+    return not path.startswith(system_prefixes) and os.path.exists(path)
+
+class CodeIndex:
+    # line_table holds (path, line, start, end) file addresses, slide is
+    # the offset between file and load addresses of the executable
+    def __init__(self, line_table, slide=0):
+        self.user_files = set([ path for path in set([ e[0] for e in line_table ]) if is_user_file(path) ])
+        self.user_filenames = set([ os.path.basename(path) for path in self.user_files ])
+
+        ranges = sorted([ (start + slide, end + slide) for (path, line, start, end) in line_table
+            if path in self.user_files and end > start ])
+
+        # merge ranges that touch or overlap
+        self.starts = list()
+        self.ends = list()
+        for (start, end) in ranges:
+            if len(self.ends) > 0 and start <= self.ends[-1]:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def is_user_pc(self, pc):
+        i = bisect.bisect_right(self.starts, pc) - 1
+        return i >= 0 and pc < self.ends[i]
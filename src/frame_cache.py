@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import lldb
+from globals_tracker import is_global
+from memory_model import *
+
+# Contents of a stack frame the last time its variables were decoded
+class CachedFrame:
+    def __init__(self, data):
+        self.data = data
+
+# bytes below SP read with the innermost frame, see FrameCache
+red_zone_size = 128
+
+# Keeps the memory model up to date with the stack while only decoding the
+# variables of frames that changed. Frames are identified by their CFA and
+# function, this key is also the owner of the frame's values in the memory
+# model so they are evicted when the frame returns. After each step the
+# stack range [SP, CFA) of every frame is read with a single ReadMemory call
+# and compared with the bytes from the previous step, only frames whose
+# bytes differ (or that are new) have their variables decoded. The range of
+# the innermost frame starts red_zone_size bytes below SP: leaf functions
+# keep their locals in the red zone without moving SP (128 bytes on x86-64
+# and arm64 macOS, elsewhere the extra bytes are just compared too).
+# Pointers into the heap are roots of the HeapGraph, which follows them
+# every step whether or not the frame changed.
+class FrameCache:
+    def __init__(self, process, memory_model):
+        self.process = process
+        self.memory_model = memory_model
+        self.frames = dict()
+
+        # the GlobalsTracker, set by ProgramState
+        self.globals = None
+
+    def get_frame_key(self, frame):
+        return ("stack", frame.GetCFA(), frame.GetFunctionName())
+
+    def read_frame(self, frame, red_zone=0):
+        sp = frame.GetSP()
+        cfa = frame.GetCFA()
+        if sp == lldb.LLDB_INVALID_ADDRESS or cfa == lldb.LLDB_INVALID_ADDRESS or cfa <= sp:
+            return None
+        return read_memory(self.process, sp - red_zone, cfa - sp + red_zone)
+
+    def decode_frame(self, frame, key, section_name):
+        for v in frame.variables:
+            # global variables show up on the stack frame, they are kept in
+            # the memory model by the GlobalsTracker, which also takes the
+            # function scope statics it didn't find by name
+            if is_global(v):
+                if self.globals is not None:
+                    self.globals.add_static(v)
+                continue
+            self.memory_model.add_from_stack(self.process, section_name, v, key)
+
+    # update the memory model with the current state of the stack.
+    # frames is a list of (frame, section name) pairs
+    def refresh(self, frames):
+        live = dict()
+        for (i, (frame, section_name)) in enumerate(frames):
+            key = self.get_frame_key(frame)
+            data = self.read_frame(frame, red_zone_size if i == 0 else 0)
+            cached = self.frames.get(key)
+
+            if data is None or cached is None or cached.data != data:
+                cached = CachedFrame(data)
+                self.decode_frame(frame, key, section_name)
+            live[key] = cached
+
+        # frames that returned are dropped so a new call that reuses the
+        # same stack address is decoded from scratch, and their values are
+        # evicted from the memory model
+        for key in self.frames:
+            if key not in live:
+                self.memory_model.retire_owner(key)
+        self.frames = live
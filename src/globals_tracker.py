@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# Keeps the global and static variables of the program in the memory
+# model, in their own "globals" section.
+#----------------------------------------------------------------------
+import lldb
+from memory_model import *
+from type_layout import *
+
+# sections global variables can live in
+data_section_names = set([ ".data", ".bss", "__data", "__bss", "__common" ])
+
+# the owner of all global values, it is never retired
+globals_owner = ("globals",)
+
+def is_global(v):
+    return v.GetAddress().GetSection().GetName() in data_section_names
+
+# A global variable, resolved once at startup
+class GlobalVariable:
+    def __init__(self, value, address):
+        self.value = value
+        self.address = address
+        self.size = value.GetByteSize()
+        self.name = value.GetName()
+        self.type_name = str(value.GetType())
+        # (element layout, count) for arrays kept as a LazyRange
+        self.large_array = get_large_array(value.GetType())
+        self.layout = get_type_layout(value.GetType()) if self.large_array is None else None
+        self.is_pointer = value.TypeIsPointerType()
+        self.section = value.GetAddress().GetSection().GetName()
+        self.module = str(value.GetAddress().GetModule().GetFileSpec())
+
+# [ start, end, variables ] for each data section of each module, sorted
+# by address. The sections of two modules are far apart, a range spanning
+# both would be enormous
+def get_ranges(variables):
+    ranges = dict()
+    for address in sorted(variables):
+        g = variables[address]
+        r = ranges.setdefault((g.module, g.section), [ address, address, list() ])
+        r[1] = max(r[1], address + g.size)
+        r[2].append(g)
+    return list(ranges.values())
+
+# The globals are grouped into one address range per data section, each
+# range is read with a single ReadMemory call per step and compared with
+# the bytes from the previous step. Only globals whose bytes changed are
+# decoded, straight from the raw bytes using the layout of their type.
+# Pointers into the heap are roots of the HeapGraph, which follows them
+# every step whether or not the global changed.
+class GlobalsTracker:
+    def __init__(self, process, target, memory_model, names):
+        self.process = process
+        self.memory_model = memory_model
+
+        # only the executable's globals, a name can also be defined in a
+        # shared library, e.g. stdout copy-relocated from libc
+        module = target.FindModule(target.GetExecutable())
+        variables = dict()
+        for name in names:
+            for v in module.FindGlobalVariables(target, name, 16):
+                address = v.GetAddress().GetLoadAddress(target)
+                if is_global(v) and address != lldb.LLDB_INVALID_ADDRESS and v.GetByteSize() > 0:
+                    variables[address] = GlobalVariable(v, address)
+
+        self.variables = variables
+        self.ranges = get_ranges(variables)
+        self.data = dict()
+
+    # a variable with static storage seen in a stack frame. Function scope
+    # statics have symbols such as "x.1" that FindGlobalVariables doesn't
+    # always resolve, they are tracked from the first time their function
+    # runs
+    def add_static(self, v):
+        address = v.GetLoadAddress()
+        if address in self.variables or address == lldb.LLDB_INVALID_ADDRESS or v.GetByteSize() == 0:
+            return
+        self.variables[address] = GlobalVariable(v, address)
+        self.ranges = get_ranges(self.variables)
+        # the ranges moved, every global is decoded again on the next refresh
+        self.data = dict()
+
+    def __len__(self):
+        return sum([ len(r[2]) for r in self.ranges ])
+
+    # decode a global from its bytes using the layout of its type, pointers
+    # go through their SBValue
+    def decode(self, g, data):
+        if data is not None and g.large_array is not None:
+            (layout, count) = g.large_array
+            self.memory_model.add_lazy_range(LazyRange("globals", g.address, g.name, g.type_name, layout, count,
+                data, globals_owner, g.name))
+            self.memory_model.add_pointer_roots(globals_owner, "globals", g.name, layout, data, count)
+        elif data is not None and not g.is_pointer:
+            for (offset, size, value, suffix, type_name) in decode_layout(g.layout, data):
+                mv = MemoryValue("globals", g.address + offset, size, value, g.name + suffix, type_name, globals_owner)
+                self.memory_model.add(mv)
+            self.memory_model.add_pointer_roots(globals_owner, "globals", g.name, g.layout, data)
+        else:
+            self.memory_model.add_from_stack(self.process, "globals", g.value, globals_owner)
+
+    def refresh(self):
+        for (start, end, variables) in self.ranges:
+            data = read_memory(self.process, start, end - start)
+            prev = self.data.get(start)
+            self.data[start] = data
+
+            for g in variables:
+                offset = g.address - start
+                new = None if data is None else data[offset:offset + g.size]
+                old = None if prev is None else prev[offset:offset + g.size]
+                if new is None or new != old:
+                    self.decode(g, new)
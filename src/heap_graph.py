@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# The heap as a graph: every live allocation is a node and every pointer
+# stored in a node that points into another allocation is an edge. Pointer
+# variables on the stack and in globals that point into the heap are the
+# roots, they are registered as their values are decoded.
+#
+# After each step the graph is walked breadth first from the roots. Every
+# node is visited at most once per step, so cycles (circular and doubly
+# linked lists) and nodes shared by several paths cost a single visit. A
+# visit reads the node's bytes and only decodes them into the memory model
+# when they changed since the node was last decoded (or it is reached as
+# a different type). The walk stops at max_depth edges from the roots and
+# after max_nodes nodes.
+#----------------------------------------------------------------------
+import collections
+
+from memory_model import *
+
+class HeapNode:
+    def __init__(self, address, size):
+        self.address = address
+        self.size = size
+
+        # the type the node was last decoded as, and its bytes at the time
+        self.type_name = None
+        self.data = None
+
+        # (field address, label, target address, pointee type) for each
+        # pointer in the node that points into the heap
+        self.edges = list()
+
+        # distance from the roots in the last walk that reached the node
+        self.depth = None
+
+class HeapGraph:
+    def __init__(self, process, memory_model, max_depth=1000, max_nodes=10000):
+        self.process = process
+        self.memory_model = memory_model
+        self.max_depth = max_depth
+        self.max_nodes = max_nodes
+
+        # owner -> label -> (section, target address, pointee type)
+        self.roots = dict()
+        self.nodes = dict()
+
+        # nodes reached by the last walk, and whether it stopped early
+        self.reached = set()
+        self.truncated = False
+
+    # called for every pointer decoded outside of the heap, a pointer that
+    # doesn't point into a live allocation drops the root it replaces
+    def set_root(self, owner, section_name, label, pointer, pointee):
+        alloc = self.memory_model.find_heap_alloc(pointer)
+        if alloc is None:
+            labels = self.roots.get(owner)
+            if labels is not None:
+                labels.pop(label, None)
+            return
+        self.roots.setdefault(owner, dict())[label] = (section_name, alloc[0], pointee)
+
+    # the stack frame or heap block owning these roots is gone
+    def remove_roots(self, owner):
+        self.roots.pop(owner, None)
+
+    def remove_node(self, address):
+        self.nodes.pop(address, None)
+
+    def refresh(self):
+        heap_alloc_sizes = self.memory_model.heap_alloc_sizes
+        queue = collections.deque()
+        for labels in self.roots.values():
+            for (section_name, address, pointee) in labels.values():
+                queue.append((address, pointee, 0))
+
+        reached = set()
+        self.truncated = False
+        while len(queue) > 0:
+            (address, pointee, depth) = queue.popleft()
+            if address in reached or address not in heap_alloc_sizes:
+                continue
+            if len(reached) >= self.max_nodes:
+                self.truncated = True
+                break
+            reached.add(address)
+
+            node = self.nodes.get(address)
+            if node is None or node.size != heap_alloc_sizes[address]:
+                node = HeapNode(address, heap_alloc_sizes[address])
+                self.nodes[address] = node
+            node.depth = depth
+            self.visit(node, pointee)
+
+            if depth >= self.max_depth:
+                self.truncated = self.truncated or len(node.edges) > 0
+                continue
+            for (field_address, label, target, target_type) in node.edges:
+                if target not in reached:
+                    queue.append((target, target_type, depth + 1))
+        self.reached = reached
+
+    # decode the node as pointee if its bytes or type changed
+    def visit(self, node, pointee):
+        type_name = str(pointee)
+        data = read_memory(self.process, node.address, node.size)
+        if data is not None and data == node.data and type_name == node.type_name:
+            return
+
+        owner = heap_owner(node.address)
+        if node.type_name is not None and type_name != node.type_name:
+            # the rows of the old type may not line up with the new ones
+            self.memory_model.retire_owner(owner)
+        node.type_name = type_name
+        node.data = data
+        node.edges = list()
+
+        element_size = pointee.GetByteSize()
+        if data is None or element_size == 0:
+            # unreadable, or a void pointer: we don't know how to interpret the block
+            return
+        num_elems = node.size // element_size
+        if num_elems == 0:
+            return
+
+        if type_name == "char":
+            # heap string
+            mv = MemoryValue("heap", node.address, node.size, decode_c_string(data), "(none)", type_name, owner)
+            self.memory_model.add(mv)
+            return
+
+        layout = get_type_layout(pointee)
+        data = data[0:num_elems * element_size]
+        scalar_type = pointee.GetCanonicalType().GetName()
+        if num_elems > lazy_threshold and len(layout.fields) > 0:
+            # large blocks are kept as raw bytes, see LazyRange
+            r = LazyRange("heap", node.address, "(none)", "%s[%d]" % (type_name, num_elems), layout, num_elems, data, owner)
+            self.memory_model.add_lazy_range(r)
+        elif get_scalar_format(scalar_type, element_size) is not None:
+            # arrays of scalars are decoded straight from the raw bytes
+            for (i, value) in enumerate(decode_scalars(data, scalar_type, element_size)):
+                mv = MemoryValue("heap", node.address + i * element_size, element_size, value, "(none)", type_name, owner)
+                self.memory_model.add(mv)
+        else:
+            # structs, arrays and pointers, labelled with their index in
+            # the block (if there are several) and their path
+            for i in range(0, num_elems):
+                base = i * layout.byte_size
+                for (offset, size, value, suffix, field_type) in decode_layout(layout, data, base):
+                    label = get_element_label(num_elems, i, suffix)
+                    mv = MemoryValue("heap", node.address + base + offset, size, value, label, field_type, owner)
+                    self.memory_model.add(mv)
+
+        for (offset, suffix, pointer, target_type) in get_pointers(layout, data, num_elems):
+            alloc = self.memory_model.find_heap_alloc(pointer)
+            if alloc is not None:
+                label = suffix if num_elems > 1 else (suffix.lstrip(".") or "(none)")
+                node.edges.append((node.address + offset, label, alloc[0], target_type))
+
+    # the graph as plain lists, as stored in traces and shown by tpdb:
+    # nodes are [address, size, type, depth] (type and depth are None for
+    # allocations the last walk didn't reach), edges [source node, field
+    # address, label, target] and roots [section, label, target]
+    def export(self):
+        graph = dict()
+        graph["nodes"] = list()
+        graph["edges"] = list()
+        for (address, size) in sorted(self.memory_model.heap_alloc_sizes.items()):
+            node = self.nodes.get(address)
+            if node is None or address not in self.reached:
+                graph["nodes"].append([ address, size, None, None ])
+                continue
+            graph["nodes"].append([ address, size, node.type_name, node.depth ])
+            for (field_address, label, target, target_type) in node.edges:
+                if target in self.memory_model.heap_alloc_sizes:
+                    graph["edges"].append([ address, field_address, label, target ])
+        graph["roots"] = sorted([ [ section_name, label, address ]
+            for labels in self.roots.values() for (label, (section_name, address, pointee)) in labels.items() ])
+        graph["truncated"] = self.truncated
+        return graph
+
+def get_element_label(num_elems, i, suffix):
+    if num_elems > 1:
+        return "[%d]%s" % (i, suffix)
+    label = suffix.lstrip(".")
+    return label if label != "" else "(none)"
+
+empty_graph = { "nodes": [], "edges": [], "roots": [], "truncated": False }
+
+# rows to show an exported graph in a memory pane: one per node, with
+# the roots that point to it as its label, followed by one per edge
+def get_graph_values(graph):
+    roots = dict()
+    for (section_name, label, address) in graph["roots"]:
+        roots.setdefault(address, list()).append(section_name.split(" ")[-1] + "." + label)
+
+    values = list()
+    for (address, size, type_name, depth) in graph["nodes"]:
+        if type_name is None:
+            label = "(unreached)"
+        elif address in roots:
+            label = "root " + ", ".join(roots[address])
+        else:
+            label = "depth %d" % depth
+        values.append(MemoryValue("heap graph", address, size, type_name, label, type_name))
+    for (source, field_address, label, target) in graph["edges"]:
+        values.append(MemoryValue("heap graph", field_address, None, "-> 0x%x" % target, label, None))
+    return values
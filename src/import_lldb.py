@@ -2,6 +2,7 @@
 # Locate and load the lldb python module
 
 import os, sys
+from cache import *
 
 def import_lldb():
   """ Find and import the lldb modules. This function tries to find the lldb module by:
@@ -24,17 +25,34 @@ def import_lldb():
   if 'LLDB' in os.environ and os.path.exists(os.environ['LLDB']):
     lldb_executable = os.environ['LLDB']
 
+  # Running 'lldb -P' takes a noticeable part of startup, so the path it
+  # returns is cached until the lldb executable changes
+  from shutil import which
+  lldb_path = which(lldb_executable)
+  cache_key = get_file_key(lldb_path) if lldb_path is not None else None
+  if cache_key is not None:
+    cached_path = cache_load("lldb-path", cache_key)
+    if cached_path is not None and os.path.exists(cached_path):
+      sys.path.append(cached_path)
+      try:
+        import lldb
+        return True
+      except ImportError:
+        sys.path.remove(cached_path)
+
   # Try using builtin module location support ('lldb -P')
   from subprocess import check_output, CalledProcessError
   try:
     with open(os.devnull, 'w') as fnull:
-      lldb_minus_p_path = check_output("%s -P" % lldb_executable, shell=True, stderr=fnull).strip()
+      lldb_minus_p_path = check_output("%s -P" % lldb_executable, shell=True, stderr=fnull).decode().strip()
     if not os.path.exists(lldb_minus_p_path):
       #lldb -P returned invalid path, probably too old
       pass
     else:
-      sys.path.append(str(lldb_minus_p_path))
+      sys.path.append(lldb_minus_p_path)
       import lldb
+      if cache_key is not None:
+        cache_store("lldb-path", cache_key, lldb_minus_p_path)
       return True
   except CalledProcessError:
     # Cannot run 'lldb -P' to determine location of lldb python module
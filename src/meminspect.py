@@ -4,21 +4,166 @@
 # Dump the contents of memory for a given program at a given breakpoint
 # using lldb's python API
 #----------------------------------------------------------------------
-from import_lldb import *
-import lldb.utils.symbolication
-
 import argparse
 import sys
 import os
+import time
 
 from memory_model import *
-from utils import *
+from profiler import Profiler
+from sqlite_export import SqliteWriter
+from tracefile import open_program
+
+# Fast-forward commands that can appear in a step specification
+fast_forward_commands = {
+    "line": lambda program, arg: program.run_to_line(int(arg)),
+    "change": lambda program, arg: program.run_until_changed(arg),
+    "alloc": lambda program, arg: program.run_to_allocation(),
+}
+
+# Parse a step specification into a list of steps. A spec is a comma
+# separated list of step indices (5), inclusive ranges (1-20) and
+# fast-forward commands: line:N runs to line N, change:VAR runs until
+# variable VAR changes and alloc runs to the next malloc/free. Indices are
+# returned sorted unless the spec contains fast-forward commands, which are
+# returned as (command, argument) in the order they were given. "all" dumps
+# every step until the program exits and is returned as None
+def parse_step_spec(spec):
+    if spec == "all":
+        return None
+
+    steps = list()
+    has_commands = False
+    for item in spec.split(","):
+        (kind, _, arg) = item.partition(":")
+        if kind in fast_forward_commands:
+            steps.append((kind, arg))
+            has_commands = True
+        elif "-" in item:
+            (start, end) = item.split("-", 1)
+            steps.extend(range(int(start), int(end) + 1))
+        else:
+            steps.append(int(item))
+
+    if not has_commands:
+        steps = sorted(set(steps))
+    return steps
+
+# Parse a range of a large array, NAME:START-END, where NAME is the label
+# of the array or the address of a heap block (0x...). Returns (name,
+# first element, last element + 1)
+def parse_range_spec(spec):
+    (name, _, indices) = spec.rpartition(":")
+    (start, _, end) = indices.partition("-")
+    start = int(start)
+    end = int(end) if end != "" else start
+    return (name, start, end + 1)
+
+# Run the program once, writing the memory model to the writer at each
+# requested step. Returns the number of snapshots written.
+def dump_steps(program, steps, writer, max_steps=None):
+    if max_steps is not None:
+        if steps is None:
+            steps = list(range(0, max_steps + 1))
+        else:
+            steps = [ s for s in steps if isinstance(s, tuple) or s <= max_steps ]
+
+    n_written = 0
+    if steps is None:
+        writer.write_step(program.step_count, program.memory_model, program.output, program.get_heap_graph())
+        n_written += 1
+        while not program.has_exited():
+            prev_step = program.step_count
+            program.step()
+            # a replayed trace may end before the program exited
+            if program.step_count == prev_step:
+                break
+            writer.write_step(program.step_count, program.memory_model, program.output, program.get_heap_graph())
+            n_written += 1
+    else:
+        for s in steps:
+            if isinstance(s, tuple):
+                if program.has_exited() or (max_steps is not None and program.step_count >= max_steps):
+                    break
+                (kind, arg) = s
+                if not fast_forward_commands[kind](program, arg):
+                    break
+            elif program.step_count < s:
+                if program.has_exited():
+                    break
+                program.step(s - program.step_count)
+                if program.step_count < s:
+                    break
+            writer.write_step(program.step_count, program.memory_model, program.output, program.get_heap_graph())
+            n_written += 1
+    writer.close()
+    return n_written
+
+def main():
+    parser = argparse.ArgumentParser(description="dump the state of memory after n steps of execution")
+    parser.add_argument("program", help="program or trace file to inspect")
+    parser.add_argument("steps", help="number of steps, or a list/range of steps (1,5,10-20), fast-forward commands " +
+        "(line:N, change:VAR, alloc) or 'all' to dump each of them")
+    parser.add_argument("--stdin", default=None, help="file to connect to the program's stdin")
+    parser.add_argument("--startup-time", action="store_true", help="report the time to the first frame on stderr")
+    parser.add_argument("--no-cache", action="store_true", help="don't use or update the startup cache")
+    parser.add_argument("--format", choices=["tsv", "sqlite"], default="tsv", help="format of the dump")
+    parser.add_argument("-o", "--output", default=None, help="file to write the dump to, required for sqlite")
+    parser.add_argument("--range", action="append", default=[], metavar="NAME:START-END",
+        help="also dump elements START to END of the large array NAME (a label or heap address), " +
+        "for a single step")
+    parser.add_argument("--profile", nargs="?", const="-", default=None, metavar="FILE",
+        help="write phase timings and lldb call counts as JSON to FILE (default stderr)")
+    args = parser.parse_args()
+    if args.format == "sqlite" and args.output is None:
+        parser.error("--format sqlite requires --output")
+    if len(args.range) > 0 and (args.format != "tsv" or not args.steps.isdigit()):
+        parser.error("--range requires a single step and --format tsv")
+    ranges = [ parse_range_spec(spec) for spec in args.range ]
+
+    if args.no_cache:
+        os.environ["TPDB_NO_CACHE"] = "1"
+
+    start_time = time.time()
+    program = open_program(args.program, args.stdin)
+    if args.startup_time:
+        static_info = getattr(program, "static_info", None)
+        cache_state = "n/a" if static_info is None else ("hit" if static_info["cached"] else "miss")
+        sys.stderr.write("time to first frame: %.1fms (static info cache %s)\n" %
+            ((time.time() - start_time) * 1000, cache_state))
+
+    profiler = None
+    if args.profile is not None:
+        profiler = Profiler()
+        profiler.instrument_program(program)
+        profiler.time_calls(TsvDeltaWriter, "write_step", "export")
+        profiler.time_calls(SqliteWriter, "write_step", "export")
+        profiler.time_calls(MemoryModel, "write_tsv", "export")
+
+    if args.format == "sqlite":
+        dump_steps(program, parse_step_spec(args.steps), SqliteWriter(args.output))
+    else:
+        fh = sys.stdout if args.output is None else open(args.output, "w")
+        if args.steps.isdigit():
+            program.step(int(args.steps))
+            expand = list()
+            for (name, start, stop) in ranges:
+                r = program.memory_model.find_lazy_range(name)
+                if r is None:
+                    sys.stderr.write("no large array %s\n" % name)
+                else:
+                    expand.append((r, start, stop))
+            program.memory_model.write_tsv(fh, expand)
+        else:
+            dump_steps(program, parse_step_spec(args.steps), TsvDeltaWriter(fh))
+        fh.flush()
 
-if len(sys.argv) != 3:
-    sys.stderr.write("usage: meminspect.py <program> <n>")
-    sys.exit(1)
+    if profiler is not None:
+        if args.profile == "-":
+            profiler.write_report(sys.stderr)
+        else:
+            with open(args.profile, "w") as pfh:
+                profiler.write_report(pfh)
 
-program = ProgramState(sys.argv[1])
-n_steps = int(sys.argv[2])
-program.step(n_steps)
-program.memory_model.write_tsv(sys.stdout)
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,52 @@
 #!/usr/bin/env python
 
-import lldb
+import bisect
+import struct
 import sys
-from utils import *
-
+import zlib
+from array import array
+from raw_decode import *
+from regions import AllocationIndex
+from type_layout import *
+
+# Read size bytes of the process' memory, returns None if it can't be read.
+# lldb is imported here rather than at the top of the module so that
+# replaying a trace does not require it.
+def read_memory(process, address, size):
+    import lldb
+    if size <= 0:
+        return None
+    error = lldb.SBError()
+    data = process.ReadMemory(address, size, error)
+    if not error.Success():
+        return None
+    return data
+
+# Strings repeated across many values (sections, types and common values
+# such as "'a'") are interned so that the values share one copy. Interned
+# strings are freed once nothing uses them.
+def intern_str(s):
+    return sys.intern(s) if type(s) is str else s
+
+# A value is its row, the tuple used for snapshots, and its owner. Values
+# are never modified and have no __dict__. A memory model doesn't keep
+# them, they are created from its columns when read, see ValueStore.
 class MemoryValue:
-    def __init__(self, section, address, size, value, label, type_name):
-        self.section = section
-        self.address = address
-        self.size = size
-        self.value = value
-        self.label = label
-        self.type_name = type_name
+    __slots__ = ("row", "owner")
+
+    def __init__(self, section, address, size, value, label, type_name, owner=None):
+        self.row = (intern_str(section), address, size, value, label, intern_str(type_name))
+
+        # the stack frame or heap allocation this value belongs to,
+        # the value is evicted when its owner returns or is freed
+        self.owner = owner
+
+    section = property(lambda self: self.row[0])
+    address = property(lambda self: self.row[1])
+    size = property(lambda self: self.row[2])
+    value = property(lambda self: self.row[3])
+    label = property(lambda self: self.row[4])
+    type_name = property(lambda self: self.row[5])
 
     def get_addr_as_str(self):
         return "0x%0.16x" % self.address
@@ -32,161 +67,790 @@ class MemoryValue:
         out.append("(none)" if self.type_name is None else str(self.type_name))
         return "\t".join(out)
 
-class ProgramState:
-    def __init__(self, program_name):
-
-        # initialize debugger, load the target
-        self.debugger = lldb.SBDebugger.Create()
-        self.debugger.SetAsync(False)
-        self.command_interpreter = self.debugger.GetCommandInterpreter()
-        self.target = self.debugger.CreateTarget(program_name)
-
-        # put a breakpoint on main before we launch so our initial state is there
-        self.target.BreakpointCreateByName("main")
-        
-        self.arch = self.target.triple.split("-")[0]
-
-        # launch the process, it will run until the breakpoint is hit
-        launch_info = lldb.SBLaunchInfo(None)
-        error = lldb.SBError()
-        self.process = self.target.Launch(launch_info, error)
-        if not error.Success():
-            print(error)
-            sys.exit(1)
-        
-        run_commands(self.command_interpreter, ['settings set target.process.thread.step-in-avoid-nodebug false'])
-        # put breakpoints on malloc and free
-        self.target.BreakpointCreateByName("malloc")
-        self.target.BreakpointCreateByName("free")
-
-        sf = self.process.GetSelectedThread().GetSelectedFrame()
-        self.line_entry = sf.GetLineEntry()
-        self.function_name = sf.GetFunctionName()
-        self.main_filename = sf.GetLineEntry().GetFileSpec().GetFilename()
-        self.code = dict()
-        self.stdout = list()
-        self.memory_model = MemoryModel()
-        
-        # get the text section
-        self.memory_model.read_text_section(self.target)
-
-    def get_code(self):
-        d = self.line_entry.GetFileSpec().GetDirectory()
-        f = self.line_entry.GetFileSpec().GetFilename()
-        
-        if d is None or f is None:
-            return []
-
-        p = d + "/" + f
-
-        if p not in self.code:
-            lines = list()
-            with open(p) as fh:
-                for (ln, s) in enumerate(fh):
-                    lines.append("%3d %s" % (ln + 1, s.rstrip()))
-            self.code[p] = lines
-        return self.code[p]    
-
-    def get_line_number(self):
-        return self.line_entry.GetLine()
-
-    def get_stack_frame_name(self, frame):
-        fn = frame.GetDisplayFunctionName()
-        if fn == None:
-            fn = "(none)"
-        return "stack" + " " + fn
-
-    def get_active_stack_frames(self):
-        thread = self.process.GetSelectedThread()
+    # plain tuple form used when storing and comparing snapshots
+    def to_tuple(self):
+        return self.row
+
+    # rows of snapshots taken in this process are shared as they are,
+    # rows read from traces (lists) are interned again
+    @staticmethod
+    def from_tuple(t, owner=None):
+        if type(t) is not tuple:
+            return MemoryValue(*t, owner=owner)
+        v = MemoryValue.__new__(MemoryValue)
+        v.row = t
+        v.owner = owner
+        return v
+
+# A large array kept as its raw bytes. Only a summary row is stored in the
+# memory model, the rows of its elements are decoded from the bytes when a
+# viewer asks for them. A range is never modified, when the bytes of the
+# array change it is replaced by a new one.
+class LazyRange:
+    def __init__(self, section, address, label, type_name, layout, count, data, owner=None, prefix=""):
+        self.section = section
+        self.address = address
+        self.label = label
+        self.type_name = type_name
+        self.layout = layout
+        self.count = count
+        self.data = data
+        self.owner = owner
+        # elements are labelled prefix[i] followed by the path of the field
+        self.prefix = prefix
+        self.rows_per_elem = len(layout.fields)
+        # the rows of every element, decoded the first time an export asks
+        self.all_rows = None
+
+    # the number of rows of all the elements
+    def __len__(self):
+        return self.count * self.rows_per_elem
+
+    def get_summary(self):
+        value = "(%d elements, crc32 %0.8x)" % (self.count, zlib.crc32(self.data))
+        return MemoryValue(self.section, self.address, len(self.data), value, self.label, self.type_name, self.owner)
+
+    # the values of rows [start, stop)
+    def get_rows(self, start, stop):
+        values = list()
+        first = start // self.rows_per_elem
+        last = min(self.count, (stop + self.rows_per_elem - 1) // self.rows_per_elem)
+        for i in range(first, last):
+            base = i * self.layout.byte_size
+            rows = decode_layout(self.layout, self.data, base)
+            for (j, (offset, size, value, suffix, type_name)) in enumerate(rows):
+                if start <= i * self.rows_per_elem + j < stop:
+                    label = "%s[%d]%s" % (self.prefix, i, suffix)
+                    values.append(MemoryValue(self.section, self.address + base + offset, size, value, label, type_name, self.owner))
+        return values
+
+    # the values of elements [start, stop)
+    def get_elements(self, start, stop):
+        return self.get_rows(start * self.rows_per_elem, stop * self.rows_per_elem)
+
+    # the rows of all elements, as snapshot tuples, for the exports that
+    # keep every element (multi-step dumps, traces and SQLite)
+    def get_all_rows(self):
+        if self.all_rows is None:
+            self.all_rows = [ v.to_tuple() for v in self.get_rows(0, len(self)) ]
+        return self.all_rows
+
+# The rows of a memory section as a viewer shows them: the values at its
+# sorted addresses, each lazy range followed by the rows of its elements.
+# Element rows are only decoded for the windows that are asked for.
+class SectionRows:
+    def __init__(self, addresses, memory, lazy_ranges=()):
+        self.addresses = addresses
+        self.memory = memory
+
+        # the rows are split into runs of addresses and runs of the elements
+        # of a lazy range, as (first row, start, stop, lazy range or None)
+        self.segments = list()
+        row = 0
+        a = 0
+        for r in sorted(lazy_ranges, key=lambda r: r.address):
+            # the summary row ends the run of addresses before the elements
+            b = bisect.bisect_right(addresses, r.address)
+            self.segments.append((row, a, b, None))
+            row += b - a
+            self.segments.append((row, 0, len(r), r))
+            row += len(r)
+            a = b
+        self.segments.append((row, a, len(addresses), None))
+        self.starts = [ s[0] for s in self.segments ]
+        self.n_rows = row + len(addresses) - a
+
+    # rows for values that aren't in a memory model, e.g. the heap graph
+    @staticmethod
+    def from_values(values):
+        values = sorted(values, key=lambda v: v.address)
+        return SectionRows(range(len(values)), values)
+
+    def __len__(self):
+        return self.n_rows
+
+    # the values of rows [start, stop)
+    def get(self, start, stop):
         out = list()
-        for f in thread.frames:
-            out.append(self.get_stack_frame_name(f))
+        k = max(0, bisect.bisect_right(self.starts, start) - 1)
+        while k < len(self.segments) and self.starts[k] < stop:
+            (first, a, b, r) = self.segments[k]
+            lo = max(0, start - first)
+            hi = min(b - a, stop - first)
+            if lo < hi:
+                if r is None:
+                    out.extend([ self.memory[addr] for addr in self.addresses[a + lo:a + hi] ])
+                else:
+                    out.extend(r.get_rows(lo, hi))
+            k += 1
         return out
 
-    def step(self, n_steps=1):
-        for _ in range(0, n_steps):
-
-            # advance the program exactly one execution step
-            self.advance()
-
-            # update state variables
-            thread = self.process.GetSelectedThread()
-            self.function_name = thread.GetSelectedFrame().GetFunctionName()
-            self.line_entry = thread.GetSelectedFrame().GetLineEntry()
-            
-            if self.process.state != lldb.eStateExited:
-                for frame in thread.frames:
-                    # in x86-64 the first stack frame is start before handing to main, skip it
-                    sf_name = self.get_stack_frame_name(frame)
-                    if "__libc_start" in sf_name:
-                        continue
-                    for v in frame.variables:
-                        self.memory_model.add_from_stack(self.process, sf_name, v)
-            
-            # Update stdout
-            max_chars = 120
-            s = self.process.GetSTDOUT(max_chars)
-            if len(s) > 0:
-                self.stdout.append(s.rstrip())
-    
-    # advance the program by a single step, taking care
-    # of various corner cases (handling malloc, etc)
-    def advance(self):
-        
-        thread = self.process.GetSelectedThread()
-
-        begin_file = self.get_filename_of_current_line(thread)
-        begin_line_num = thread.GetSelectedFrame().GetLineEntry().GetLine()
-
-        # perform the step in LLDB
-        thread.StepInto()
-        
-        curr_fn = thread.GetSelectedFrame().GetFunctionName()
-        # glibc malloc has mangled function names
-        if curr_fn.endswith("malloc"):
-            handle_malloc(self.memory_model, thread, self.arch)
-        elif curr_fn.endswith("free"):
-            handle_free(self.memory_model, thread, self.arch)
-
-        # lazy way of detecting when we're in non-user functions
-        # this won't handle programs with code in multiple files
-        while not self.has_exited() and self.get_filename_of_current_line(thread) != self.main_filename: 
-            thread.StepOut()
-
-        # for reasons I don't yet understand step-into can sometimes do an instruction-level step?
-        # detect this by checking whether we changed line numbers, if not recurse
-        if self.get_filename_of_current_line(thread) == begin_file and \
-            thread.GetSelectedFrame().GetLineEntry().GetLine() == begin_line_num:
-            return self.advance()
-
-    def get_filename_of_current_line(self, thread):
-        return thread.GetSelectedFrame().GetLineEntry().GetFileSpec().GetFilename()
-
-    def has_exited(self):
-        return self.process.state == lldb.eStateExited
+# The first part of a label, the name of the variable it belongs to:
+# "arr" for "arr[3].x", "p" for "p.next"
+def get_base_label(label):
+    if label is None:
+        return None
+    for (i, c) in enumerate(label):
+        if (c == "[" or c == ".") and i > 0:
+            return label[0:i]
+    return label
+
+# Values are kept in columns of a few bytes per value rather than as one
+# object each. Strings that repeat (sections, types, and labels with the
+# index of the array element taken out) are stored as small integers into
+# tables, and values in the formats the decoders write (decimal and hex
+# integers, floats) as their 64 raw bits, formatted again when the value
+# is read. Other values are kept as strings.
+value_none = 0
+value_str = 1
+value_int = 2
+value_uint = 3
+value_double = 4
+value_float = 5
+# "0x" and kind - value_hex digits
+value_hex = 16
+
+double_struct = struct.Struct("<d")
+raw_struct = struct.Struct("<Q")
+
+# (kind, raw bits, string) of a value
+def encode_value(value):
+    if value is None:
+        return (value_none, 0, None)
+    if type(value) is str and 0 < len(value) <= 24:
+        if value.startswith("0x"):
+            n = len(value) - 2
+            try:
+                x = int(value, 16)
+                if n <= 16 and "0x%0.*x" % (n, x) == value:
+                    return (value_hex + n, x, None)
+            except ValueError:
+                pass
+        elif value[0].isdigit() or value[0] in "-in":
+            try:
+                x = int(value)
+                if str(x) == value and -(1 << 63) <= x < (1 << 64):
+                    return (value_uint if x >= (1 << 63) else value_int, x & 0xffffffffffffffff, None)
+            except ValueError:
+                try:
+                    x = float(value)
+                    raw = raw_struct.unpack(double_struct.pack(x))[0]
+                    if "%.17g" % x == value:
+                        return (value_double, raw, None)
+                    if "%.9g" % x == value:
+                        return (value_float, raw, None)
+                except ValueError:
+                    pass
+    return (value_str, 0, intern_str(value))
+
+def decode_value(kind, raw, s):
+    if kind == value_str or kind == value_none:
+        return s
+    if kind == value_int:
+        return str(raw - (1 << 64) if raw >> 63 else raw)
+    if kind >= value_hex:
+        return "0x%0.*x" % (kind - value_hex, raw)
+    if kind == value_uint:
+        return str(raw)
+    x = double_struct.unpack(raw_struct.pack(raw))[0]
+    return "%.17g" % x if kind == value_double else "%.9g" % x
+
+# "arr[3].x" is stored as the format "arr[%d].x" and 3, so that the
+# elements of an array share one label. Returns (label, -1) for others
+def split_label(label):
+    i = label.find("[")
+    j = label.find("]", i + 1)
+    if i >= 0 and j > i + 1:
+        digits = label[i + 1:j]
+        if digits.isascii() and digits.isdigit() and str(int(digits)) == digits and int(digits) < (1 << 31):
+            return (label[0:i + 1].replace("%", "%%") + "%d" + label[j:].replace("%", "%%"), int(digits))
+    return (label, -1)
+
+# strings numbered in the order they were first seen, 0 is None. Entries
+# are never removed, a table is shared by a model and its copies
+class StringTable:
+    def __init__(self):
+        self.ids = { None: 0 }
+        self.strings = [ None ]
+
+    def get_id(self, s):
+        i = self.ids.get(s)
+        if i is None:
+            i = len(self.strings)
+            self.strings.append(intern_str(s))
+            self.ids[s] = i
+        return i
+
+class ValueTables:
+    def __init__(self):
+        self.sections = StringTable()
+        self.labels = StringTable()
+        self.types = StringTable()
+        # label -> (label id, index), for the labels seen recently
+        self.split_labels = dict()
+
+    def encode_label(self, label):
+        r = self.split_labels.get(label)
+        if r is None:
+            (s, index) = (None, -1) if label is None else split_label(label)
+            r = (self.labels.get_id(s), index)
+            if len(self.split_labels) >= 65536:
+                self.split_labels.clear()
+            self.split_labels[label] = r
+        return r
+
+    def decode_label(self, label_id, index):
+        s = self.labels.strings[label_id]
+        return s if index < 0 else s % index
+
+# the columns of a chunk, in the order of the fields of an encoded row:
+# address, size (-1 for None), section, label, element index (-1 for
+# none), type, owner, value kind, raw value, value string
+(col_address, col_size, col_section, col_label, col_index, col_type, col_owner, col_kind, col_raw, col_str) = range(10)
+
+def new_columns():
+    return [ array("Q"), array("q"), array("I"), array("I"), array("i"), array("I"), array("I"), array("B"), array("Q"), list() ]
+
+# The values of a run of consecutive addresses. A chunk may be shared by
+# a model and its copies, only the store whose token it carries changes it
+# in place, the others replace it with a copy first.
+class ValueChunk:
+    __slots__ = ("columns", "token", "runs")
+
+    def __init__(self, columns, token):
+        self.columns = columns
+        self.token = token
+        # (section id, start, stop) of the rows of each section, built when
+        # the rows of the sections are asked for
+        self.runs = None
+
+    def __len__(self):
+        return len(self.columns[col_address])
+
+    def get_row(self, i):
+        return tuple([ c[i] for c in self.columns ])
+
+    def get_runs(self):
+        if self.runs is None:
+            runs = list()
+            start = 0
+            sections = self.columns[col_section]
+            for i in range(1, len(sections) + 1):
+                if i == len(sections) or sections[i] != sections[start]:
+                    runs.append((sections[start], start, i))
+                    start = i
+            self.runs = runs
+        return self.runs
+
+# rows per chunk, a chunk is split in two when it grows past this
+chunk_size = 256
+
+# The values of a memory model, by address. Reading it works like a dict
+# of address -> MemoryValue, values are created from the columns as they
+# are read. Copies share the chunks, a chunk is only copied once one of
+# the stores changes it.
+class ValueStore:
+    def __init__(self, tables=None):
+        self.tables = ValueTables() if tables is None else tables
+        self.chunks = list()
+        # the first address of each chunk
+        self.firsts = list()
+        self.n = 0
+        self.token = object()
+        # owner id -> owner, for the model that tracks owners. Copies
+        # return values without their owner
+        self.owners = None
+
+    def __len__(self):
+        return self.n
+
+    # (chunk, row, found) of address
+    def locate(self, address):
+        k = bisect.bisect_right(self.firsts, address) - 1
+        if k < 0:
+            return (0, 0, False)
+        addresses = self.chunks[k].columns[col_address]
+        i = bisect.bisect_left(addresses, address)
+        return (k, i, i < len(addresses) and addresses[i] == address)
+
+    def encode(self, row, owner_id=0):
+        (section, address, size, value, label, type_name) = row
+        t = self.tables
+        (label_id, index) = t.encode_label(label)
+        (kind, raw, s) = encode_value(value)
+        return (address, -1 if size is None else size, t.sections.get_id(section), label_id, index,
+            t.types.get_id(type_name), owner_id, kind, raw, s)
+
+    # the snapshot row of an encoded row
+    def decode(self, enc):
+        t = self.tables
+        return (t.sections.strings[enc[col_section]], enc[col_address], None if enc[col_size] < 0 else enc[col_size],
+            decode_value(enc[col_kind], enc[col_raw], enc[col_str]), t.decode_label(enc[col_label], enc[col_index]),
+            t.types.strings[enc[col_type]])
+
+    def get_value(self, enc):
+        owner = None
+        if self.owners is not None and enc[col_owner] != 0:
+            owner = self.owners[enc[col_owner]]
+        return MemoryValue.from_tuple(self.decode(enc), owner)
+
+    def get_encoded(self, address):
+        (k, i, found) = self.locate(address)
+        return self.chunks[k].get_row(i) if found else None
+
+    def get(self, address, default=None):
+        enc = self.get_encoded(address)
+        return default if enc is None else self.get_value(enc)
+
+    def __getitem__(self, address):
+        enc = self.get_encoded(address)
+        if enc is None:
+            raise KeyError(address)
+        return self.get_value(enc)
+
+    def __contains__(self, address):
+        return self.locate(address)[2]
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            for address in chunk.columns[col_address]:
+                yield address
+
+    def keys(self):
+        return iter(self)
+
+    def get_encoded_rows(self):
+        for chunk in self.chunks:
+            for enc in zip(*chunk.columns):
+                yield enc
+
+    # the snapshot rows, in address order. Same as decode, for every row
+    def get_rows(self):
+        sections = self.tables.sections.strings
+        labels = self.tables.labels.strings
+        types = self.tables.types.strings
+        for chunk in self.chunks:
+            for (address, size, section, label, index, type_id, owner, kind, raw, s) in zip(*chunk.columns):
+                yield (sections[section], address, None if size < 0 else size,
+                    s if kind <= value_str else decode_value(kind, raw, s),
+                    labels[label] if index < 0 else labels[label] % index, types[type_id])
+
+    def values(self):
+        for enc in self.get_encoded_rows():
+            yield self.get_value(enc)
+
+    def items(self):
+        for enc in self.get_encoded_rows():
+            yield (enc[col_address], self.get_value(enc))
+
+    def get_writable(self, k):
+        chunk = self.chunks[k]
+        if chunk.token is not self.token:
+            chunk = ValueChunk([ c[:] for c in chunk.columns ], self.token)
+            self.chunks[k] = chunk
+        chunk.runs = None
+        return chunk
+
+    # store an encoded row, returns the one it replaced or None
+    def put(self, enc):
+        address = enc[col_address]
+        if len(self.chunks) == 0:
+            self.chunks.append(ValueChunk(new_columns(), self.token))
+            self.firsts.append(address)
+        (k, i, found) = self.locate(address)
+        if found:
+            prev = self.chunks[k].get_row(i)
+            if prev != enc:
+                for (c, x) in zip(self.get_writable(k).columns, enc):
+                    c[i] = x
+            return prev
+
+        chunk = self.get_writable(k)
+        for (c, x) in zip(chunk.columns, enc):
+            c.insert(i, x)
+        self.n += 1
+        if i == 0:
+            self.firsts[k] = address
+        if len(chunk) > chunk_size:
+            half = len(chunk) // 2
+            self.chunks[k:k + 1] = [ ValueChunk([ c[0:half] for c in chunk.columns ], self.token),
+                ValueChunk([ c[half:] for c in chunk.columns ], self.token) ]
+            self.firsts.insert(k + 1, chunk.columns[col_address][half])
+        return None
+
+    # remove rows [i, j) of chunk k, returns their columns
+    def remove_rows(self, k, i, j):
+        chunk = self.get_writable(k)
+        removed = [ c[i:j] for c in chunk.columns ]
+        for c in chunk.columns:
+            del c[i:j]
+        self.n -= j - i
+        if len(chunk) == 0:
+            del self.chunks[k]
+            del self.firsts[k]
+        else:
+            self.firsts[k] = chunk.columns[col_address][0]
+            # merge small chunks left behind by removals into the next one
+            if k + 1 < len(self.chunks) and len(chunk) + len(self.chunks[k + 1]) <= chunk_size // 2:
+                following = self.chunks[k + 1]
+                for (c, other) in zip(chunk.columns, following.columns):
+                    c.extend(other)
+                del self.chunks[k + 1]
+                del self.firsts[k + 1]
+        return removed
+
+    # remove the rows at the given addresses (sorted), returns them as a
+    # new store
+    def remove(self, addresses):
+        removed = ValueStore(self.tables)
+        columns = new_columns()
+        j = 0
+        while j < len(addresses):
+            (k, i, found) = self.locate(addresses[j])
+            j += 1
+            if not found:
+                continue
+            # the run of addresses at consecutive rows of the chunk
+            chunk_addresses = self.chunks[k].columns[col_address]
+            end = i + 1
+            while j < len(addresses) and end < len(chunk_addresses) and chunk_addresses[end] == addresses[j]:
+                end += 1
+                j += 1
+            for (c, rows) in zip(columns, self.remove_rows(k, i, end)):
+                c.extend(rows)
+        if len(columns[col_address]) > 0:
+            removed.chunks.append(ValueChunk(columns, removed.token))
+            removed.firsts.append(columns[col_address][0])
+            removed.n = len(columns[col_address])
+        return removed
+
+    # a store holding the same values. The chunks are shared from now on,
+    # whichever store changes one first copies it
+    def copy(self):
+        store = ValueStore(self.tables)
+        store.chunks = list(self.chunks)
+        store.firsts = list(self.firsts)
+        store.n = self.n
+        self.token = object()
+        return store
+
+    # address -> encoded row of the rows in chunks that other doesn't share
+    def get_unshared_rows(self, other):
+        shared = set([ id(chunk) for chunk in other.chunks ])
+        rows = dict()
+        for chunk in self.chunks:
+            if id(chunk) not in shared:
+                for enc in zip(*chunk.columns):
+                    rows[enc[col_address]] = enc
+        return rows
+
+    # section name -> sorted addresses of its values
+    def get_section_addresses(self):
+        sections = dict()
+        for chunk in self.chunks:
+            addresses = chunk.columns[col_address]
+            for (section, start, stop) in chunk.get_runs():
+                if section not in sections:
+                    sections[section] = array("Q")
+                sections[section].extend(addresses[start:stop])
+        return dict([ (self.tables.sections.strings[s], a) for (s, a) in sections.items() ])
+
+    # the values at addresses in [start, end), of one section or all of them
+    def get_range(self, start, end, section=None):
+        section_id = None if section is None else self.tables.sections.ids.get(section, -1)
+        values = list()
+        (k, i, found) = self.locate(start)
+        while k < len(self.chunks):
+            chunk = self.chunks[k]
+            addresses = chunk.columns[col_address]
+            stop = bisect.bisect_left(addresses, end, i)
+            for j in range(i, stop):
+                if section_id is None or chunk.columns[col_section][j] == section_id:
+                    values.append(self.get_value(chunk.get_row(j)))
+            if stop < len(addresses):
+                break
+            k += 1
+            i = 0
+        return values
+
+# Lookups of the values of a memory model by (section, variable) and by
+# type. They are only built once a model is asked for them, then updated
+# as values are added and removed.
+class MemoryIndex:
+    def __init__(self, rows=()):
+        self.names = dict()
+        self.types = dict()
+        for row in rows:
+            self.insert(row)
+
+    def insert(self, row):
+        self.names.setdefault((row[0], get_base_label(row[4])), set()).add(row[1])
+        self.types.setdefault(row[5], set()).add(row[1])
+
+    def remove(self, row):
+        key = (row[0], get_base_label(row[4]))
+        self.names[key].discard(row[1])
+        if len(self.names[key]) == 0:
+            del self.names[key]
+        self.types[row[5]].discard(row[1])
+        if len(self.types[row[5]]) == 0:
+            del self.types[row[5]]
+
+# compare two snapshots (address -> tuple) and return the rows that were
+# added or changed and the addresses that were removed
+def diff_snapshots(old, new):
+    added = list()
+    changed = list()
+    for addr, row in new.items():
+        if addr not in old:
+            added.append(row)
+        elif old[addr] != row:
+            changed.append(row)
+    removed = [ addr for addr in old if addr not in new ]
+    return added, changed, removed
+
+# the owner of values that live in a heap allocation
+def heap_owner(address):
+    return ("heap", address)
 
 class MemoryModel:
     def __init__(self):
 
-        self.memory = dict()
+        # address -> MemoryValue, see ValueStore
+        self.memory = ValueStore()
+
+        # lookups by section, variable and type, built when first used,
+        # see MemoryIndex
+        self.index = None
+
+        # owners (stack frames and heap allocations) are stored as small
+        # integers: owner -> id, the owner of each id (None once it died)
+        # and the ids free to reuse
+        self.owner_ids = dict()
+        self.owners = [ None ]
+        self.free_owner_ids = list()
+        self.memory.owners = self.owners
+
+        # addresses of the values belonging to each owner id
+        self.owned = dict()
+
         self.heap_alloc_sizes = dict()
+        self.allocations = AllocationIndex()
+
+        # number of calls to malloc/free seen so far
+        self.n_allocator_calls = 0
+
+        # memory map of the live process, set by ProgramState
+        self.regions = None
+
+        # the HeapGraph following pointers into the heap, set by ProgramState
+        self.heap_graph = None
+
+        # large arrays whose elements are decoded on demand, keyed by
+        # the address of their summary row
+        self.lazy_ranges = dict()
     
     def clear(self):
-        self.memory.clear()
+        self.memory = ValueStore(self.memory.tables)
+        self.memory.owners = self.owners
+        self.index = None
+        self.owner_ids.clear()
+        del self.owners[1:]
+        self.free_owner_ids = list()
+        self.owned.clear()
+        self.lazy_ranges.clear()
+
+    def get_owner_id(self, owner):
+        if owner is None:
+            return 0
+        i = self.owner_ids.get(owner)
+        if i is None:
+            if len(self.free_owner_ids) > 0:
+                i = self.free_owner_ids.pop()
+                self.owners[i] = owner
+            else:
+                i = len(self.owners)
+                self.owners.append(owner)
+            self.owner_ids[owner] = i
+        return i
 
     def add(self, value):
-        self.memory[value.address] = value
+        if len(self.lazy_ranges) > 0:
+            self.lazy_ranges.pop(value.address, None)
+        owner_id = self.get_owner_id(value.owner)
+        enc = self.memory.encode(value.row, owner_id)
+        prev = self.memory.put(enc)
+        prev_owner_id = 0 if prev is None else prev[col_owner]
+        if prev_owner_id != owner_id:
+            if prev_owner_id != 0:
+                self.owned[prev_owner_id].remove(value.address)
+            if owner_id != 0:
+                self.owned.setdefault(owner_id, array("Q")).append(value.address)
+        if self.index is not None and (prev is None or prev[col_section:col_owner] != enc[col_section:col_owner]):
+            if prev is not None:
+                self.index.remove(self.memory.decode(prev))
+            self.index.insert(value.row)
+
+    # remove the values at the given addresses, returns them as a ValueStore
+    def remove_values(self, addresses):
+        addresses = sorted(addresses)
+        values = self.memory.remove(addresses)
+        for addr in addresses:
+            self.lazy_ranges.pop(addr, None)
+        for enc in values.get_encoded_rows():
+            owned = self.owned.get(enc[col_owner])
+            if owned is not None:
+                owned.remove(enc[col_address])
+        if self.index is not None:
+            for row in values.get_rows():
+                self.index.remove(row)
+        return values
+
+    # remove all values belonging to a stack frame that returned or a heap
+    # block that was freed
+    def retire_owner(self, owner):
+        owner_id = self.owner_ids.pop(owner, None)
+        if owner_id is not None:
+            self.owners[owner_id] = None
+            self.free_owner_ids.append(owner_id)
+            self.remove_values(self.owned.pop(owner_id, ()))
+        if self.heap_graph is not None:
+            self.heap_graph.remove_roots(owner)
+
+    # address -> row, in address order. With expand_lazy the summary row of
+    # each lazy range is replaced by the rows of its elements
+    def snapshot(self, expand_lazy=False):
+        if not expand_lazy or len(self.lazy_ranges) == 0:
+            return dict([ (row[1], row) for row in self.memory.get_rows() ])
+
+        rows = dict()
+        for row in self.memory.get_rows():
+            r = self.lazy_ranges.get(row[1])
+            if r is None:
+                rows[row[1]] = row
+            else:
+                for element_row in r.get_all_rows():
+                    rows[element_row[1]] = element_row
+        return rows
+
+    # the rows added, changed and removed since prev, a copy of this model
+    # taken earlier, with the lazy ranges expanded as by snapshot. Only the
+    # chunks of values the two models no longer share are compared
+    def diff(self, prev):
+        if prev.memory.tables is not self.memory.tables:
+            old = prev.snapshot(expand_lazy=True)
+            new = self.snapshot(expand_lazy=True)
+        else:
+            old_rows = prev.memory.get_unshared_rows(self.memory)
+            new_rows = self.memory.get_unshared_rows(prev.memory)
+            # rows written again unchanged, or only moved to another owner
+            for (addr, enc) in list(new_rows.items()):
+                other = old_rows.get(addr)
+                if other is not None and other[0:col_owner] == enc[0:col_owner] and other[col_kind:] == enc[col_kind:]:
+                    del old_rows[addr]
+                    del new_rows[addr]
+            old = dict([ (addr, prev.memory.decode(enc)) for (addr, enc) in old_rows.items() ])
+            new = dict([ (addr, self.memory.decode(enc)) for (addr, enc) in new_rows.items() ])
+
+            # lazy ranges that were replaced are compared element by element
+            for addr in set(prev.lazy_ranges) | set(self.lazy_ranges):
+                (r, s) = (prev.lazy_ranges.get(addr), self.lazy_ranges.get(addr))
+                if r is s:
+                    continue
+                for (rows, lazy_range) in ((old, r), (new, s)):
+                    if lazy_range is not None:
+                        rows.pop(addr, None)
+                        for row in lazy_range.get_all_rows():
+                            rows[row[1]] = row
+
+        added, changed, removed = diff_snapshots(old, new)
+        return added, changed, [ old[addr] for addr in removed ]
+
+    # a model holding the same values and lazy ranges, to be read while
+    # this one keeps changing. The values are shared until either changes
+    # them, see ValueStore
+    def copy(self):
+        m = MemoryModel()
+        m.memory = self.memory.copy()
+        m.lazy_ranges = dict(self.lazy_ranges)
+        m.n_allocator_calls = self.n_allocator_calls
+        return m
+
+    def load_snapshot(self, rows):
+        self.memory = ValueStore(self.memory.tables)
+        self.memory.owners = self.owners
+        if self.index is not None:
+            self.index = MemoryIndex()
+        self.lazy_ranges = dict()
+        for r in rows:
+            self.add(MemoryValue.from_tuple(r))
+
+    def apply_delta(self, rows, removed):
+        for r in rows:
+            self.add(MemoryValue.from_tuple(r))
+        self.remove_values(removed)
+
+    def add_lazy_range(self, r):
+        self.add(r.get_summary())
+        self.lazy_ranges[r.address] = r
+
+    # the lazy range labelled name, or starting at address name (0x...)
+    def find_lazy_range(self, name):
+        for r in self.lazy_ranges.values():
+            if r.label == name or (name.startswith("0x") and r.address == int(name, 16)):
+                return r
+        return None
+
+    # the value labelled label in the given section, or None
+    def find_value(self, section, label):
+        for v in self.find_by_name(section, get_base_label(label)):
+            if v.label == label:
+                return v
+        return None
+
+    def get_index(self):
+        if self.index is None:
+            self.index = MemoryIndex(self.memory.get_rows())
+        return self.index
+
+    # the values of the variable name (its fields and elements) in the
+    # given section, sorted by address
+    def find_by_name(self, section, name):
+        return [ self.memory[addr] for addr in sorted(self.get_index().names.get((section, name), ())) ]
+
+    # the values of the given type, sorted by address
+    def find_by_type(self, type_name):
+        return [ self.memory[addr] for addr in sorted(self.get_index().types.get(type_name, ())) ]
+
+    # the values at addresses in [start, end), of one section or all of
+    # them, sorted by address
+    def get_range(self, start, end, section=None):
+        return self.memory.get_range(start, end, section)
 
     def add_heap_alloc(self, address, size):
+        self.n_allocator_calls += 1
         self.heap_alloc_sizes[address] = size
+        self.allocations.add(address, size)
+        if self.regions is not None:
+            self.regions.note_allocation(address)
+
+    def free_heap_alloc(self, address):
+        self.n_allocator_calls += 1
+        self.heap_alloc_sizes.pop(address, None)
+        self.allocations.remove(address)
+        if self.heap_graph is not None:
+            self.heap_graph.remove_node(address)
+        self.retire_owner(heap_owner(address))
+
+    # returns (start, size) of the live heap allocation containing address, or None
+    def find_heap_alloc(self, address):
+        if self.regions is not None and self.regions.classify(address) in ("stack", "text", "rodata", "data"):
+            return None
+        return self.allocations.find(address)
     
-    def add_from_stack(self, process, section_name, v):
+    # owner is the stack frame the variable belongs to, see MemoryValue
+    def add_from_stack(self, process, section_name, v, owner=None):
         #print(v.GetName(), v.GetAddress().GetSection().GetName(), v.location)
-        # global variables show up on the stack frame, do not add them to the memory model
-        sn = v.GetAddress().GetSection().GetName()
-        if sn == "__data" or sn == ".data":
-            return
-
         # slightly lame, this discards variables that are in registers
         if not v.location.startswith("0x"):
             return
@@ -194,108 +858,151 @@ class MemoryModel:
         # Store POD stack variables and pointers to the memory model
         # More complicated stack variables (structs, arrays) are handled below
         if v.num_children == 0 or v.TypeIsPointerType():
-            mv = MemoryValue(section_name, int(v.location, 16), v.GetByteSize(), str(v.GetValue()), v.GetName(), str(v.GetType()))
+            mv = MemoryValue(section_name, int(v.location, 16), v.GetByteSize(), str(v.GetValue()), v.GetName(), str(v.GetType()), owner)
             self.add(mv)
 
         # If POD stack variable return now, nothing else to do
         if v.num_children == 0 and not v.TypeIsPointerType():
             return
 
-        # If this is a pointer we need to figure out whether it points to the stack or heap
-        # if its on the heap we recurse to parse the heap data
+        # pointers into the heap are roots of the heap graph, which decodes
+        # the blocks they lead to
         if v.TypeIsPointerType():
-            d = v.Dereference()
-            # very hacky way to determine whether on stack or heap
-            diff = abs(d.GetLoadAddress() - v.GetLoadAddress())
-            if diff > 100000:
-                section_name = "heap"
-            else:
-                # this is a pointer to non-heap data, nothing else to do
-                return
+            if self.heap_graph is not None:
+                self.heap_graph.set_root(owner, section_name, v.GetName(), v.GetValueAsUnsigned(), v.GetType().GetPointeeType())
 
-            # get the size of this heap allocation, we need this to work out 
-            # how many items it points to
-            if d.location is not None and d.location != '':
-                heap_addr = int(d.location, 16)
-                if heap_addr in self.heap_alloc_sizes:
-                    heap_alloc_size = self.heap_alloc_sizes[heap_addr]
-                    element_size = d.GetByteSize()
-                    base_address = d.GetLoadAddress()
-                    num_elems = int(heap_alloc_size / element_size)
-                    if str(d.GetType()) == "char":
-                        # handle heap string
-                        s = ""
-                        for i in range(0, num_elems):
-                            elem = d.CreateValueFromAddress("(none)", base_address, d.GetType())
-                            #print(i, elem, heap_alloc_size)
-                            s += elem.GetValue()[1:-1]
-                            base_address += element_size
-                        mv = MemoryValue(section_name, int(d.location, 16), heap_alloc_size, s, "(none)", str(d.GetType()))
-                        self.add(mv)
-                    else:
-                        # all other datatypes
-                        for i in range(0, num_elems):
-                            elem = d.CreateValueFromAddress("(none)", base_address, d.GetType())
-                            #print(i, num_elems, base_address, elem)
-                            self.add_from_stack(process, section_name, elem)
-                            base_address += element_size
-
-        elif str(v.GetType().GetArrayElementType()) == "char":
-            # special case for character array
-            s = ""
-            for i in range(0, v.num_children):
-                s += (v.GetChildAtIndex(i).GetValue())[1:-1]
-            mv = MemoryValue(section_name, int(v.location, 16), v.GetByteSize(), s, v.GetName(), str(v.GetType()))
-            self.add(mv)
         else:
-            # this is an array or struct
-            name = v.GetName()
-            for i in range(0, v.num_children):
-                child = v.GetChildAtIndex(i)
-
-                # pretty print the name
-                child_name = child.GetName()
-                if child_name[0] == '[' and child_name[-1] == ']':
-                    # array
-                    name = v.GetName() + child.GetName()
-                else:
-                    # assume struct
-                    name = v.GetName() + "." +child.GetName()
-
-                mv = MemoryValue(section_name, int(child.location, 16), child.GetByteSize(), str(child.GetValue()), name, str(child.GetType()))
-                self.add(mv)
-
-    def read_text_section(self, target):
-
-        module = target.module[target.executable.basename]
-
-        for section in module.sections:
-            for sub in section:
-                if sub.GetName() == "__cstring":
-                    a = []
-                    for b in sub.data.uint8:
-                        if b != 0:
-                            a.append(chr(b))
-                        else:
-                            a.append("\\0")
-                    s = ''.join(a).replace("\n", "\\n")
-                    #print("%s\t0x%0.16x\t%s\t%s\t%d" % ("text", sub.addr.GetLoadAddress(target), s, "null", sub.GetByteSize()))
-                    mv = MemoryValue("text", sub.addr.GetLoadAddress(target), sub.GetByteSize(), s, None, None)
+            # arrays (including strings) and structs are decoded in full
+            # from a single read, using the flattened layout of their type
+            address = int(v.location, 16)
+            large = get_large_array(v.GetType())
+            if large is not None:
+                (layout, count) = large
+                data = read_memory(process, address, count * layout.byte_size)
+                if data is not None:
+                    self.add_lazy_range(LazyRange(section_name, address, v.GetName(), str(v.GetType()), layout, count,
+                        data, owner, v.GetName()))
+                    self.add_pointer_roots(owner, section_name, v.GetName(), layout, data, count)
+                return
+
+            layout = get_type_layout(v.GetType())
+            data = read_memory(process, address, layout.byte_size)
+            if data is not None:
+                for (offset, size, value, suffix, type_name) in decode_layout(layout, data):
+                    mv = MemoryValue(section_name, address + offset, size, value, v.GetName() + suffix, type_name, owner)
                     self.add(mv)
+                self.add_pointer_roots(owner, section_name, v.GetName(), layout, data)
 
+    # make the pointers into the heap held by count values of the layout's
+    # type (decoded from data) roots of the heap graph
+    def add_pointer_roots(self, owner, section_name, label, layout, data, count=1):
+        if self.heap_graph is None:
+            return
+        for (offset, suffix, pointer, pointee) in get_pointers(layout, data, count):
+            self.heap_graph.set_root(owner, section_name, label + suffix, pointer, pointee)
+
+    # add the string sections of the binary, as (name, file address, size, contents)
+    def add_text_sections(self, target, strings):
+        for (name, file_addr, size, s) in strings:
+            addr = target.ResolveFileAddress(file_addr).GetLoadAddress(target)
+            mv = MemoryValue("text", addr, size, s, None, None)
+            self.add(mv)
+
+    # the values of each section, sorted by address
     def get_memory_sections(self):
-        # partition by section
         sections = dict()
-        sections["heap"] = list()
-        for addr, o in self.memory.items():
-            if o.section not in sections:
-                sections[o.section] = list()
-            sections[o.section].append(o) 
+        for v in self.memory.values():
+            sections.setdefault(v.section, list()).append(v)
+        sections.setdefault("heap", list())
         return sections
 
-    def write_tsv(self, fp):
+    def get_section_rows(self):
+        ranges = dict()
+        for r in self.lazy_ranges.values():
+            ranges.setdefault(r.section, list()).append(r)
+        rows = dict([ (name, SectionRows(addresses, self.memory, ranges.get(name, ())))
+            for (name, addresses) in self.memory.get_section_addresses().items() ])
+        rows.setdefault("heap", SectionRows([], {}))
+        return rows
+
+    # expand is a list of (lazy range, first element, last element + 1)
+    # whose elements are written after the summary row of the range
+    def write_tsv(self, fp, expand=()):
         # header
         fp.write("\t".join( [ "section", "address", "size", "value", "label", "type\n" ] ))
 
-        for addr in sorted(self.memory.keys()):
-            fp.write("%s\n" % self.memory[addr])
+        windows = dict()
+        for (r, start, stop) in expand:
+            windows.setdefault(r.address, list()).append((start, stop))
+
+        for v in self.memory.values():
+            fp.write("%s\n" % v)
+            r = self.lazy_ranges.get(v.address)
+            for (start, stop) in windows.get(v.address, []) if r is not None else []:
+                for v in r.get_elements(start, stop):
+                    fp.write("%s\n" % v)
+
+# Output chunks are written as ">" rows with the stream as the section,
+# the step that printed them and the escaped text as the value
+def format_output_row(step, stream, text):
+    value = text.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+    return "%d\t>\t%s\t\t%d\t%s\t\t\n" % (step, stream, len(text), value)
+
+# The heap graph (see heap_graph.py) is written as "^" rows at the steps
+# where its roots or edges changed: a root has the section and label of
+# the pointer and the heap block it points to as the value, an edge has
+# the address of the pointer in the heap
+def format_graph_row(step, kind, section, address, target, label):
+    address = "" if address is None else "0x%0.16x" % address
+    return "%d\t^\t%s\t%s\t\t0x%0.16x\t%s\t%s\n" % (step, section.replace(" ", "-"), address, target, label, kind)
+
+def get_graph_rows(graph):
+    rows = [ ("root", section, None, target, label) for (section, label, target) in graph["roots"] ]
+    rows += [ ("edge", "heap", address, target, label) for (source, address, label, target) in graph["edges"] ]
+    return rows
+
+# Streams the memory model at several steps of execution. The first
+# snapshot is written in full, after that only rows that were added (+),
+# changed (~) or removed (-) since the previous snapshot are written.
+# Large arrays are written element by element, not as their summary row.
+class TsvDeltaWriter:
+    def __init__(self, fp):
+        self.fp = fp
+        self.prev = None
+        self.prev_graph = None
+        self.output_seq = 0
+        self.fp.write("\t".join( [ "step", "op", "section", "address", "size", "value", "label", "type\n" ] ))
+
+    def write_row(self, step, op, row):
+        self.fp.write("%d\t%s\t%s\n" % (step, op, MemoryValue.from_tuple(row)))
+
+    def write_output(self, output):
+        for (seq, step, stream, text) in output.get_chunks(self.output_seq):
+            self.fp.write(format_output_row(step, stream, text))
+        self.output_seq = output.next_seq
+
+    def write_graph(self, step, graph):
+        rows = get_graph_rows(graph)
+        if rows != self.prev_graph:
+            for row in rows:
+                self.fp.write(format_graph_row(step, *row))
+        self.prev_graph = rows
+
+    def write_step(self, step, memory_model, output=None, graph=None):
+        if output is not None:
+            self.write_output(output)
+        if graph is not None:
+            self.write_graph(step, graph)
+        if self.prev is None:
+            for row in memory_model.snapshot(expand_lazy=True).values():
+                self.write_row(step, "=", row)
+        else:
+            added, changed, removed = memory_model.diff(self.prev)
+            out = [ ("+", r) for r in added ] + [ ("~", r) for r in changed ] + \
+                  [ ("-", r) for r in removed ]
+            for op, r in sorted(out, key=lambda x: x[1][1]):
+                self.write_row(step, op, r)
+        self.prev = memory_model.copy()
+
+    def close(self):
+        self.fp.flush()
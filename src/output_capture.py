@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# Capture of the target's stdout and stderr. Each stream is connected to
+# its own pty (so the program's stdio stays line buffered as it would be
+# in a terminal) which a background thread drains into a bounded ring
+# buffer. Every chunk of output is tagged with the step that printed it.
+#----------------------------------------------------------------------
+import collections
+import os
+import select
+import threading
+
+# The most recent output of the program, as (seq, step, stream, text)
+# chunks. seq numbers every chunk ever appended so that readers can ask
+# for the chunks they have not seen yet. The oldest chunks are dropped
+# once the buffer holds more than max_chars characters.
+class OutputRing:
+    def __init__(self, max_chars=64 * 1024):
+        self.max_chars = max_chars
+        self.chunks = collections.deque()
+        self.n_chars = 0
+        self.next_seq = 0
+        self.n_dropped = 0
+        self.lock = threading.Lock()
+
+    def append(self, step, stream, text, seq=None):
+        with self.lock:
+            if seq is None:
+                seq = self.next_seq
+            self.chunks.append((seq, step, stream, text))
+            self.next_seq = seq + 1
+            self.n_chars += len(text)
+            while self.n_chars > self.max_chars and len(self.chunks) > 1:
+                (_, _, _, old) = self.chunks.popleft()
+                self.n_chars -= len(old)
+                self.n_dropped += 1
+
+    # the chunks numbered seq or later that are still in the buffer
+    def get_chunks(self, seq=0):
+        with self.lock:
+            return [ c for c in self.chunks if c[0] >= seq ]
+
+    # replace the contents with chunks read from a trace, they keep their
+    # sequence numbers
+    def load(self, chunks):
+        with self.lock:
+            self.chunks.clear()
+            self.n_chars = 0
+            self.next_seq = 0
+        self.extend(chunks)
+
+    def extend(self, chunks):
+        for chunk in chunks:
+            self.append(chunk[1], chunk[2], chunk[3], chunk[0])
+
+    # the output split into lines, as (step, stream, text). A line is tagged
+    # with the step that started it, lines of stdout and stderr are kept
+    # apart even when their chunks interleave
+    def get_lines(self):
+        lines = list()
+        open_lines = dict()
+        for (_, step, stream, text) in self.get_chunks():
+            parts = text.split("\n")
+            for (i, part) in enumerate(parts):
+                terminated = i < len(parts) - 1
+                if stream in open_lines:
+                    line = open_lines.pop(stream)
+                    line[2] += part
+                elif part != "" or terminated:
+                    line = [ step, stream, part ]
+                    lines.append(line)
+                else:
+                    continue
+                if not terminated:
+                    open_lines[stream] = line
+        return [ tuple(l) for l in lines ]
+
+# Connects stdout and stderr of the target to ptys and copies everything
+# the program writes into an OutputRing. The paths of the pty slaves are
+# passed to the launch, chunks are tagged with self.step. The reader
+# thread keeps the ptys drained while the program runs so that a chatty
+# program never blocks on a full buffer; sync() picks up whatever the
+# thread has not read yet once the program stopped.
+class PtyCapture(threading.Thread):
+    def __init__(self, output):
+        import tty
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.output = output
+        self.step = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+        self.masters = dict()
+        self.slaves = list()
+        self.paths = dict()
+        for stream in ("stdout", "stderr"):
+            (master, slave) = os.openpty()
+            # no newline translation or echo
+            tty.setraw(slave)
+            os.set_blocking(master, False)
+            self.masters[master] = stream
+            self.slaves.append(slave)
+            self.paths[stream] = os.ttyname(slave)
+
+    # read whatever is waiting on the ptys, returns true if there was any
+    def drain(self, timeout):
+        (ready, _, _) = select.select(list(self.masters), [], [], timeout)
+        n_read = 0
+        with self.lock:
+            for fd in ready:
+                try:
+                    data = os.read(fd, 65536)
+                except OSError:
+                    continue
+                if len(data) > 0:
+                    self.output.append(self.step, self.masters[fd], data.decode("utf-8", "replace"))
+                    n_read += 1
+        return n_read > 0
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.drain(0.05)
+
+    # called while the program is stopped: tag everything it printed so far
+    # with the current step, and what it prints from now on with next_step
+    def sync(self, next_step):
+        while self.drain(0):
+            pass
+        with self.lock:
+            self.step = next_step
+
+    def close(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        for fd in list(self.masters) + self.slaves:
+            os.close(fd)
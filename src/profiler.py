@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# Opt-in instrumentation, enabled with --profile. Nothing is patched
+# unless a Profiler is created, so there is no cost when it is disabled.
+#
+# Phases are timed by wrapping the methods that implement them and lldb
+# SB API calls are counted by wrapping the SB methods on the hot paths.
+# Time and calls are accumulated into one record per step, a step record
+# is closed when the next step, seek or fast-forward command starts. Each
+# phase also gets a cumulative histogram of the duration of its calls.
+# Phases nest (advance includes allocator, frames includes decode), a
+# recursive method is only timed at its outermost call.
+#----------------------------------------------------------------------
+import json
+import threading
+import time
+
+# SB API methods whose calls are counted, by class
+sb_api_methods = {
+    "SBThread": [ "StepInto", "StepOut", "StepOver", "StepInstruction" ],
+    "SBProcess": [ "Continue", "ReadMemory", "GetSTDOUT" ],
+    "SBFrame": [ "GetVariables", "FindVariable", "GetCFA", "GetSP" ],
+    "SBValue": [ "GetChildAtIndex", "CreateValueFromAddress", "Dereference", "GetValue", "GetValueAsUnsigned" ],
+    "SBTarget": [ "BreakpointCreateByLocation", "BreakpointDelete", "WatchAddress", "ResolveFileAddress" ],
+}
+
+# upper bounds of the histogram buckets in milliseconds
+histogram_bounds_ms = [ 0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000, float("inf") ]
+
+class Profiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = threading.local()
+        self.steps = list()
+        self.current = self.new_record()
+        self.phase_times = dict()
+        self.phase_calls = dict()
+        self.sb_calls = dict()
+        self.histograms = dict()
+        self.program = None
+
+    def new_record(self):
+        return { "step": None, "phases_ms": dict(), "sb_calls": dict() }
+
+    def add_time(self, phase, seconds):
+        ms = seconds * 1000
+        with self.lock:
+            self.phase_times[phase] = self.phase_times.get(phase, 0.0) + ms
+            self.phase_calls[phase] = self.phase_calls.get(phase, 0) + 1
+            phases = self.current["phases_ms"]
+            phases[phase] = phases.get(phase, 0.0) + ms
+            histogram = self.histograms.setdefault(phase, [ 0 ] * len(histogram_bounds_ms))
+            for (i, bound) in enumerate(histogram_bounds_ms):
+                if ms <= bound:
+                    histogram[i] += 1
+
+    def count_call(self, name):
+        with self.lock:
+            self.sb_calls[name] = self.sb_calls.get(name, 0) + 1
+            calls = self.current["sb_calls"]
+            calls[name] = calls.get(name, 0) + 1
+
+    # close the record of the step that just finished, if anything happened
+    def end_step(self):
+        with self.lock:
+            if len(self.current["phases_ms"]) == 0 and len(self.current["sb_calls"]) == 0:
+                return
+            if self.program is not None:
+                self.current["step"] = self.program.step_count
+            self.steps.append(self.current)
+            self.current = self.new_record()
+
+    # wrap owner.name (a method of a class, or a function of a module) so
+    # that the time spent in it is added to phase
+    def time_calls(self, owner, name, phase):
+        original = getattr(owner, name)
+        profiler = self
+        def timed(*args, **kwargs):
+            depth = getattr(profiler.active, phase, 0)
+            if depth > 0:
+                return original(*args, **kwargs)
+            setattr(profiler.active, phase, 1)
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                profiler.add_time(phase, time.perf_counter() - start)
+                setattr(profiler.active, phase, 0)
+        setattr(owner, name, timed)
+
+    # wrap owner.name so that a new step record is started before it runs
+    def start_steps_at(self, owner, name):
+        original = getattr(owner, name)
+        profiler = self
+        def step(*args, **kwargs):
+            profiler.end_step()
+            return original(*args, **kwargs)
+        setattr(owner, name, step)
+
+    def count_calls(self, owner, name, key):
+        original = getattr(owner, name)
+        profiler = self
+        def counted(*args, **kwargs):
+            profiler.count_call(key)
+            return original(*args, **kwargs)
+        setattr(owner, name, counted)
+
+    # instrument the classes of a ProgramState or ReplayState
+    def instrument_program(self, program):
+        self.program = program
+        cls = type(program)
+        for name in [ "step", "seek", "run_to_line", "run_until_changed", "run_to_allocation" ]:
+            if hasattr(cls, name):
+                self.start_steps_at(cls, name)
+
+        if not hasattr(program, "process"):
+            self.time_calls(cls, "seek", "seek")
+            return
+
+        import lldb
+        import program_state
+        import stepping
+        from memory_model import MemoryModel
+
+        self.time_calls(cls, "advance", "advance")
+        self.time_calls(cls, "refresh", "refresh")
+        self.time_calls(stepping, "handle_allocator_stop", "allocator")
+        self.time_calls(program_state, "handle_allocator_stop", "allocator")
+        if program.alloc_log is not None:
+            self.time_calls(type(program.alloc_log), "drain", "allocator")
+        self.time_calls(type(program.frame_cache), "refresh", "frames")
+        self.time_calls(type(program.globals), "refresh", "globals")
+        self.time_calls(type(program.heap_graph), "refresh", "heap")
+        self.time_calls(type(program.capture), "sync", "output")
+        self.time_calls(MemoryModel, "add_from_stack", "decode")
+
+        for (class_name, methods) in sb_api_methods.items():
+            sb_class = getattr(lldb, class_name)
+            for name in methods:
+                if hasattr(sb_class, name):
+                    self.count_calls(sb_class, name, name)
+
+    def get_report(self):
+        self.end_step()
+        with self.lock:
+            report = dict()
+            if self.program is not None and hasattr(self.program, "startup_seconds"):
+                report["startup_ms"] = self.program.startup_seconds * 1000
+            report["phases"] = dict([ (p, { "calls": self.phase_calls[p], "total_ms": self.phase_times[p] })
+                for p in sorted(self.phase_times) ])
+            report["sb_calls"] = dict(sorted(self.sb_calls.items()))
+            report["histogram_bounds_ms"] = [ b if b != float("inf") else None for b in histogram_bounds_ms ]
+            report["histograms"] = dict(self.histograms)
+            report["steps"] = list(self.steps)
+            return report
+
+    def write_report(self, fp):
+        json.dump(self.get_report(), fp, indent=1)
+        fp.write("\n")
+
+    # a one line summary of the last finished step
+    def get_status(self):
+        with self.lock:
+            if len(self.steps) == 0:
+                return "profile: no steps yet"
+            record = self.steps[-1]
+        phases = sorted(record["phases_ms"].items(), key=lambda x: -x[1])
+        calls = sorted(record["sb_calls"].items(), key=lambda x: -x[1])
+        return "profile step %s: %s | %s" % (record["step"],
+            " ".join([ "%s %.1fms" % p for p in phases ]),
+            " ".join([ "%s %d" % c for c in calls ]))
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+
+import lldb
+import time
+from alloc_shim import create_alloc_log, shim_enabled
+from code_index import CodeIndex
+from frame_cache import FrameCache
+from globals_tracker import GlobalsTracker
+from heap_graph import HeapGraph
+from memory_model import *
+from output_capture import *
+from regions import RegionIndex
+from static_info import *
+from stepping import *
+from utils import *
+
+# raised when the program can't be launched
+class LaunchError(Exception):
+    pass
+
+class ProgramState:
+    # a debugger and a target already created for program_name can be
+    # passed in to save their startup cost (see server.DebuggerPool).
+    # alloc_shim tracks allocations with the preloaded library in
+    # alloc_shim.py rather than breakpoints, it defaults to TPDB_ALLOC_SHIM
+    def __init__(self, program_name, stdin_path=None, engine="breakpoint", debugger=None, target=None,
+            alloc_shim=None):
+
+        start_time = time.time()
+
+        # initialize debugger, load the target
+        self.debugger = debugger if debugger is not None else lldb.SBDebugger.Create()
+        self.process = None
+        self.capture = None
+        self.alloc_log = None
+        # a launch that fails part way releases what it holds, including a
+        # debugger that came from a pool
+        try:
+            self.start(program_name, stdin_path, engine, target, alloc_shim)
+        except BaseException:
+            self.close()
+            raise
+        self.startup_seconds = time.time() - start_time
+
+    def start(self, program_name, stdin_path, engine, target, alloc_shim):
+        self.debugger.SetAsync(False)
+        self.command_interpreter = self.debugger.GetCommandInterpreter()
+        self.target = target if target is not None else self.debugger.CreateTarget(program_name)
+        if not self.target.IsValid():
+            raise LaunchError("could not create a target for %s" % program_name)
+
+        # put a breakpoint on main before we launch so our initial state is there
+        self.target.BreakpointCreateByName("main")
+        
+        self.arch = self.target.triple.split("-")[0]
+
+        # stdout and stderr are drained into a ring buffer by a reader thread
+        self.output = OutputRing()
+        self.capture = PtyCapture(self.output)
+
+        # the ring allocator calls are logged to, or None to use breakpoints
+        if alloc_shim is None:
+            alloc_shim = shim_enabled()
+        self.alloc_log = create_alloc_log() if alloc_shim else None
+
+        # launch the process, it will run until the breakpoint is hit
+        launch_info = lldb.SBLaunchInfo(None)
+        if stdin_path is not None:
+            launch_info.AddOpenFileAction(0, stdin_path, True, False)
+        launch_info.AddOpenFileAction(1, self.capture.paths["stdout"], False, True)
+        launch_info.AddOpenFileAction(2, self.capture.paths["stderr"], False, True)
+        if self.alloc_log is not None:
+            launch_info.SetEnvironmentEntries(self.alloc_log.get_environment(), True)
+        self.capture.start()
+        error = lldb.SBError()
+        self.process = self.target.Launch(launch_info, error)
+        if not error.Success():
+            raise LaunchError(str(error))
+
+        if self.alloc_log is not None and not self.alloc_log.attach(self.target, self.process):
+            self.alloc_log.close()
+            self.alloc_log = None
+
+        # put breakpoints on malloc and free, they are only used when
+        # allocations aren't logged by the preloaded library
+        self.malloc_bp = self.target.BreakpointCreateByName("malloc")
+        self.free_bp = self.target.BreakpointCreateByName("free")
+        self.malloc_bp.SetEnabled(self.alloc_log is None)
+        self.free_bp.SetEnabled(self.alloc_log is None)
+        self.stepper = steppers[engine](self)
+
+        sf = self.process.GetSelectedThread().GetSelectedFrame()
+        self.line_entry = sf.GetLineEntry()
+        self.function_name = sf.GetFunctionName()
+        self.main_filename = sf.GetLineEntry().GetFileSpec().GetFilename()
+        self.code = dict()
+        self.step_count = 0
+
+        # set by interrupt() to end the running step or fast-forward early
+        self.interrupted = False
+        self.capture.sync(1)
+        self.memory_model = MemoryModel()
+        self.memory_model.regions = RegionIndex(self.process)
+        self.heap_graph = HeapGraph(self.process, self.memory_model)
+        self.memory_model.heap_graph = self.heap_graph
+        self.frame_cache = FrameCache(self.process, self.memory_model)
+        
+        # get the text section and other static data, cached between runs
+        self.static_info = load_static_info(self.target)
+        self.memory_model.add_text_sections(self.target, self.static_info["strings"])
+        # the user's source files and code ranges, to tell user code apart
+        # from libc in programs made of several files
+        self.code_index = CodeIndex(self.static_info["line_table"], self.get_slide())
+        self.globals = GlobalsTracker(self.process, self.target, self.memory_model, self.static_info["globals"])
+        self.frame_cache.globals = self.globals
+
+    def get_filename(self):
+        return self.line_entry.GetFileSpec().GetFilename()
+
+    def get_source_path(self):
+        d = self.line_entry.GetFileSpec().GetDirectory()
+        f = self.line_entry.GetFileSpec().GetFilename()
+        
+        if d is None or f is None:
+            return None
+        return d + "/" + f
+
+    def get_code(self):
+        p = self.get_source_path()
+        if p is None:
+            return []
+
+        if p not in self.code:
+            self.code[p] = get_source(self.static_info, p)
+        return self.code[p]    
+
+    def get_line_number(self):
+        return self.line_entry.GetLine()
+
+    def get_stack_frame_name(self, frame):
+        fn = frame.GetDisplayFunctionName()
+        if fn == None:
+            fn = "(none)"
+        return "stack" + " " + fn
+
+    def get_active_stack_frames(self):
+        thread = self.process.GetSelectedThread()
+        out = list()
+        for f in thread.frames:
+            out.append(self.get_stack_frame_name(f))
+        return out
+
+    def step(self, n_steps=1):
+        for _ in range(0, n_steps):
+
+            # advance the program exactly one execution step
+            self.advance()
+            self.refresh()
+            if self.interrupted:
+                break
+
+    # update the state variables and memory model after the program moved
+    def refresh(self):
+        self.step_count += 1
+
+        # allocations logged by the preloaded library since the last step
+        if self.alloc_log is not None:
+            self.alloc_log.drain(self.memory_model)
+
+        # update state variables
+        thread = self.process.GetSelectedThread()
+        self.function_name = thread.GetSelectedFrame().GetFunctionName()
+        self.line_entry = thread.GetSelectedFrame().GetLineEntry()
+        
+        if self.process.state != lldb.eStateExited:
+            frames = list()
+            for frame in thread.frames:
+                # in x86-64 the first stack frame is start before handing to main, skip it
+                sf_name = self.get_stack_frame_name(frame)
+                if "__libc_start" in sf_name:
+                    continue
+                frames.append((frame, sf_name))
+            self.frame_cache.refresh(frames)
+            self.globals.refresh()
+            self.heap_graph.refresh()
+
+        # output printed up to here belongs to this step
+        self.capture.sync(self.step_count + 1)
+
+    # Fast-forward commands. These let the program run at full speed until
+    # the condition is met and then rebuild the memory model once. Each
+    # counts as a single step. They return false if the program exited first.
+
+    # run until the given line of the current source file is reached
+    def run_to_line(self, line):
+        filename = self.get_filename() if self.is_user_code(self.process.GetSelectedThread()) else self.main_filename
+        bp = self.target.BreakpointCreateByLocation(filename, line)
+        if bp.GetNumLocations() == 0:
+            self.target.BreakpointDelete(bp.GetID())
+            return False
+
+        reached = self.continue_until(lambda thread: get_breakpoint_hit(thread) == bp.GetID())
+        self.target.BreakpointDelete(bp.GetID())
+        self.refresh()
+        return reached
+
+    # run until the named variable of the current frame is written to, or the
+    # frame returns. This uses a hardware watchpoint so the variable must fit
+    # in a machine word
+    def run_until_changed(self, name):
+        thread = self.process.GetSelectedThread()
+        frame = thread.GetSelectedFrame()
+        v = frame.FindVariable(name)
+        if not v.IsValid() or not v.location.startswith("0x"):
+            return False
+
+        error = lldb.SBError()
+        wp = self.target.WatchAddress(v.GetLoadAddress(), v.GetByteSize(), False, True, error)
+        if not error.Success():
+            return False
+
+        # stop when the variable goes out of scope
+        ret_bp = None
+        if thread.GetNumFrames() > 1:
+            ret_bp = self.target.BreakpointCreateByAddress(thread.GetFrameAtIndex(1).GetPC())
+            ret_bp.SetThreadID(thread.GetThreadID())
+
+        changed = self.continue_until(lambda thread: thread.GetStopReason() == lldb.eStopReasonWatchpoint or \
+            (ret_bp is not None and get_breakpoint_hit(thread) == ret_bp.GetID()))
+        changed = changed and thread.GetStopReason() == lldb.eStopReasonWatchpoint
+        self.target.DeleteWatchpoint(wp.GetID())
+        if ret_bp is not None:
+            self.target.BreakpointDelete(ret_bp.GetID())
+
+        # the write may have happened inside a library function (e.g. scanf)
+        self.return_to_user_code()
+        self.refresh()
+        return changed
+
+    # run until the next call to malloc or free (or calloc and realloc when
+    # the library logs them)
+    def run_to_allocation(self):
+        if self.alloc_log is not None:
+            bp = self.alloc_log.logged_bp
+            bp.SetEnabled(True)
+            reached = self.continue_until(lambda thread: get_breakpoint_hit(thread) == bp.GetID())
+            bp.SetEnabled(False)
+            if reached:
+                self.return_to_user_code()
+            self.refresh()
+            return reached
+
+        reached = self.continue_until(lambda thread: get_breakpoint_hit(thread) in (self.malloc_bp.GetID(), self.free_bp.GetID()),
+            record_allocations=False)
+        if reached:
+            handle_allocator_stop(self, self.process.GetSelectedThread())
+            self.return_to_user_code()
+        self.refresh()
+        return reached
+
+    # continue the process until is_done(thread) is true, recording allocations
+    # at the malloc/free breakpoints along the way
+    def continue_until(self, is_done, record_allocations=True):
+        thread = self.process.GetSelectedThread()
+        while True:
+            self.process.Continue()
+            if self.has_exited() or self.interrupted:
+                return False
+            if is_done(thread):
+                return True
+            if record_allocations:
+                handle_allocator_stop(self, thread)
+
+    def return_to_user_code(self):
+        thread = self.process.GetSelectedThread()
+        while not self.has_exited() and not self.interrupted and not self.is_user_code(thread):
+            thread.StepOut()
+    
+    # advance the program by a single step, taking care
+    # of various corner cases (handling malloc, etc)
+    def advance(self):
+        self.stepper.advance()
+
+    # whether the thread is in code built from the user's sources
+    def is_user_code(self, thread):
+        return self.is_user_frame(thread.GetSelectedFrame())
+
+    def is_user_frame(self, frame):
+        if len(self.code_index) == 0:
+            # no line tables, fall back to the file main is in
+            return frame.GetLineEntry().GetFileSpec().GetFilename() == self.main_filename
+        return self.code_index.is_user_pc(frame.GetPC())
+
+    # the difference between load and file addresses of the executable
+    def get_slide(self):
+        line_table = self.static_info["line_table"]
+        if len(line_table) == 0:
+            return 0
+        file_addr = line_table[0][2]
+        return self.target.ResolveFileAddress(file_addr).GetLoadAddress(self.target) - file_addr
+
+    def get_filename_of_current_line(self, thread):
+        return thread.GetSelectedFrame().GetLineEntry().GetFileSpec().GetFilename()
+
+    def get_heap_graph(self):
+        return self.heap_graph.export()
+
+    def has_exited(self):
+        return self.process.state == lldb.eStateExited
+
+    # called from another thread to stop a step or fast-forward that runs
+    # too long, e.g. an infinite loop or a read from stdin. The program
+    # stays wherever it was interrupted and the memory model is refreshed
+    # there. The flag is cleared by the caller before the next command
+    def interrupt(self):
+        self.interrupted = True
+        if self.process.GetState() in (lldb.eStateRunning, lldb.eStateStepping):
+            self.process.SendAsyncInterrupt()
+
+    # kill the program and release the debugger
+    def close(self):
+        if self.process is not None and self.process.IsValid() and not self.has_exited():
+            self.process.Kill()
+        if self.capture is not None:
+            self.capture.close()
+        if self.alloc_log is not None:
+            self.alloc_log.close()
+        lldb.SBDebugger.Destroy(self.debugger)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# Decode values from raw bytes read out of the target, producing the same
+# strings lldb's SBValue.GetValue() would. Only little endian targets
+# (x86-64 and arm64) are supported.
+#----------------------------------------------------------------------
+import struct
+
+# struct format characters for C scalar types, keyed by (canonical type name, size)
+scalar_formats = {
+    ("char", 1): "b",
+    ("signed char", 1): "b",
+    ("unsigned char", 1): "B",
+    ("_Bool", 1): "?",
+    ("bool", 1): "?",
+    ("short", 2): "h",
+    ("unsigned short", 2): "H",
+    ("int", 4): "i",
+    ("unsigned int", 4): "I",
+    ("long", 4): "i",
+    ("unsigned long", 4): "I",
+    ("long", 8): "q",
+    ("unsigned long", 8): "Q",
+    ("long long", 8): "q",
+    ("unsigned long long", 8): "Q",
+    ("float", 4): "f",
+    ("double", 8): "d",
+}
+
+char_types = set([ "char", "signed char", "unsigned char" ])
+
+char_escapes = {
+    0: "\\0",
+    7: "\\a",
+    8: "\\b",
+    9: "\\t",
+    10: "\\n",
+    11: "\\v",
+    12: "\\f",
+    13: "\\r",
+    27: "\\e",
+    34: "\\\"",
+    39: "\\'",
+    92: "\\\\",
+}
+
+# the format character used to decode a scalar type, or None if
+# the type can't be decoded from raw bytes
+def get_scalar_format(type_name, byte_size):
+    return scalar_formats.get((type_name, byte_size))
+
+# a single character as lldb displays it between quotes
+def char_to_str(b):
+    if b in char_escapes:
+        return char_escapes[b]
+    if 32 <= b < 127:
+        return chr(b)
+    return "\\x%0.2x" % b
+
+def decode_c_string(data):
+    return "".join([ char_to_str(b) for b in bytearray(data) ])
+
+def format_scalar(type_name, fmt, value):
+    if type_name in char_types:
+        return "'" + char_to_str(value & 0xff) + "'"
+    if fmt == "?":
+        return "true" if value else "false"
+    if fmt == "f":
+        return "%.9g" % value
+    if fmt == "d":
+        return "%.17g" % value
+    return str(value)
+
+# decode every element of an array of scalars, returning the formatted values
+def decode_scalars(data, type_name, byte_size):
+    fmt = get_scalar_format(type_name, byte_size)
+    n = len(data) // byte_size
+    values = struct.unpack("<%d%s" % (n, fmt), data[0:n * byte_size])
+    return [ format_scalar(type_name, fmt, x) for x in values ]
+
+# decode an array of pointers, formatted as lldb displays addresses
+def decode_pointers(data, byte_size):
+    fmt = "Q" if byte_size == 8 else "I"
+    n = len(data) // byte_size
+    values = struct.unpack("<%d%s" % (n, fmt), data[0:n * byte_size])
+    return [ "0x%0.*x" % (byte_size * 2, x) for x in values ]
@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# Run a program once under lldb and record every step to a trace file
+# that tpdb.py and meminspect.py can replay without lldb
+#----------------------------------------------------------------------
+from import_lldb import *
+
+import argparse
+import sys
+
+from program_state import LaunchError, ProgramState
+from tracefile import record_trace
+
+parser = argparse.ArgumentParser(description="record the execution of a program to a trace file")
+parser.add_argument("program")
+parser.add_argument("trace")
+parser.add_argument("--max-steps", type=int, default=None, help="stop recording after this many steps")
+parser.add_argument("--keyframe-interval", type=int, default=50, help="write a full memory snapshot every N steps")
+args = parser.parse_args()
+
+try:
+    program = ProgramState(args.program)
+except LaunchError as e:
+    print(e)
+    sys.exit(1)
+n = record_trace(program, args.trace, args.max_steps, args.keyframe_interval)
+sys.stderr.write("recorded %d steps to %s\n" % (n, args.trace))
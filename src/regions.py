@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# Indexes to answer "what contains address X" in O(log n): the memory
+# regions mapped by the process (stack, heap, data, text) and the live
+# heap allocations.
+#----------------------------------------------------------------------
+import bisect
+
+# Sorted, non-overlapping [start, start + size) intervals, one per live
+# heap allocation. Updated incrementally on malloc and free.
+class AllocationIndex:
+    def __init__(self):
+        self.starts = list()
+        self.sizes = dict()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, address, size):
+        if address not in self.sizes:
+            bisect.insort(self.starts, address)
+        self.sizes[address] = size
+
+    def remove(self, address):
+        if address not in self.sizes:
+            return
+        del self.sizes[address]
+        i = bisect.bisect_left(self.starts, address)
+        del self.starts[i]
+
+    # returns (start, size) of the allocation containing address, or None
+    def find(self, address):
+        i = bisect.bisect_right(self.starts, address) - 1
+        if i < 0:
+            return None
+        start = self.starts[i]
+        size = self.sizes[start]
+        # zero sized allocations still own their start address
+        if address < start + max(size, 1):
+            return (start, size)
+        return None
+
+class MemoryRegion:
+    def __init__(self, start, end, kind, name):
+        self.start = start
+        self.end = end
+        self.kind = kind
+        self.name = name
+
+# The memory map of the process, built from process.GetMemoryRegions().
+# Each region is classified as stack, heap, text, rodata, data or mmap
+# (anonymous mappings, which also hold large malloc'd blocks). The map is
+# reloaded lazily once an allocation lands outside of every known region.
+class RegionIndex:
+    def __init__(self, process):
+        self.process = process
+        self.starts = list()
+        self.regions = list()
+        self.stale = True
+
+    def load(self):
+        # imported here so that the rest of the module is usable without lldb
+        import lldb
+
+        sp = self.process.GetSelectedThread().GetFrameAtIndex(0).GetSP()
+        region_list = self.process.GetMemoryRegions()
+        info = lldb.SBMemoryRegionInfo()
+
+        regions = list()
+        for i in range(0, region_list.GetSize()):
+            if not region_list.GetMemoryRegionAtIndex(i, info) or not info.IsMapped():
+                continue
+            start = info.GetRegionBase()
+            end = info.GetRegionEnd()
+            name = info.GetName()
+
+            if name == "[stack]" or start <= sp < end:
+                kind = "stack"
+            elif name == "[heap]":
+                kind = "heap"
+            elif info.IsExecutable():
+                kind = "text"
+            elif name is not None and name != "" and not name.startswith("["):
+                kind = "data" if info.IsWritable() else "rodata"
+            else:
+                kind = "mmap"
+            regions.append(MemoryRegion(start, end, kind, name))
+
+        regions.sort(key=lambda r: r.start)
+        self.regions = regions
+        self.starts = [ r.start for r in regions ]
+        self.stale = False
+
+    # the memory map can change whenever the program allocates memory
+    def note_allocation(self, address):
+        if not self.stale and self.find(address) is None:
+            self.stale = True
+
+    def find(self, address):
+        if self.stale:
+            self.load()
+        i = bisect.bisect_right(self.starts, address) - 1
+        if i >= 0 and address < self.regions[i].end:
+            return self.regions[i]
+        return None
+
+    # the kind of region address falls in, or None if it is not mapped
+    def classify(self, address):
+        r = self.find(address)
+        return None if r is None else r.kind
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# A long running server that hosts many debugging sessions for a front
+# end, e.g. one per student in a classroom. Clients talk JSON-RPC 2.0 over
+# a Unix or TCP socket, one JSON object per line:
+#
+#   {"jsonrpc": "2.0", "id": 1, "method": "launch", "params": {"program": "example/demo"}}
+#   {"jsonrpc": "2.0", "id": 1, "result": {"session": "3f2a...", ...}}
+#
+# Methods (every one but launch and status takes a "session" parameter):
+#   launch(program, stdin=None)    start a session, returns its state
+#   step(n=1)                      step n lines, at most --max-steps
+#   run_to(command, arg=None)      fast-forward: line, change or alloc
+#   snapshot()                     the state, every row of the memory model
+#                                  and the heap graph
+#   diff()                         the rows added, changed and removed since
+#                                  the last snapshot or diff of the session
+#   stdout(since=0)                output chunks numbered since or later
+#   close()                        end the session
+#   status()                       counts of sessions and warm debuggers
+#
+# Creating a debugger and loading a target take a large part of the time
+# to open a session, so a pool keeps debuggers ready and targets loaded
+# for the binaries given with --preload. Sessions idle for longer than
+# --idle-timeout are closed, at most --max-sessions are open and at most
+# --max-active run an lldb command at the same time. A step or run_to that
+# takes longer than --request-timeout (an infinite loop, a read from stdin)
+# is interrupted and returns the state where the program stopped, with
+# "interrupted" set.
+#----------------------------------------------------------------------
+from import_lldb import *
+import lldb
+
+import argparse
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+import uuid
+
+from memory_model import *
+from program_state import LaunchError, ProgramState
+from tracefile import ReplayState, is_trace_file
+
+# JSON-RPC error codes
+parse_error = -32700
+invalid_request = -32600
+method_not_found = -32601
+invalid_params = -32602
+server_error = -32000
+
+class RpcError(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+# Debuggers created ahead of time, and for each preloaded binary targets
+# already loaded into a debugger of their own. A background thread tops
+# the pool up after debuggers are taken.
+class DebuggerPool:
+    def __init__(self, size=4, preload=(), targets_per_binary=2):
+        self.size = size
+        self.targets_per_binary = targets_per_binary
+        self.preload = [ os.path.realpath(p) for p in preload ]
+        self.debuggers = list()
+        self.targets = dict([ (p, list()) for p in self.preload ])
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.refill)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_wanted(self):
+        if len(self.debuggers) < self.size:
+            return (None, None)
+        for path in self.preload:
+            if len(self.targets[path]) < self.targets_per_binary:
+                return (path, None)
+        return None
+
+    def refill(self):
+        while True:
+            with self.cond:
+                while not self.stopped and self.get_wanted() is None:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                (path, _) = self.get_wanted()
+
+            # created outside of the lock, this is the slow part
+            debugger = lldb.SBDebugger.Create()
+            target = debugger.CreateTarget(path) if path is not None else None
+            with self.cond:
+                if path is None:
+                    self.debuggers.append(debugger)
+                else:
+                    self.targets[path].append((debugger, target))
+
+    # returns (debugger, target) for the program, target is None if the
+    # program was not preloaded and has to be loaded by the caller
+    def acquire(self, program):
+        path = os.path.realpath(program)
+        with self.cond:
+            if len(self.targets.get(path, [])) > 0:
+                pair = self.targets[path].pop()
+            elif len(self.debuggers) > 0:
+                pair = (self.debuggers.pop(), None)
+            else:
+                pair = None
+            self.cond.notify()
+        if pair is None:
+            pair = (lldb.SBDebugger.Create(), None)
+        return pair
+
+    def get_status(self):
+        with self.cond:
+            return { "debuggers": len(self.debuggers),
+                     "targets": dict([ (p, len(t)) for (p, t) in self.targets.items() ]) }
+
+    def close(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+class Session:
+    def __init__(self, session_id, program):
+        self.id = session_id
+        self.program = program
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+        self.prev_rows = dict()
+
+        # requests holding or waiting for the session, and whether it was
+        # closed. Both change under the server's lock
+        self.n_requests = 0
+        self.closed = False
+
+    def get_state(self):
+        program = self.program
+        state = dict()
+        state["session"] = self.id
+        state["step"] = program.step_count
+        state["file"] = program.get_filename()
+        state["line"] = program.get_line_number()
+        state["frames"] = list(program.get_active_stack_frames())
+        state["exited"] = program.has_exited()
+        state["interrupted"] = getattr(program, "interrupted", False)
+        return state
+
+    def close(self):
+        if hasattr(self.program, "close"):
+            self.program.close()
+
+class SessionServer:
+    def __init__(self, pool, max_sessions=200, max_active=None, idle_timeout=900.0, max_steps=10000, request_timeout=30.0):
+        self.pool = pool
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.max_steps = max_steps
+        self.request_timeout = request_timeout
+        self.active = threading.BoundedSemaphore(max_active if max_active is not None else os.cpu_count())
+        self.sessions = dict()
+        self.lock = threading.Lock()
+        self.methods = {
+            "launch": self.launch,
+            "step": self.step,
+            "run_to": self.run_to,
+            "snapshot": self.snapshot,
+            "diff": self.diff,
+            "stdout": self.stdout,
+            "close": self.close,
+            "status": self.status,
+        }
+
+        reaper = threading.Thread(target=self.evict_idle)
+        reaper.daemon = True
+        reaper.start()
+
+    # run fn(session) holding the session and one of the active slots.
+    # With timed, a program that runs longer than request_timeout is
+    # interrupted
+    def with_session(self, params, fn, timed=False):
+        with self.lock:
+            session = self.sessions.get(params.get("session"))
+            if session is None:
+                raise RpcError(invalid_params, "no such session")
+            # not evicted while the request runs
+            session.n_requests += 1
+        try:
+            # the session is taken first, requests queued on a busy session
+            # don't hold active slots that other sessions could use
+            with session.lock:
+                # closed while this request waited for it
+                if session.closed:
+                    raise RpcError(invalid_params, "no such session")
+                with self.active:
+                    timer = None
+                    if timed and hasattr(session.program, "interrupt"):
+                        session.program.interrupted = False
+                        timer = threading.Timer(self.request_timeout, session.program.interrupt)
+                        timer.daemon = True
+                        timer.start()
+                    try:
+                        result = fn(session)
+                    finally:
+                        if timer is not None:
+                            timer.cancel()
+        finally:
+            with self.lock:
+                session.n_requests -= 1
+                session.last_used = time.time()
+        return result
+
+    def launch(self, params):
+        program_name = params.get("program")
+        if program_name is None or not os.path.exists(program_name):
+            raise RpcError(invalid_params, "program not found")
+        with self.lock:
+            if len(self.sessions) >= self.max_sessions:
+                raise RpcError(server_error, "too many sessions")
+            # reserve the slot while the program launches
+            session_id = uuid.uuid4().hex
+            self.sessions[session_id] = None
+
+        try:
+            with self.active:
+                if is_trace_file(program_name):
+                    program = ReplayState(program_name)
+                else:
+                    (debugger, target) = self.pool.acquire(program_name)
+                    program = ProgramState(program_name, params.get("stdin"), debugger=debugger, target=target)
+        except Exception as e:
+            with self.lock:
+                del self.sessions[session_id]
+            if isinstance(e, LaunchError):
+                raise RpcError(server_error, "launch failed: %s" % e)
+            raise
+
+        session = Session(session_id, program)
+        with self.lock:
+            self.sessions[session_id] = session
+        return session.get_state()
+
+    def step(self, params):
+        n = int(params.get("n", 1))
+        if n < 1 or n > self.max_steps:
+            raise RpcError(invalid_params, "n must be between 1 and %d" % self.max_steps)
+        def fn(session):
+            session.program.step(n)
+            return session.get_state()
+        return self.with_session(params, fn, timed=True)
+
+    def run_to(self, params):
+        command = params.get("command")
+        arg = params.get("arg")
+        def fn(session):
+            program = session.program
+            if command == "line":
+                reached = program.run_to_line(int(arg))
+            elif command == "change":
+                reached = program.run_until_changed(arg)
+            elif command == "alloc":
+                reached = program.run_to_allocation()
+            else:
+                raise RpcError(invalid_params, "unknown command %s" % command)
+            state = session.get_state()
+            state["reached"] = reached
+            return state
+        return self.with_session(params, fn, timed=True)
+
+    def snapshot(self, params):
+        def fn(session):
+            rows = session.program.memory_model.snapshot()
+            session.prev_rows = rows
+            state = session.get_state()
+            state["memory"] = list(rows.values())
+            state["heap_graph"] = session.program.get_heap_graph()
+            return state
+        return self.with_session(params, fn)
+
+    def diff(self, params):
+        def fn(session):
+            rows = session.program.memory_model.snapshot()
+            added, changed, removed = diff_snapshots(session.prev_rows, rows)
+            session.prev_rows = rows
+            state = session.get_state()
+            state["added"] = added
+            state["changed"] = changed
+            state["removed"] = removed
+            return state
+        return self.with_session(params, fn)
+
+    def stdout(self, params):
+        since = int(params.get("since", 0))
+        def fn(session):
+            output = session.program.output
+            return { "chunks": output.get_chunks(since), "next": output.next_seq }
+        return self.with_session(params, fn)
+
+    def close(self, params):
+        with self.lock:
+            session = self.sessions.pop(params.get("session"), None)
+            if session is None:
+                raise RpcError(invalid_params, "no such session")
+            session.closed = True
+        with session.lock:
+            session.close()
+        return { "closed": session.id }
+
+    def status(self, params):
+        with self.lock:
+            n_sessions = len(self.sessions)
+        return { "sessions": n_sessions, "max_sessions": self.max_sessions, "pool": self.pool.get_status() }
+
+    def evict_idle(self):
+        while True:
+            time.sleep(min(self.idle_timeout, 30.0))
+            now = time.time()
+            with self.lock:
+                idle = [ s for s in self.sessions.values()
+                    if s is not None and s.n_requests == 0 and now - s.last_used > self.idle_timeout ]
+                for s in idle:
+                    del self.sessions[s.id]
+                    s.closed = True
+            for s in idle:
+                with s.lock:
+                    s.close()
+                sys.stderr.write("evicted idle session %s\n" % s.id)
+
+    # handle one decoded request, returns the response or None for notifications
+    def handle(self, request):
+        request_id = request.get("id") if isinstance(request, dict) else None
+        try:
+            if not isinstance(request, dict) or not isinstance(request.get("method"), str):
+                raise RpcError(invalid_request, "invalid request")
+            method = self.methods.get(request["method"])
+            if method is None:
+                raise RpcError(method_not_found, "unknown method %s" % request["method"])
+            params = request.get("params", {})
+            if not isinstance(params, dict):
+                raise RpcError(invalid_params, "params must be an object")
+            response = { "jsonrpc": "2.0", "id": request_id, "result": method(params) }
+        except RpcError as e:
+            response = { "jsonrpc": "2.0", "id": request_id, "error": { "code": e.code, "message": str(e) } }
+        except Exception as e:
+            response = { "jsonrpc": "2.0", "id": request_id, "error": { "code": server_error, "message": repr(e) } }
+
+        if isinstance(request, dict) and "id" not in request:
+            return None
+        return response
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if line.strip() == b"":
+                continue
+            try:
+                request = json.loads(line.decode("utf-8"))
+            except ValueError:
+                response = { "jsonrpc": "2.0", "id": None, "error": { "code": parse_error, "message": "parse error" } }
+            else:
+                response = self.server.sessions.handle(request)
+            if response is not None:
+                self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+                self.wfile.flush()
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class TcpServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def main():
+    parser = argparse.ArgumentParser(description="serve debugging sessions over JSON-RPC")
+    parser.add_argument("--unix", default=None, help="path of the Unix socket to listen on")
+    parser.add_argument("--port", type=int, default=None, help="TCP port to listen on (localhost only)")
+    parser.add_argument("--preload", nargs="*", default=[], help="binaries to keep loaded targets ready for")
+    parser.add_argument("--pool-size", type=int, default=4, help="number of debuggers to keep ready")
+    parser.add_argument("--max-sessions", type=int, default=200, help="number of sessions that can be open at once")
+    parser.add_argument("--max-active", type=int, default=os.cpu_count(), help="number of sessions that can run at once")
+    parser.add_argument("--idle-timeout", type=float, default=900.0, help="seconds after which an idle session is closed")
+    parser.add_argument("--max-steps", type=int, default=10000, help="number of steps a single step request can take")
+    parser.add_argument("--request-timeout", type=float, default=30.0,
+        help="seconds after which a step or run_to request is interrupted")
+    args = parser.parse_args()
+    if (args.unix is None) == (args.port is None):
+        parser.error("give one of --unix or --port")
+
+    pool = DebuggerPool(args.pool_size, args.preload)
+    sessions = SessionServer(pool, args.max_sessions, args.max_active, args.idle_timeout, args.max_steps,
+        args.request_timeout)
+    if args.unix is not None:
+        if os.path.exists(args.unix):
+            os.unlink(args.unix)
+        server = UnixServer(args.unix, RequestHandler)
+    else:
+        server = TcpServer(("127.0.0.1", args.port), RequestHandler)
+    server.sessions = sessions
+
+    sys.stderr.write("serving on %s\n" % (args.unix if args.unix is not None else "127.0.0.1:%d" % args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    pool.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# Export the memory model at many steps into a SQLite database that can
+# be queried without loading it all, and convert between such databases
+# and the TSV written by meminspect.
+#
+# The values table holds the same rows as a TSV delta dump: the first
+# snapshot in full (op =), then the rows added (+), changed (~) and
+# removed (-) at each step. Section and type names are interned in their
+# own tables, the memory view joins them back. Use snapshot_at() to get
+# the state of memory at a given step. The roots and edges of the heap
+# graph are stored in full at each step where they changed.
+#
+# To convert a database to TSV or a TSV dump to a database:
+#
+#   python3 src/sqlite_export.py dump.db dump.tsv
+#   python3 src/sqlite_export.py dump.tsv dump.db
+#----------------------------------------------------------------------
+import argparse
+import heapq
+import sqlite3
+import sys
+
+from memory_model import *
+
+sqlite_magic = b"SQLite format 3\0"
+
+schema = """
+create table sections (id integer primary key, name text unique not null);
+create table types (id integer primary key, name text unique not null);
+create table values_ (
+    step integer not null,
+    op text not null,
+    section_id integer not null references sections(id),
+    address integer not null,
+    size integer,
+    value text,
+    label text,
+    type_id integer references types(id)
+);
+create table output (step integer not null, stream text not null, text text not null);
+create table heap_graph (
+    step integer not null,
+    kind text not null,
+    section text not null,
+    address integer,
+    target integer not null,
+    label text
+);
+create index values_step_address on values_ (step, address);
+create index values_step_section on values_ (step, section_id);
+create index values_address_step on values_ (address, step);
+create view memory as
+    select v.step, v.op, s.name as section, v.address, v.size, v.value, v.label, t.name as type
+    from values_ v join sections s on s.id = v.section_id left join types t on t.id = v.type_id;
+"""
+
+def is_sqlite_file(path):
+    try:
+        with open(path, "rb") as fh:
+            return fh.read(len(sqlite_magic)) == sqlite_magic
+    except IOError:
+        return False
+
+# Writes snapshots of the memory model into a database, with the same
+# interface as TsvDeltaWriter. Rows are inserted in batches, the
+# transaction is committed every commit_interval steps.
+class SqliteWriter:
+    def __init__(self, path, commit_interval=100):
+        self.db = sqlite3.connect(path)
+        self.db.execute("pragma journal_mode = off")
+        self.db.execute("pragma synchronous = off")
+        self.db.executescript(schema)
+        self.commit_interval = commit_interval
+        self.n_steps = 0
+        self.prev = None
+        self.prev_graph = None
+        self.output_seq = 0
+        self.section_ids = dict()
+        self.type_ids = dict()
+
+    def intern(self, table, ids, name):
+        if name is None:
+            return None
+        if name not in ids:
+            ids[name] = self.db.execute("insert into %s (name) values (?)" % table, (name,)).lastrowid
+        return ids[name]
+
+    def get_row(self, step, op, row):
+        (section, address, size, value, label, type_name) = row
+        return (step, op, self.intern("sections", self.section_ids, section), address, size,
+                None if value is None else str(value), None if label is None else str(label),
+                self.intern("types", self.type_ids, type_name))
+
+    def write_rows(self, step, ops):
+        self.db.executemany("insert into values_ values (?, ?, ?, ?, ?, ?, ?, ?)",
+            [ self.get_row(step, op, r) for (op, r) in ops ])
+
+    def write_output(self, output):
+        self.db.executemany("insert into output values (?, ?, ?)",
+            [ (step, stream, text) for (seq, step, stream, text) in output.get_chunks(self.output_seq) ])
+        self.output_seq = output.next_seq
+
+    def write_graph(self, step, graph):
+        rows = get_graph_rows(graph)
+        if rows != self.prev_graph:
+            self.db.executemany("insert into heap_graph values (?, ?, ?, ?, ?, ?)",
+                [ (step,) + row for row in rows ])
+        self.prev_graph = rows
+
+    def write_step(self, step, memory_model, output=None, graph=None):
+        if output is not None:
+            self.write_output(output)
+        if graph is not None:
+            self.write_graph(step, graph)
+        if self.prev is None:
+            self.write_rows(step, [ ("=", row) for row in memory_model.snapshot(expand_lazy=True).values() ])
+        else:
+            added, changed, removed = memory_model.diff(self.prev)
+            out = [ ("+", r) for r in added ] + [ ("~", r) for r in changed ] + \
+                  [ ("-", r) for r in removed ]
+            self.write_rows(step, sorted(out, key=lambda x: x[1][1]))
+        self.prev = memory_model.copy()
+
+        self.n_steps += 1
+        if self.n_steps % self.commit_interval == 0:
+            self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+# the rows of memory (section, address, size, value, label, type) at the
+# given step, read from a database written by SqliteWriter
+def snapshot_at(db, step):
+    return db.execute("""
+        select section, address, size, value, label, type from memory m
+        where m.step = (select max(step) from values_ where address = m.address and step <= ?)
+          and m.op != '-'
+        order by address""", (step,)).fetchall()
+
+def unescape_output(value):
+    out = list()
+    escapes = { "\\": "\\", "t": "\t", "n": "\n" }
+    i = 0
+    while i < len(value):
+        if value[i] == "\\" and i + 1 < len(value) and value[i + 1] in escapes:
+            out.append(escapes[value[i + 1]])
+            i += 2
+        else:
+            out.append(value[i])
+            i += 1
+    return "".join(out)
+
+# write the contents of a database as the TSV TsvDeltaWriter would have written
+def sqlite_to_tsv(db, fp):
+    fp.write("\t".join( [ "step", "op", "section", "address", "size", "value", "label", "type\n" ] ))
+    outputs = db.execute("select step, stream, text from output order by rowid")
+    graph = []
+    if db.execute("select 1 from sqlite_master where name = 'heap_graph'").fetchone() is not None:
+        graph = db.execute("select step, kind, section, address, target, label from heap_graph order by rowid")
+    values = db.execute("""
+        select v.step, v.op, s.name, v.address, v.size, v.value, v.label, t.name
+        from values_ v join sections s on s.id = v.section_id left join types t on t.id = v.type_id
+        order by v.rowid""")
+
+    # the output of a step is written before its heap graph, which is
+    # written before its memory rows
+    def format_value(step, op, section, address, size, value, label, type_name):
+        mv = MemoryValue(section, address, size, value, label, type_name)
+        return "%d\t%s\t%s\n" % (step, op, mv)
+    rows = heapq.merge(
+        ((r[0], 0, format_output_row(*r)) for r in outputs),
+        ((r[0], 1, format_graph_row(*r)) for r in graph),
+        ((r[0], 2, format_value(*r)) for r in values),
+        key=lambda x: x[0:2])
+    for (step, kind, line) in rows:
+        fp.write(line)
+
+# TSV dumps write the spaces in section names as "-", a live export stores
+# "stack main" where the TSV has "stack-main". Only the space after "stack"
+# is restored, function names with spaces (C++ signatures) keep their "-"
+def get_live_section_name(name):
+    if name.startswith("stack-"):
+        return "stack " + name[len("stack-"):]
+    return name
+
+# load a TSV delta dump into a database. The TSV does not distinguish a
+# missing label, value or type from the strings used to display them,
+# these are stored as the strings
+def tsv_to_sqlite(fp, db_path):
+    writer = SqliteWriter(db_path)
+    header = fp.readline()
+    if not header.startswith("step\top"):
+        raise ValueError("not a multi-step meminspect dump")
+
+    batch = list()
+    for line in fp:
+        fields = line.rstrip("\n").split("\t")
+        step = int(fields[0])
+        if fields[1] == ">":
+            writer.db.execute("insert into output values (?, ?, ?)", (step, fields[2], unescape_output(fields[5])))
+            continue
+        if fields[1] == "^":
+            address = int(fields[3], 16) if fields[3] != "" else None
+            writer.db.execute("insert into heap_graph values (?, ?, ?, ?, ?, ?)",
+                (step, fields[7], get_live_section_name(fields[2]), address, int(fields[5], 16), fields[6]))
+            continue
+        (section, address, size, value, label, type_name) = fields[2:8]
+        batch.append(writer.get_row(step, fields[1], (get_live_section_name(section), int(address, 16), int(size), value, label, type_name)))
+        if len(batch) >= 10000:
+            writer.db.executemany("insert into values_ values (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+            batch = list()
+    writer.db.executemany("insert into values_ values (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+    writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="convert a meminspect dump between SQLite and TSV")
+    parser.add_argument("input", help="SQLite database or TSV dump")
+    parser.add_argument("output", help="file to write, '-' writes TSV to stdout")
+    args = parser.parse_args()
+
+    if is_sqlite_file(args.input):
+        db = sqlite3.connect(args.input)
+        if args.output == "-":
+            sqlite_to_tsv(db, sys.stdout)
+        else:
+            with open(args.output, "w") as fh:
+                sqlite_to_tsv(db, fh)
+        db.close()
+    else:
+        with open(args.input) as fh:
+            tsv_to_sqlite(fh, args.output)
+
+if __name__ == "__main__":
+    main()
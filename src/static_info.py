@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# Static data read out of a program binary once and then cached on disk
+# until the binary changes: the contents of its string sections, its
+# data symbols, its line tables and the text of its source files.
+#----------------------------------------------------------------------
+import lldb
+import os
+
+from cache import *
+from utils import get_globals
+
+text_section_names = set([ "__cstring" ])
+
+# bumped when the contents of the static info change, so that entries
+# cached by older versions are not used
+static_cache_kind = "static2"
+
+def iter_sections(sections):
+    for section in sections:
+        yield section
+        for sub in iter_sections(section):
+            yield sub
+
+def decode_text_section(data):
+    a = []
+    for b in bytearray(data):
+        if b != 0:
+            a.append(chr(b))
+        else:
+            a.append("\\0")
+    return ''.join(a).replace("\n", "\\n")
+
+# (section name, file address, size, contents) of each string section
+def read_strings(module):
+    strings = list()
+    for section in iter_sections(module.sections):
+        if section.GetName() not in text_section_names:
+            continue
+        data = section.GetSectionData()
+        error = lldb.SBError()
+        raw = data.ReadRawData(error, 0, data.GetByteSize())
+        if error.Success() and raw is not None:
+            strings.append([ section.GetName(), section.GetFileAddress(), section.GetByteSize(), decode_text_section(raw) ])
+    return strings
+
+# (file, line, start file address, end file address) of each line table entry
+def read_line_table(module):
+    entries = list()
+    for cu in module.compile_units:
+        for i in range(0, cu.GetNumLineEntries()):
+            le = cu.GetLineEntryAtIndex(i)
+            path = le.GetFileSpec().fullpath
+            if path is None:
+                continue
+            entries.append([ path, le.GetLine(), le.GetStartAddress().GetFileAddress(), le.GetEndAddress().GetFileAddress() ])
+    return entries
+
+def read_source(path):
+    lines = list()
+    with open(path) as fh:
+        for (ln, s) in enumerate(fh):
+            lines.append("%3d %s" % (ln + 1, s.rstrip()))
+    return lines
+
+def read_sources(line_table):
+    sources = dict()
+    for path in set([ e[0] for e in line_table ]):
+        if os.path.exists(path):
+            sources[path] = { "mtime": os.stat(path).st_mtime_ns, "lines": read_source(path) }
+    return sources
+
+def compute_static_info(target):
+    module = target.module[target.executable.basename]
+    info = dict()
+    info["strings"] = read_strings(module)
+    info["globals"] = get_globals(target)
+    info["line_table"] = read_line_table(module)
+    info["sources"] = read_sources(info["line_table"])
+    return info
+
+# returns the static info of the target's executable, from the cache if
+# the executable has not changed. info["cached"] tells which it was
+def load_static_info(target):
+    path = target.executable.fullpath
+    key = get_file_key(path)
+    info = cache_load(static_cache_kind, key)
+    if info is not None:
+        info["cached"] = True
+        return info
+
+    info = compute_static_info(target)
+    cache_store(static_cache_kind, key, info)
+    info["cached"] = False
+    return info
+
+# the formatted lines of a source file, from the static info if the file
+# is unchanged since it was read
+def get_source(static_info, path):
+    entry = static_info["sources"].get(path)
+    if entry is not None and os.path.exists(path) and os.stat(path).st_mtime_ns == entry["mtime"]:
+        return entry["lines"]
+    return read_source(path)
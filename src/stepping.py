@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# Engines that advance a ProgramState by one line of user code
+#----------------------------------------------------------------------
+import lldb
+from utils import *
+
+# the id of the breakpoint the thread stopped at, or None
+def get_breakpoint_hit(thread):
+    if thread.GetStopReason() != lldb.eStopReasonBreakpoint:
+        return None
+    return thread.GetStopReasonDataAtIndex(0)
+
+# if the thread stopped at malloc or free, record the allocation and
+# return to the caller. With the preloaded library (see alloc_shim.py) the
+# only allocator stop is a full ring, which is drained before returning to
+# user code. Like the legacy engine, only calls made from user code are
+# recorded: buffers libc allocates for itself (inside printf, say) are not
+# user heap blocks. returns true if this was an allocator stop
+def handle_allocator_stop(program, thread):
+    bp_id = get_breakpoint_hit(thread)
+    if bp_id is not None and program.alloc_log is not None and bp_id == program.alloc_log.full_bp.GetID():
+        program.alloc_log.drain(program.memory_model)
+        program.return_to_user_code()
+        return True
+    if bp_id == program.malloc_bp.GetID():
+        from_user = program.is_user_frame(thread.GetFrameAtIndex(1))
+        size = read_argument(thread.GetFrameAtIndex(0), 0, program.arch)
+        thread.StepOut()
+        ptr = read_return_value(thread.GetFrameAtIndex(0), program.arch)
+        if ptr != 0 and from_user:
+            program.memory_model.add_heap_alloc(ptr, size)
+        return True
+    elif bp_id == program.free_bp.GetID():
+        if program.is_user_frame(thread.GetFrameAtIndex(1)):
+            ptr = read_argument(thread.GetFrameAtIndex(0), 0, program.arch)
+            program.memory_model.free_heap_alloc(ptr)
+        thread.StepOut()
+        return True
+    return False
+
+# The original engine: step into every call, including calls into libc,
+# then step out until we are back in the main source file
+class LegacyStepper:
+    def __init__(self, program):
+        self.program = program
+        run_commands(program.command_interpreter, ['settings set target.process.thread.step-in-avoid-nodebug false'])
+
+    def advance(self):
+        program = self.program
+        thread = program.process.GetSelectedThread()
+
+        begin_file = program.get_filename_of_current_line(thread)
+        begin_line_num = thread.GetSelectedFrame().GetLineEntry().GetLine()
+
+        while True:
+            # perform the step in LLDB
+            thread.StepInto()
+            
+            curr_fn = thread.GetSelectedFrame().GetFunctionName()
+            # allocations logged by the preloaded library are picked up by
+            # refresh, unless the ring filled up
+            if program.alloc_log is not None:
+                handle_allocator_stop(program, thread)
+            # glibc malloc has mangled function names
+            elif curr_fn is not None and curr_fn.endswith("malloc"):
+                handle_malloc(program.memory_model, thread, program.arch)
+            elif curr_fn is not None and curr_fn.endswith("free"):
+                handle_free(program.memory_model, thread, program.arch)
+
+            # step out of non-user functions
+            while not program.has_exited() and not program.interrupted and not program.is_user_code(thread):
+                thread.StepOut()
+
+            # for reasons I don't yet understand step-into can sometimes do an instruction-level step?
+            # detect this by checking whether we changed line numbers, if not step again
+            if program.has_exited() or program.interrupted or \
+               program.get_filename_of_current_line(thread) != begin_file or \
+               thread.GetSelectedFrame().GetLineEntry().GetLine() != begin_line_num:
+                return
+
+# Steps over code without debug info and every shared library (libc, even
+# with debug info installed) with a single step-in thread plan, so a line
+# that calls printf costs one stop. Calls into any of the user's source
+# files are stepped into. Allocations are captured
+# at the malloc/free breakpoints: their argument is read when the breakpoint
+# is hit and the thread steps out once to read malloc's return value, after
+# which stepping resumes to finish the line.
+class BreakpointStepper:
+    def __init__(self, program):
+        self.program = program
+        run_commands(program.command_interpreter, ['settings set target.process.thread.step-in-avoid-nodebug true'])
+
+        executable = program.target.executable.fullpath
+        libraries = [ m.GetFileSpec().GetFilename() for m in program.target.module_iter() if m.GetFileSpec().fullpath != executable ]
+        if len(libraries) > 0:
+            run_commands(program.command_interpreter, ['settings set target.process.thread.step-avoid-libraries ' + " ".join(libraries)])
+
+    def get_location(self, thread):
+        frame = thread.GetSelectedFrame()
+        return (frame.GetLineEntry().GetFileSpec().GetFilename(), frame.GetLineEntry().GetLine(), frame.GetCFA())
+
+    def advance(self):
+        program = self.program
+        thread = program.process.GetSelectedThread()
+        begin = self.get_location(thread)
+
+        while not program.has_exited() and not program.interrupted:
+            thread.StepInto()
+            if program.has_exited() or program.interrupted:
+                return
+
+            if handle_allocator_stop(program, thread):
+                # we are back in the middle of the caller's line
+                continue
+
+            if not program.is_user_code(thread):
+                thread.StepOut()
+                continue
+
+            if self.get_location(thread) != begin:
+                return
+
+steppers = {
+    "breakpoint": BreakpointStepper,
+    "legacy": LegacyStepper,
+}
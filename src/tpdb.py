@@ -1,10 +1,13 @@
 #! /usr/bin/env python
-from import_lldb import *
 
+import argparse
 import curses
+import sys
+from heap_graph import get_graph_values
 from memory_model import *
-from import_lldb import *
-from utils import *
+from tracefile import open_program
+from profiler import Profiler
+from worker import Snapshot, StepWorker
 
 border_width = 1
 addr_width = 22
@@ -18,6 +21,18 @@ def pad_or_truncate(s, max_length):
     else:
         return s.ljust(max_length)
 
+# read a line of text from the user on the given row of the screen
+def prompt(stdscr, row, text):
+    stdscr.move(row, 0)
+    stdscr.clrtoeol()
+    stdscr.addstr(row, 0, text)
+    curses.echo()
+    curses.curs_set(1)
+    s = stdscr.getstr(row, len(text)).decode("utf-8").strip()
+    curses.noecho()
+    curses.curs_set(0)
+    return s
+
 class Dimension:
     def __init__(self, x, y, height, width):
         self.x = x
@@ -44,16 +59,21 @@ class CodeWindow:
         self.window.addstr(0, 2, " %s " % (title))
     
     def update_code(self, lines, current_line_number):
-        for c, l in enumerate(lines):
+        # scroll files that don't fit so the current line stays visible
+        first = 0
+        if len(lines) > self.max_lines:
+            first = max(0, min(current_line_number - 1 - self.max_lines // 2, len(lines) - self.max_lines))
+
+        for c, l in enumerate(lines[first:first + self.max_lines]):
         
             prefix = "  "
-            if c == current_line_number - 1:
+            if first + c == current_line_number - 1:
                 prefix = "->"
             l = pad_or_truncate(prefix + l, self.max_line_length)
             self.window.addstr(2 + c, 1, l)
     
     def draw(self):
-        self.window.refresh()
+        self.window.noutrefresh()
 
 class OutputWindow:
     def __init__(self, x_start, y_start, width, height, name):
@@ -67,175 +87,378 @@ class OutputWindow:
         self.window.border()
         self.window.addstr(0, 2, " %s " % (name))
 
+    # lines are (step, stream, text), each is shown with the step that
+    # printed it, stderr is marked with a !
     def update(self, lines ):
         lines = lines[-self.max_lines:]
 
-        for c, l in enumerate(lines):
-            l = pad_or_truncate(l, self.max_line_length)
+        for c, (step, stream, text) in enumerate(lines):
+            marker = "!" if stream == "stderr" else "|"
+            l = pad_or_truncate("%4d %s %s" % (step, marker, text), self.max_line_length)
             self.window.addstr(1 + c, 1, l)
    
     def draw(self):
-        self.window.refresh()
-
-
-class MemoryWindow:
-    def __init__(self, x_start, y_start, height, section_name):
-        line_num = 0
+        self.window.noutrefresh()
+
+
+# A scrollable view of the rows of one memory section (a SectionRows).
+# Only the visible rows are formatted, so the elements of a large array
+# are decoded as they are scrolled into view. The visible rows live in a
+# curses pad that is only written to where the text of a row changed,
+# rows that changed in the last step can be highlighted.
+class MemoryPane:
+    def __init__(self, x_start, y_start, height, section_name, highlight=True):
+        self.x = x_start
+        self.y = y_start
+        self.height = height
+        self.width = MemoryPane.get_width()
         self.max_lines = height - 2 * border_width
-        self.addr_window = curses.newwin(height, addr_width, y_start, x_start)
-        self.max_addr_length = addr_width - 2 * border_width - 2
-
-        x_start += addr_width
-        self.value_window = curses.newwin(height, value_width, y_start, x_start)
-        self.max_value_length = value_width - 2 * border_width - 2
-        
-        x_start += value_width
-        self.label_window = curses.newwin(height, label_width, y_start, x_start)
-        self.max_label_length = label_width - 2 * border_width - 2
-
-        # write titles
-        self.addr_window.border(0, 0, 0, 0, 0, curses.ACS_TTEE, 0, curses.ACS_BTEE)
-        self.value_window.border(' ', 0, 0, 0, curses.ACS_HLINE, curses.ACS_TTEE, curses.ACS_HLINE, curses.ACS_BTEE)
-        self.label_window.border(' ', 0, 0, 0, curses.ACS_HLINE, 0, curses.ACS_HLINE, 0)
-        
-        self.addr_window.addstr(0, 2, " " + section_name + " ")
+        self.max_line_length = self.width - 2 * border_width - 1
+        self.section_name = section_name
+        self.highlight = highlight
+
+        self.frame = curses.newwin(height, self.width, y_start, x_start)
+        self.pad = curses.newpad(self.max_lines + 1, self.width - 2 * border_width)
+
+        # the text of the visible rows by row index, the rows that are
+        # highlighted as changed and the (text, attribute) painted on
+        # each line of the pad
+        self.rows = SectionRows([], {})
+        self.lines = dict()
+        self.changed = set()
+        self.painted = [ None ] * self.max_lines
+        self.scroll_pos = 0
+        self.focused = False
+        self.title = None
 
     @staticmethod
     def get_width():
         return addr_width + value_width + label_width
 
-    def draw(self):
-        self.addr_window.refresh()
-        self.value_window.refresh()
-        self.label_window.refresh()
-
-    def set(self, idx, value):
-
-        if idx >= self.max_lines:
-            return
-
-        astr = pad_or_truncate(value.get_addr_as_str(), self.max_addr_length)
-        self.addr_window.addstr(idx + border_width, 1 + border_width, astr)
-        
-        vstr = pad_or_truncate(value.get_value_as_str(), self.max_value_length)
-        self.value_window.addstr(idx + border_width, 1, vstr)
-
-        lstr = pad_or_truncate(value.get_label_as_str(), self.max_label_length)
-        self.label_window.addstr(idx + border_width, 1, lstr)
-
-    def clear(self):
-        self.addr_window.clear()
-        self.value_window.clear()
-        self.label_window.clear()
+    def format_value(self, value):
+        astr = pad_or_truncate(value.get_addr_as_str(), addr_width - 3)
+        vstr = pad_or_truncate(value.get_value_as_str(), value_width - 1)
+        lstr = pad_or_truncate(value.get_label_as_str(), self.max_line_length - len(astr) - len(vstr) - 2)
+        return astr + " " + vstr + " " + lstr
+
+    def get_visible_lines(self):
+        first = self.scroll_pos
+        values = self.rows.get(first, first + self.max_lines)
+        return dict([ (first + i, self.format_value(v)) for (i, v) in enumerate(values) ])
+
+    def update(self, rows):
+        self.rows = rows
+        self.scroll_pos = max(0, min(self.scroll_pos, len(rows) - self.max_lines))
+        new_lines = self.get_visible_lines()
+
+        # nothing is highlighted when the pane is first filled
+        if self.highlight and len(self.lines) > 0:
+            self.changed = set([ i for (i, l) in new_lines.items() if self.lines.get(i) != l ])
+        else:
+            self.changed = set()
+        self.lines = new_lines
+        self.paint()
+
+    def scroll(self, delta):
+        last = max(0, len(self.rows) - self.max_lines)
+        pos = max(0, min(self.scroll_pos + delta, last))
+        if pos != self.scroll_pos:
+            self.scroll_pos = pos
+            self.lines = self.get_visible_lines()
+            self.paint()
+
+    # repaint the lines of the pad whose text or highlight changed
+    def paint(self):
+        for row in range(0, self.max_lines):
+            i = self.scroll_pos + row
+            text = self.lines.get(i)
+            attr = curses.A_REVERSE if i in self.changed else curses.A_NORMAL
+            if self.painted[row] == (text, attr):
+                continue
+            if text is None:
+                self.pad.move(row, 0)
+                self.pad.clrtoeol()
+            else:
+                self.pad.addstr(row, 0, text, attr)
+            self.painted[row] = (text, attr)
+
+    def get_title(self):
+        title = " " + self.section_name + " "
+        if len(self.rows) > self.max_lines:
+            title += "[%d-%d/%d] " % (self.scroll_pos + 1, min(self.scroll_pos + self.max_lines, len(self.rows)), len(self.rows))
+        return title
 
-        self.addr_window.refresh()
-        self.value_window.refresh()
-        self.label_window.refresh()
+    def draw(self):
+        # the border only needs redrawing when the title changes
+        title = (self.get_title(), self.focused)
+        if title != self.title:
+            self.frame.erase()
+            self.frame.border()
+            self.frame.addstr(0, 2, title[0][0:self.width - 4], curses.A_BOLD if self.focused else curses.A_NORMAL)
+            self.frame.noutrefresh()
+            self.title = title
+
+        if self.max_lines > 0:
+            self.pad.noutrefresh(0, 0, self.y + border_width, self.x + border_width,
+                self.y + self.height - 1 - border_width, self.x + self.width - 1 - border_width)
+
+# Lays out one pane per active stack frame below the heap. Panes are kept
+# between updates and only recreated when the set of frames or the number
+# of values in a frame changes.
+class StackPanes:
+    def __init__(self, x_start, y_start, height, highlight):
+        self.x = x_start
+        self.y = y_start
+        self.height = height
+        self.highlight = highlight
+        self.layout = None
+        self.panes = list()
+        self.background = curses.newwin(height, MemoryPane.get_width(), y_start, x_start)
+
+    def update(self, active_stack_frames, memory_by_section):
+        frames = [ name for name in active_stack_frames if name in memory_by_section ]
+
+        # each frame gets enough room for all of its values if possible,
+        # frames that don't fit are scrollable
+        layout = list()
+        curr_start = self.y
+        for name in frames:
+            remaining = self.y + self.height - curr_start
+            if remaining < 1 + 2 * border_width:
+                break
+            h = min(len(memory_by_section[name]) + 2 * border_width, remaining)
+            layout.append((name, curr_start, h))
+            curr_start += h
+
+        if layout != self.layout:
+            self.background.erase()
+            self.background.noutrefresh()
+            self.panes = [ MemoryPane(self.x, y, h, name, self.highlight) for (name, y, h) in layout ]
+            self.layout = layout
+
+        for pane in self.panes:
+            pane.update(memory_by_section[pane.section_name])
 
-def main(stdscr, program):
-    # hide cursor
-    curses.curs_set(0)
+    def draw(self):
+        for pane in self.panes:
+            pane.draw()
+
+# All windows of the UI, sized to the terminal
+class Layout:
+    def __init__(self, stdscr, highlight, can_step_back):
+        self.code_width = curses.COLS - MemoryPane.get_width()
+
+        output_height = 5
+        command_height = 1
+        fixed_element_height = output_height + command_height
+        code_height = curses.LINES - fixed_element_height
+        text_height = 1 + 2 * border_width
+        heap_height = int(code_height / 2)
+        stack_height = code_height - heap_height - text_height
 
-    # initialize windows
-    code_height = 36
-    code_width = curses.COLS - MemoryWindow.get_width()
-    stack_height = 18
-
-    output_height = 5
-    command_height = 1
-    fixed_element_height = output_height + command_height
-    code_height = curses.LINES - fixed_element_height
-    text_height = 1 + 2 * border_width
-    heap_height = int(code_height / 2)
-    stack_height = code_height - heap_height
-
-    # Code
-    code_window = CodeWindow(0, 0, code_width, code_height)
-
-    # Memory
-    mem_x_start = code_width
-
-    text_window = MemoryWindow(mem_x_start, 0, text_height, ".text")
-    heap_window = MemoryWindow(mem_x_start, text_height, heap_height, "heap")
- 
-    # Output
-    output_window = OutputWindow(0, code_height, code_width + MemoryWindow.get_width(), output_height, "stdout")
-
-    # command help
-    stdscr.addstr(code_height +  output_height, 0, " commands: (n)ext line (d)ump memory to tsv")
-    stdscr.refresh()
-    
+        # Code
+        self.code_window = CodeWindow(0, 0, self.code_width, code_height)
+        self.code_window.window.timeout(50)
+        self.code_window.window.keypad(True)
 
-    while True:
+        # Memory
+        mem_x_start = self.code_width
 
-        # Update UI
-        
+        self.text_pane = MemoryPane(mem_x_start, 0, text_height, ".text", highlight=False)
+        self.heap_pane = MemoryPane(mem_x_start, text_height, heap_height, "heap", highlight)
+        self.stack_panes = StackPanes(mem_x_start, text_height + heap_height, stack_height, highlight)
+     
+        # Output
+        self.output_window = OutputWindow(0, code_height, self.code_width + MemoryPane.get_width(), output_height, "output")
+
+        # command help
+        self.commands = " commands: (n)ext line (d)ump memory to tsv (l) run to line (w)atch variable (m)alloc/free" + \
+            " (g)raph of the heap (tab) select pane (j/k) scroll (q)uit"
+        if can_step_back:
+            self.commands += " (p)revious line"
+        self.command_row = code_height +  output_height
+        self.stdscr = stdscr
+        # the heap pane shows the heap graph instead of the heap's values
+        self.show_graph = False
+        self.show_commands()
+
+    def show_commands(self):
+        self.show_status(self.commands)
+
+    # replaces the command help, used by --profile
+    def show_status(self, text):
+        self.stdscr.move(self.command_row, 0)
+        self.stdscr.clrtoeol()
+        self.stdscr.addstr(self.command_row, 0, text[0:curses.COLS - 1])
+        self.stdscr.noutrefresh()
+
+    def update(self, snapshot, status):
         # Code
-        code = program.get_code()
-        ln = program.get_line_number()
-        code_window.update_title(program.line_entry.GetFileSpec().GetFilename())
-        code_window.update_code(code, ln)
+        title = snapshot.get_filename()
+        if status != "":
+            title += " - " + status
+        self.code_window.update_title(pad_or_truncate(title, self.code_width - 6))
+        self.code_window.update_code(snapshot.get_code(), snapshot.get_line_number())
 
-        memory_by_section = program.memory_model.get_memory_sections()
+        memory_by_section = snapshot.memory_model.get_section_rows()
         
-        # set the .text section, this only needs to happen once since it is read-only
-        if "text" in memory_by_section:
-            assert(len(memory_by_section["text"]) == 1)
-            text_window.set(0, memory_by_section["text"][0])
-
-        # set the heap
-        heap_count = 0
-        for heap_value in memory_by_section["heap"]:
-            heap_window.set(heap_count, heap_value)
-            heap_count += 1
-
+        self.text_pane.update(memory_by_section.get("text", SectionRows([], {})))
+        if self.show_graph:
+            self.heap_pane.section_name = "heap graph"
+            self.heap_pane.update(SectionRows.from_values(get_graph_values(snapshot.heap_graph)))
+        else:
+            self.heap_pane.section_name = "heap"
+            self.heap_pane.update(memory_by_section["heap"])
         del memory_by_section["heap"]
+        # globals are shown above the stack frames
+        self.stack_panes.update([ "globals" ] + snapshot.get_active_stack_frames(), memory_by_section)
 
-        # create stack windows
-        stack = list()
-
-        # set the stack, creating new windows as needed
-        active_stack_frames = program.get_active_stack_frames()
+        # Output
+        self.output_window.update(snapshot.output_lines)
+
+    def draw(self, focus):
+        # the heap and stack panes can be selected for scrolling
+        scrollable = self.get_scrollable()
+        for (i, pane) in enumerate(scrollable):
+            pane.focused = (i == focus % len(scrollable))
+
+        self.code_window.draw()
+        self.output_window.draw()
+        self.text_pane.draw()
+        self.heap_pane.draw()
+        self.stack_panes.draw()
+        curses.doupdate()
+
+    def get_scrollable(self):
+        return [ self.heap_pane ] + self.stack_panes.panes
+
+# The program runs on a StepWorker thread. The UI sends it commands and
+# shows the snapshots it publishes, so it keeps responding to keys (and
+# terminal resizes) while a step is running.
+def main(stdscr, worker, highlight=True, profiler=None):
+    # hide cursor
+    curses.curs_set(0)
 
-        curr_stack_start = heap_height + text_height
-        for stack_name in active_stack_frames:
-            if stack_name not in memory_by_section:
-                continue
-    
-            stack_values = sorted(memory_by_section[stack_name], key=lambda x: x.address)
-            curr_stack_height = len(stack_values) + 2 * border_width
-            stack_window = MemoryWindow(mem_x_start, curr_stack_start, curr_stack_height, stack_name)
-            stack.append(stack_window)
-            curr_stack_start += curr_stack_height
-            stack_count = 0
-            for stack_value in stack_values:
-                stack_window.set(stack_count, stack_value)
-                stack_count += 1
+    layout = Layout(stdscr, highlight, worker.can_step_back)
+    snapshot = None
+    error = ""
+    focus = 0
+    needs_update = False
+    shown_busy = False
+    while True:
 
-        # Output
-        output_window.update(program.stdout)
-
-        text_window.draw()
-        heap_window.draw()
-        for s in stack:
-            s.draw()
-        code_window.draw()
-        output_window.draw()
+        # show the latest snapshot from the worker
+        message = worker.poll()
+        while message is not None:
+            (kind, payload) = message
+            if kind == "snapshot":
+                snapshot = payload
+                error = ""
+            else:
+                error = payload
+            needs_update = True
+            message = worker.poll()
+
+        # Update UI, the panes only repaint the rows that changed
+        if needs_update and snapshot is not None:
+            status = "step %d" % snapshot.step
+            shown_busy = worker.busy
+            if shown_busy:
+                status += " (running)"
+            if snapshot.has_exited():
+                status += " (exited)"
+            if error != "":
+                status += " error: " + error
+            layout.update(snapshot, status)
+            if profiler is not None:
+                layout.show_status(profiler.get_status())
+            needs_update = False
+        layout.draw(focus)
     
-        #key = code_window.window.getstr()
-        key = code_window.window.getch()
-        if key == ord('n'):
-            program.step()
-        elif key == ord('d'):
-            fp = open("memory_dump.tsv", "w")
-            program.memory_model.write_tsv(fp)
-
-        curses.napms(50)
-        
-        # needed to discard stack frames that drop out of scope
-        for s in stack:
-            s.clear()
+        key = layout.code_window.window.getch()
+        scrollable = layout.get_scrollable()
+        pane = scrollable[focus % len(scrollable)]
+        if key == -1:
+            # keep the running indicator up to date
+            needs_update = needs_update or worker.busy != shown_busy
+        elif key == ord('q'):
+            worker.stop()
+            return
+        elif key == ord('n'):
+            worker.request("step")
+            needs_update = True
+        elif key == ord('p') and worker.can_step_back:
+            worker.request("back")
+            needs_update = True
+        elif key == ord('l'):
+            line = prompt(stdscr, layout.command_row, " run to line: ")
+            if line.isdigit():
+                worker.request("line", int(line))
+            layout.show_commands()
+            needs_update = True
+        elif key == ord('w'):
+            name = prompt(stdscr, layout.command_row, " run until variable changes: ")
+            if name != "":
+                worker.request("watch", name)
+            layout.show_commands()
+            needs_update = True
+        elif key == ord('m'):
+            worker.request("alloc")
+            needs_update = True
+        elif key == ord('g'):
+            layout.show_graph = not layout.show_graph
+            # switching views doesn't highlight every row as changed
+            layout.heap_pane.lines = dict()
+            needs_update = True
+        elif key == ord('\t'):
+            focus += 1
+        elif key in (ord('j'), curses.KEY_DOWN):
+            pane.scroll(1)
+        elif key in (ord('k'), curses.KEY_UP):
+            pane.scroll(-1)
+        elif key == curses.KEY_NPAGE:
+            pane.scroll(pane.max_lines)
+        elif key == curses.KEY_PPAGE:
+            pane.scroll(-pane.max_lines)
+        elif key == curses.KEY_RESIZE:
+            curses.update_lines_cols()
+            stdscr.clear()
+            stdscr.noutrefresh()
+            show_graph = layout.show_graph
+            layout = Layout(stdscr, highlight, worker.can_step_back)
+            layout.show_graph = show_graph
+            needs_update = True
+        elif key == ord('d') and snapshot is not None:
+            with open("memory_dump.tsv", "w") as fp:
+                snapshot.memory_model.write_tsv(fp)
         
-#       
-program = ProgramState(sys.argv[1])
-curses.wrapper(main, program)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="tiny program debugger")
+    parser.add_argument("program", help="program or trace file to debug")
+    parser.add_argument("--no-highlight", action="store_true", help="don't highlight values that changed in the last step")
+    parser.add_argument("--prefetch", type=int, default=4, help="number of steps to compute ahead while idle")
+    parser.add_argument("--profile", nargs="?", const="-", default=None, metavar="FILE",
+        help="show phase timings and lldb call counts of the last step instead of the command help, " +
+        "and write them all as JSON to FILE (default stdout) on exit")
+    args = parser.parse_args()
+
+    program = open_program(args.program)
+
+    profiler = None
+    if args.profile is not None:
+        profiler = Profiler()
+        profiler.instrument_program(program)
+        profiler.time_calls(Snapshot, "__init__", "snapshot")
+        profiler.time_calls(Layout, "update", "ui-update")
+        profiler.time_calls(Layout, "draw", "ui-draw")
+
+    worker = StepWorker(program, args.prefetch)
+    worker.start()
+    curses.wrapper(main, worker, not args.no_highlight, profiler)
+
+    if profiler is not None:
+        if args.profile == "-":
+            profiler.write_report(sys.stdout)
+        else:
+            with open(args.profile, "w") as fh:
+                profiler.write_report(fh)
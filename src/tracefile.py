@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# Record the execution of a program once into a trace file and replay
+# it later without lldb.
+#
+# Layout of a trace file:
+#   magic
+#   one record per step: <u32 length><zlib compressed json>
+#   index record (same framing): offsets of every step, source code
+#   trailer: <u64 offset of the index record><magic>
+#
+# Each step record holds the line entry, active frames, the (seq, step,
+# stream, text) chunks of stdout and stderr written during the step and the memory
+# model rows that changed since the previous step (large arrays element
+# by element, see LazyRange). Every keyframe_interval
+# steps a full copy of the memory model and output buffer is written
+# instead so seeking to any step only
+# needs to read a bounded number of records. The heap graph is written
+# in keyframes and in the steps where it changed.
+#----------------------------------------------------------------------
+import json
+import struct
+import sys
+import zlib
+
+from heap_graph import empty_graph
+from memory_model import *
+from output_capture import OutputRing
+
+trace_magic = b"TPDBTRC1"
+record_header = struct.Struct("<I")
+trailer = struct.Struct("<Q8s")
+
+def is_trace_file(path):
+    try:
+        with open(path, "rb") as fh:
+            return fh.read(len(trace_magic)) == trace_magic
+    except (IOError, OSError):
+        return False
+
+# open either a recorded trace or a live program, only the
+# latter requires lldb
+def open_program(path, stdin_path=None):
+    if is_trace_file(path):
+        return ReplayState(path)
+
+    import import_lldb
+    from program_state import LaunchError, ProgramState
+    try:
+        return ProgramState(path, stdin_path)
+    except LaunchError as e:
+        print(e)
+        sys.exit(1)
+
+class TraceWriter:
+    def __init__(self, path, program_name, keyframe_interval=50):
+        self.fh = open(path, "wb")
+        self.fh.write(trace_magic)
+        self.program_name = program_name
+        self.keyframe_interval = keyframe_interval
+        self.offsets = list()
+        self.sources = dict()
+        self.prev_model = None
+        self.prev_graph = None
+        self.output_seq = 0
+
+    def write_record(self, obj):
+        offset = self.fh.tell()
+        data = zlib.compress(json.dumps(obj, separators=(",", ":")).encode("utf-8"))
+        self.fh.write(record_header.pack(len(data)))
+        self.fh.write(data)
+        return offset
+
+    def add_step(self, program):
+        step = len(self.offsets)
+        memory_model = program.memory_model
+
+        path = program.get_source_path()
+        if path is not None and path not in self.sources:
+            self.sources[path] = program.get_code()
+
+        record = dict()
+        record["step"] = step
+        record["path"] = path
+        record["file"] = program.get_filename()
+        record["line"] = program.get_line_number()
+        record["function"] = program.function_name
+        record["frames"] = program.get_active_stack_frames()
+        record["exited"] = program.has_exited()
+        record["allocator_calls"] = memory_model.n_allocator_calls
+
+        # keyframes hold the whole output buffer for seeking, and like every
+        # other step the chunks printed during the step for replaying forward
+        record["output_chunks"] = program.output.get_chunks(self.output_seq)
+        if step % self.keyframe_interval == 0:
+            record["memory"] = list(memory_model.snapshot(expand_lazy=True).values())
+            record["output"] = program.output.get_chunks()
+        else:
+            added, changed, removed = memory_model.diff(self.prev_model)
+            record["set"] = added + changed
+            record["del"] = [ row[1] for row in removed ]
+        graph = program.get_heap_graph()
+        if "memory" in record or graph != self.prev_graph:
+            record["heap_graph"] = graph
+        self.prev_graph = graph
+
+        self.offsets.append(self.write_record(record))
+        self.prev_model = memory_model.copy()
+        self.output_seq = program.output.next_seq
+
+    def close(self):
+        index = dict()
+        index["program"] = self.program_name
+        index["keyframe_interval"] = self.keyframe_interval
+        index["offsets"] = self.offsets
+        index["sources"] = self.sources
+        index_offset = self.write_record(index)
+        self.fh.write(trailer.pack(index_offset, trace_magic))
+        self.fh.close()
+
+# run the program to completion (or max_steps) recording every step
+def record_trace(program, path, max_steps=None, keyframe_interval=50):
+    writer = TraceWriter(path, program.target.executable.fullpath, keyframe_interval)
+    writer.add_step(program)
+    while not program.has_exited():
+        if max_steps is not None and program.step_count >= max_steps:
+            break
+        program.step()
+        writer.add_step(program)
+    writer.close()
+    return len(writer.offsets)
+
+class TraceReader:
+    def __init__(self, path):
+        self.fh = open(path, "rb")
+        if self.fh.read(len(trace_magic)) != trace_magic:
+            raise ValueError("%s is not a tpdb trace file" % path)
+
+        self.fh.seek(-trailer.size, 2)
+        index_offset, magic = trailer.unpack(self.fh.read(trailer.size))
+        if magic != trace_magic:
+            raise ValueError("%s is truncated, the recording did not finish" % path)
+
+        self.index = self.read_record(index_offset)
+        self.offsets = self.index["offsets"]
+        self.keyframe_interval = self.index["keyframe_interval"]
+
+    def read_record(self, offset):
+        self.fh.seek(offset)
+        (length,) = record_header.unpack(self.fh.read(record_header.size))
+        return json.loads(zlib.decompress(self.fh.read(length)).decode("utf-8"))
+
+    def get_step(self, step):
+        return self.read_record(self.offsets[step])
+
+    def num_steps(self):
+        return len(self.offsets)
+
+    def close(self):
+        self.fh.close()
+
+# Stand-in for ProgramState that is backed by a trace file. It supports
+# moving backwards as well as forwards.
+class ReplayState:
+    def __init__(self, path):
+        self.reader = TraceReader(path)
+        self.memory_model = MemoryModel()
+        self.output = OutputRing()
+        self.heap_graph = empty_graph
+        self.step_count = -1
+        self.record = None
+        self.seek(0)
+
+    def seek(self, step):
+        step = max(0, min(step, self.reader.num_steps() - 1))
+        if step == self.step_count:
+            return
+
+        # apply deltas directly when moving forward to a nearby step,
+        # otherwise restart from the closest keyframe
+        keyframe = step - step % self.reader.keyframe_interval
+        if self.step_count < keyframe or self.step_count > step:
+            self.load_keyframe(keyframe)
+
+        for s in range(self.step_count + 1, step + 1):
+            record = self.reader.get_step(s)
+            if "memory" in record:
+                self.memory_model.load_snapshot(record["memory"])
+            else:
+                self.memory_model.apply_delta(record["set"], record["del"])
+            self.output.extend(record["output_chunks"])
+            self.record = record
+            self.heap_graph = record.get("heap_graph", self.heap_graph)
+        self.step_count = step
+        self.memory_model.n_allocator_calls = self.record["allocator_calls"]
+
+    def load_keyframe(self, step):
+        self.load_keyframe_record(self.reader.get_step(step))
+        self.step_count = step
+        self.memory_model.n_allocator_calls = self.record["allocator_calls"]
+
+    def load_keyframe_record(self, record):
+        self.memory_model.load_snapshot(record["memory"])
+        self.output.load(record["output"])
+        self.heap_graph = record.get("heap_graph", empty_graph)
+        self.record = record
+
+    def step(self, n_steps=1):
+        self.seek(self.step_count + n_steps)
+
+    def step_back(self, n_steps=1):
+        self.seek(self.step_count - n_steps)
+
+    def num_steps(self):
+        return self.reader.num_steps()
+
+    # fast-forward commands matching ProgramState's, implemented by
+    # replaying steps until the condition holds
+    def run_until(self, is_done):
+        while self.step_count < self.num_steps() - 1:
+            self.step()
+            if is_done():
+                return True
+        return False
+
+    def run_to_line(self, line):
+        filename = self.get_filename()
+        return self.run_until(lambda: self.get_line_number() == line and self.get_filename() == filename)
+
+    def run_until_changed(self, name):
+        section = self.get_active_stack_frames()[0]
+        v = self.memory_model.find_value(section, name)
+        if v is None:
+            return False
+        value = v.value
+
+        def is_changed():
+            curr = self.memory_model.find_value(section, name)
+            return curr is None or curr.value != value
+        return self.run_until(is_changed)
+
+    def run_to_allocation(self):
+        calls = self.memory_model.n_allocator_calls
+        return self.run_until(lambda: self.memory_model.n_allocator_calls != calls)
+
+    @property
+    def function_name(self):
+        return self.record["function"]
+
+    def get_filename(self):
+        return self.record["file"]
+
+    def get_source_path(self):
+        return self.record["path"]
+
+    def get_code(self):
+        return self.reader.index["sources"].get(self.record["path"], [])
+
+    def get_line_number(self):
+        return self.record["line"]
+
+    def get_active_stack_frames(self):
+        return self.record["frames"]
+
+    def get_heap_graph(self):
+        return self.heap_graph
+
+    def has_exited(self):
+        return self.record["exited"]
+
+    def close(self):
+        self.reader.close()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# Flattened memory layouts of C types, computed once per type from its
+# SBType. A layout lists every scalar, pointer and char array inside a
+# struct, union or array, however deeply nested, with its offset, size,
+# decoder and a label suffix such as ".pos[2].x". A value of the type can
+# then be decoded in full from a single read of its bytes.
+#----------------------------------------------------------------------
+import struct
+
+from raw_decode import *
+
+# aggregates bigger than this are only laid out up to this many fields
+max_fields = 65536
+
+# arrays with more elements than this are not flattened, they are kept
+# as a LazyRange whose elements are decoded on demand
+lazy_threshold = 256
+
+class Field:
+    def __init__(self, offset, size, suffix, type_name, kind, fmt=None):
+        self.offset = offset
+        self.size = size
+        self.suffix = suffix
+        self.type_name = type_name
+        # scalar, pointer, chars, enum, bitfield or unknown
+        self.kind = kind
+        self.fmt = fmt
+        self.scalar_type = None
+        self.enum_names = None
+        self.bit_offset = 0
+        self.bit_size = 0
+        self.signed = False
+        # the SBType pointers point to
+        self.pointee = None
+
+class TypeLayout:
+    def __init__(self, byte_size, fields):
+        self.byte_size = byte_size
+        self.fields = fields
+
+        # scalars and pointers that don't overlap (no unions) are decoded
+        # with a single precompiled struct
+        simple = [ f for f in fields if f.kind in ("scalar", "pointer", "enum") ]
+        self.struct = None
+        self.struct_fields = simple
+        self.pointer_fields = [ f for f in fields if f.kind == "pointer" ]
+        end = 0
+        fmt = "<"
+        for f in simple:
+            if f.offset < end:
+                self.struct = None
+                break
+            if f.offset > end:
+                fmt += "%dx" % (f.offset - end)
+            fmt += f.fmt
+            end = f.offset + f.size
+        else:
+            self.struct = struct.Struct(fmt)
+
+layout_cache = dict()
+
+# Layouts are keyed by name and size, where the type is declared and its
+# direct members: two compilation units can define different structs with
+# the same name and size. Anonymous structs and unions (and arrays of
+# them) return None and are not cached
+def get_type_key(sb_type):
+    t = sb_type.GetCanonicalType()
+    if t.IsArrayType():
+        elem = get_type_key(t.GetArrayElementType())
+        return None if elem is None else (elem, t.GetByteSize())
+    name = t.GetName()
+    if name is None or name == "" or "(anonymous" in name or "(unnamed" in name:
+        return None
+    # SBType.GetDeclaration is missing from older versions of lldb
+    declaration = str(t.GetDeclaration()) if hasattr(t, "GetDeclaration") else None
+    members = tuple([ (f.GetName(), f.GetOffsetInBits(), f.GetType().GetCanonicalType().GetName())
+        for f in [ t.GetFieldAtIndex(i) for i in range(t.GetNumberOfFields()) ] ])
+    return (name, t.GetByteSize(), declaration, members)
+
+# the layout of a type, computed on first use
+def get_type_layout(sb_type):
+    key = get_type_key(sb_type)
+    layout = layout_cache.get(key) if key is not None else None
+    if layout is None:
+        fields = list()
+        flatten(sb_type, 0, "", fields)
+        layout = TypeLayout(sb_type.GetByteSize(), fields)
+        if key is not None:
+            layout_cache[key] = layout
+    return layout
+
+# (element layout, number of elements) if sb_type is an array large enough
+# to be kept as a LazyRange, None otherwise. strings are always decoded
+def get_large_array(sb_type):
+    t = sb_type.GetCanonicalType()
+    if not t.IsArrayType():
+        return None
+    elem = t.GetArrayElementType()
+    elem_size = elem.GetByteSize()
+    if elem_size == 0 or elem.GetCanonicalType().GetName() in char_types:
+        return None
+    count = t.GetByteSize() // elem_size
+    if count <= lazy_threshold:
+        return None
+    layout = get_type_layout(elem)
+    if len(layout.fields) == 0:
+        return None
+    return (layout, count)
+
+def get_type_class_kind(t):
+    # imported here so that the module is usable without lldb
+    import lldb
+    type_class = t.GetTypeClass()
+    if type_class in (lldb.eTypeClassStruct, lldb.eTypeClassUnion, lldb.eTypeClassClass):
+        return "aggregate"
+    if type_class == lldb.eTypeClassEnumeration:
+        return "enum"
+    return None
+
+def flatten(sb_type, offset, suffix, fields):
+    if len(fields) >= max_fields:
+        return
+    t = sb_type.GetCanonicalType()
+    size = t.GetByteSize()
+    type_name = sb_type.GetName()
+
+    if t.IsArrayType():
+        elem = t.GetArrayElementType()
+        elem_size = elem.GetByteSize()
+        if elem_size == 0:
+            return
+        if elem.GetCanonicalType().GetName() in char_types:
+            fields.append(Field(offset, size, suffix, type_name, "chars"))
+            return
+        for i in range(0, size // elem_size):
+            flatten(elem, offset + i * elem_size, "%s[%d]" % (suffix, i), fields)
+            if len(fields) >= max_fields:
+                return
+        return
+
+    if t.IsPointerType():
+        f = Field(offset, size, suffix, type_name, "pointer", "Q" if size == 8 else "I")
+        f.pointee = t.GetPointeeType()
+        fields.append(f)
+        return
+
+    kind = get_type_class_kind(t)
+    if kind == "aggregate":
+        for i in range(0, t.GetNumberOfFields()):
+            member = t.GetFieldAtIndex(i)
+            name = member.GetName()
+            member_suffix = suffix + "." + name if name is not None else suffix
+            if member.IsBitfield():
+                f = Field(offset + member.GetOffsetInBytes(), 0, member_suffix, member.GetType().GetName(), "bitfield")
+                f.bit_offset = member.GetOffsetInBits() % 8
+                f.bit_size = member.GetBitfieldSizeInBits()
+                f.size = (f.bit_offset + f.bit_size + 7) // 8
+                f.signed = not member.GetType().GetCanonicalType().GetName().startswith("unsigned")
+                fields.append(f)
+            else:
+                flatten(member.GetType(), offset + member.GetOffsetInBytes(), member_suffix, fields)
+        return
+
+    if kind == "enum":
+        fmt = { 1: "b", 2: "h", 4: "i", 8: "q" }.get(size)
+        f = Field(offset, size, suffix, type_name, "enum" if fmt is not None else "unknown", fmt)
+        members = t.GetEnumMembers()
+        f.enum_names = dict([ (members.GetTypeEnumMemberAtIndex(i).GetValueAsSigned(),
+            members.GetTypeEnumMemberAtIndex(i).GetName()) for i in range(0, members.GetSize()) ])
+        fields.append(f)
+        return
+
+    scalar_type = t.GetName()
+    fmt = get_scalar_format(scalar_type, size)
+    f = Field(offset, size, suffix, type_name, "scalar" if fmt is not None else "unknown", fmt)
+    f.scalar_type = scalar_type
+    fields.append(f)
+
+def format_field(f, value):
+    if f.kind == "pointer":
+        return "0x%0.*x" % (f.size * 2, value)
+    if f.kind == "enum":
+        return f.enum_names.get(value, str(value))
+    return format_scalar(f.scalar_type, f.fmt, value)
+
+def decode_bitfield(f, data, base):
+    raw = int.from_bytes(data[base + f.offset:base + f.offset + f.size], "little")
+    value = (raw >> f.bit_offset) & ((1 << f.bit_size) - 1)
+    if f.signed and value >> (f.bit_size - 1):
+        value -= 1 << f.bit_size
+    return str(value)
+
+# decode a value of the layout's type found at data[base:], returns a
+# (offset, size, value, label suffix, type name) tuple for each field
+def decode_layout(layout, data, base=0):
+    if len(data) < base + layout.byte_size:
+        return []
+
+    values = dict()
+    if layout.struct is not None:
+        for (f, x) in zip(layout.struct_fields, layout.struct.unpack_from(data, base)):
+            values[f] = format_field(f, x)
+    else:
+        for f in layout.struct_fields:
+            (x,) = struct.unpack_from("<" + f.fmt, data, base + f.offset)
+            values[f] = format_field(f, x)
+
+    rows = list()
+    for f in layout.fields:
+        if f.kind == "chars":
+            value = decode_c_string(data[base + f.offset:base + f.offset + f.size])
+        elif f.kind == "bitfield":
+            value = decode_bitfield(f, data, base)
+        elif f.kind == "unknown":
+            value = None
+        else:
+            value = values[f]
+        rows.append((f.offset, f.size, value, f.suffix, f.type_name))
+    return rows
+
+# the pointers in count consecutive values of the layout's type found at
+# the start of data, as (offset, label suffix, address, pointee type). the
+# suffix starts with the index of the value when there are several
+def get_pointers(layout, data, count=1):
+    pointers = list()
+    if len(layout.pointer_fields) == 0 or layout.byte_size == 0:
+        return pointers
+    for i in range(0, min(count, len(data) // layout.byte_size)):
+        base = i * layout.byte_size
+        for f in layout.pointer_fields:
+            (x,) = struct.unpack_from("<" + f.fmt, data, base + f.offset)
+            suffix = f.suffix if count == 1 else "[%d]%s" % (i, f.suffix)
+            pointers.append((base + f.offset, suffix, x, f.pointee))
+    return pointers
@@ -19,9 +19,8 @@ def get_globals(target):
             # Make sure we don't lookup the same variable twice
             if global_name not in global_names:
                 global_names.append(global_name)
-    
-    #TODO: finish
-    print("Globals: ", ",".join(global_names))
+
+    return global_names
 
 # from: https://github.com/llvm/llvm-project/blob/main/lldb/examples/python/process_events.py#L65
 def run_commands(command_interpreter, commands, print_output=False):
@@ -48,6 +47,16 @@ def get_register_for_return_value(arch):
     else:
         return "rax"
 
+def read_argument(frame, arg_index, arch):
+    reg = frame.FindRegister( get_register_for_argument(arg_index, arch) )
+    error = lldb.SBError()
+    return reg.GetData().GetUnsignedInt64(error, 0)
+
+def read_return_value(frame, arch):
+    reg = frame.FindRegister( get_register_for_return_value(arch) )
+    error = lldb.SBError()
+    return reg.GetData().GetUnsignedInt64(error, 0)
+
 def handle_malloc(memory_model, thread, arch):
     debug_handle_malloc = False
     # determine if this is the target code's call to malloc
@@ -80,7 +89,7 @@ def handle_free(memory_model, thread, arch):
     arg0 = thread.GetSelectedFrame().FindRegister( get_register_for_argument(0, arch) )
     error = lldb.SBError()
     free_ptr = arg0.GetData().GetUnsignedInt64(error, 0)
-    memory_model.add_heap_alloc(free_ptr, 0)
+    memory_model.free_heap_alloc(free_ptr)
 
     # advance the thread back to the calling function
     thread.StepOut()
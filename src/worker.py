@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+#----------------------------------------------------------------------
+# Runs a ProgramState (or ReplayState) on a background thread so that
+# the UI stays responsive while the debugger steps. The worker publishes
+# an immutable Snapshot after every command and, while idle, steps ahead
+# of the user into a bounded buffer so that the next step is usually
+# ready immediately. All lldb calls happen on the worker thread.
+#----------------------------------------------------------------------
+import collections
+import queue
+import threading
+import traceback
+
+# The state of the program after a step, copied out of the program so that
+# the UI can use it while the worker keeps stepping
+class Snapshot:
+    def __init__(self, program):
+        self.step = program.step_count
+        self.filename = program.get_filename()
+        self.line = program.get_line_number()
+        self.code = program.get_code()
+        self.frames = list(program.get_active_stack_frames())
+        self.output_lines = program.output.get_lines()
+        self.exited = program.has_exited()
+        self.allocator_calls = program.memory_model.n_allocator_calls
+        self.heap_graph = program.get_heap_graph()
+
+        self.memory_model = program.memory_model.copy()
+
+    def get_filename(self):
+        return self.filename
+
+    def get_line_number(self):
+        return self.line
+
+    def get_code(self):
+        return self.code
+
+    def get_active_stack_frames(self):
+        return self.frames
+
+    def has_exited(self):
+        return self.exited
+
+    # the value of a variable in the given stack frame section, or None
+    def get_variable(self, section, name):
+        v = self.memory_model.find_value(section, name)
+        return None if v is None else v.value
+
+class StepWorker(threading.Thread):
+    def __init__(self, program, prefetch=4):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.program = program
+        self.prefetch = prefetch
+        self.can_step_back = hasattr(program, "seek")
+
+        self.commands = queue.Queue()
+        self.published = queue.Queue()
+
+        # snapshots computed ahead of the one the user is looking at
+        self.ahead = collections.deque()
+        self.at_end = False
+        self.current = None
+
+        # whether commands are waiting or running, for the UI's indicator.
+        # busy_lock keeps it in step with the command queue
+        self.busy = False
+        self.busy_lock = threading.Lock()
+
+    # called from the UI thread
+    def request(self, command, arg=None):
+        with self.busy_lock:
+            self.busy = True
+            self.commands.put((command, arg))
+
+    def stop(self):
+        self.commands.put(("quit", None))
+
+    # returns the most recent (kind, payload) message, or None
+    def poll(self):
+        try:
+            return self.published.get_nowait()
+        except queue.Empty:
+            return None
+
+    def publish(self, snapshot):
+        self.current = snapshot
+        self.published.put(("snapshot", snapshot))
+
+    def can_prefetch(self):
+        if len(self.ahead) >= self.prefetch or self.at_end:
+            return False
+        last = self.ahead[-1] if len(self.ahead) > 0 else self.current
+        return not last.exited
+
+    def step_ahead(self):
+        prev_step = self.program.step_count
+        self.program.step()
+        # a replayed trace may end before the program exited
+        if self.program.step_count != prev_step:
+            self.ahead.append(Snapshot(self.program))
+        else:
+            self.at_end = True
+
+    # publish the first prefetched snapshot matching is_match, returns
+    # false if none of them match
+    def take_ahead(self, is_match):
+        for (i, snapshot) in enumerate(self.ahead):
+            if is_match(snapshot):
+                for _ in range(0, i + 1):
+                    self.ahead.popleft()
+                self.publish(snapshot)
+                return True
+        return False
+
+    def handle(self, command, arg):
+        current = self.current
+        if command == "step":
+            if len(self.ahead) == 0 and not current.exited:
+                self.step_ahead()
+            if len(self.ahead) > 0:
+                self.publish(self.ahead.popleft())
+            return
+
+        if command == "back":
+            if self.can_step_back:
+                self.ahead.clear()
+                self.at_end = False
+                self.program.seek(current.step - 1)
+                self.publish(Snapshot(self.program))
+            return
+
+        # fast-forward commands: the stop may already be in the prefetched
+        # steps, otherwise the program continues from the last of them
+        if command == "line":
+            is_match = lambda s: s.line == arg and s.filename == current.filename
+            run = lambda: self.program.run_to_line(arg)
+        elif command == "watch":
+            # the variable changed, or its frame returned
+            section = current.frames[0] if len(current.frames) > 0 else None
+            value = current.get_variable(section, arg)
+            is_match = lambda s: s.get_variable(section, arg) != value
+            run = lambda: self.program.run_until_changed(arg)
+        elif command == "alloc":
+            is_match = lambda s: s.allocator_calls != current.allocator_calls
+            run = lambda: self.program.run_to_allocation()
+        else:
+            return
+
+        if not self.take_ahead(is_match):
+            self.ahead.clear()
+            run()
+            self.publish(Snapshot(self.program))
+
+    def run(self):
+        self.publish(Snapshot(self.program))
+        while True:
+            try:
+                with self.busy_lock:
+                    if self.commands.empty():
+                        self.busy = False
+                if self.can_prefetch():
+                    (command, arg) = self.commands.get_nowait()
+                else:
+                    (command, arg) = self.commands.get()
+            except queue.Empty:
+                (command, arg) = ("prefetch", None)
+
+            if command == "quit":
+                return
+
+            try:
+                if command == "prefetch":
+                    self.step_ahead()
+                else:
+                    self.handle(command, arg)
+            except Exception:
+                # stop prefetching, the program is in an unknown state
+                self.at_end = True
+                self.published.put(("error", traceback.format_exc().strip().split("\n")[-1]))
@@ -0,0 +1,20 @@
+import pytest
+
+from meminspect import parse_step_spec, parse_range_spec
+
+def test_step_indices():
+    assert parse_step_spec("5") == [ 5 ]
+    assert parse_step_spec("7,1-3,2") == [ 1, 2, 3, 7 ]
+    assert parse_step_spec("all") is None
+
+def test_fast_forward_commands():
+    # commands keep the order they were given in, with the indices
+    assert parse_step_spec("line:12,3,change:x,alloc,1") == [ ("line", "12"), 3, ("change", "x"), ("alloc", ""), 1 ]
+
+def test_bad_step_spec():
+    with pytest.raises(ValueError):
+        parse_step_spec("x")
+
+def test_range_spec():
+    assert parse_range_spec("arr:10-19") == ("arr", 10, 20)
+    assert parse_range_spec("0x1000:4") == ("0x1000", 4, 5)
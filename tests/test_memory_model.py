@@ -0,0 +1,142 @@
+#----------------------------------------------------------------------
+# ValueStore and MemoryModel checked against a plain dict of rows
+#----------------------------------------------------------------------
+import random
+import struct
+
+import pytest
+
+import memory_model
+from memory_model import *
+from type_layout import Field, TypeLayout
+
+values = [ "0", "-5", "123456789012", "18446744073709551615", "-9223372036854775808",
+    "9223372036854775808", "18446744073709551616", "0x0000000000001234", "0x00ff", "0x",
+    "3.1400001", "0.10000000000000001", "1e+20", "2.5e-10", "inf", "-nan", "nan", "'a'",
+    "true", None, "007", "-0", "abc" ]
+labels = [ "arr[3].x", "m[2][3]", "p.next", None, "(none)", "a[01]", "a[]", "b[x]", "c[2147483648]", "q[0]" ]
+owners = [ None, "A", "B", heap_owner(5) ]
+
+# small chunks so that chunks are split and merged often
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(memory_model, "chunk_size", 8)
+
+def random_row(rng, address):
+    label = rng.choice(labels[:6]) if rng.random() < 0.5 else "arr[%d].y" % rng.randrange(50)
+    return ("stack f%d" % rng.randrange(3), address, rng.choice([4, 8, None]), rng.choice(values),
+        label, rng.choice(["int", None, "char *"]))
+
+def sort_rows(rows):
+    return sorted(rows, key=lambda r: r[1])
+
+def test_encode_value():
+    for v in values:
+        assert decode_value(*encode_value(v)) == v
+
+def test_encode_label():
+    tables = ValueTables()
+    for label in labels:
+        assert tables.decode_label(*tables.encode_label(label)) == label
+
+# copies of a model return values without their owner
+def check_model(model, ref, owners=True):
+    assert len(model.memory) == len(ref)
+    assert model.snapshot() == dict([ (a, r) for (a, (r, o)) in sorted(ref.items()) ])
+    assert list(model.snapshot()) == sorted(ref)
+    for (address, (row, owner)) in ref.items():
+        v = model.memory[address]
+        assert v.row == row
+        if owners:
+            assert v.owner == owner
+    sections = model.memory.get_section_addresses()
+    for (section, addresses) in sections.items():
+        assert list(addresses) == sorted([ a for a in ref if ref[a][0][0] == section ])
+    assert sum([ len(a) for a in sections.values() ]) == len(ref)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_against_dict(seed):
+    rng = random.Random(seed)
+    model = MemoryModel()
+    # address -> (row, owner)
+    ref = dict()
+    copies = list()
+    for i in range(2000):
+        op = rng.random()
+        if op < 0.6:
+            address = rng.randrange(400) * 4
+            row = random_row(rng, address)
+            owner = rng.choice(owners)
+            model.add(MemoryValue(*row, owner=owner))
+            ref[address] = (row, owner)
+        elif op < 0.7:
+            owner = rng.choice(owners[1:])
+            model.retire_owner(owner)
+            ref = dict([ (a, x) for (a, x) in ref.items() if x[1] != owner ])
+        elif op < 0.8:
+            removed = rng.sample(sorted(ref), min(len(ref), rng.randrange(5)))
+            model.apply_delta([], removed)
+            for address in removed:
+                del ref[address]
+        elif op < 0.85:
+            copies.append((model.copy(), dict(ref)))
+        elif op < 0.9 and len(copies) > 0:
+            # copies are unchanged by later changes to the model
+            (prev, prev_ref) = rng.choice(copies)
+            check_model(prev, prev_ref, owners=False)
+            (added, changed, removed) = model.diff(prev)
+            expected = diff_snapshots(dict([ (a, r) for (a, (r, o)) in prev_ref.items() ]),
+                dict([ (a, r) for (a, (r, o)) in ref.items() ]))
+            assert sort_rows(added) == sort_rows(expected[0])
+            assert sort_rows(changed) == sort_rows(expected[1])
+            assert sort_rows(removed) == sort_rows([ prev_ref[a][0] for a in expected[2] ])
+        elif op < 0.95:
+            section = "stack f%d" % rng.randrange(3)
+            label = rng.choice(labels[:3])
+            found = [ v.address for v in model.find_by_name(section, get_base_label(label)) ]
+            assert found == sorted([ a for (a, (r, o)) in ref.items()
+                if r[0] == section and get_base_label(r[4]) == get_base_label(label) ])
+        else:
+            start = rng.randrange(1600)
+            end = start + rng.randrange(200)
+            assert [ v.row for v in model.get_range(start, end) ] == \
+                [ ref[a][0] for a in sorted(ref) if start <= a < end ]
+        if i % 100 == 0:
+            check_model(model, ref)
+    check_model(model, ref)
+
+# diff of models holding lazy ranges matches the diff of their expanded
+# snapshots
+@pytest.mark.parametrize("seed", range(10))
+def test_lazy_range_diff(seed):
+    rng = random.Random(seed)
+    field = Field(0, 4, "", "int", "scalar", "i")
+    field.scalar_type = "int"
+    field.signed = True
+    layout = TypeLayout(4, [ field ])
+    model = MemoryModel()
+    copies = list()
+    for i in range(200):
+        op = rng.random()
+        base = rng.choice([ 0x1000, 0x2000 ])
+        owner = "o%d" % base
+        if op < 0.3:
+            n = rng.randrange(1, 6)
+            data = struct.pack("<%di" % n, *[ rng.randrange(3) for j in range(n) ])
+            model.add_lazy_range(LazyRange("s", base, "arr", "int[]", layout, n, data, owner, "arr"))
+        elif op < 0.5:
+            model.add(MemoryValue("s", base + rng.choice([ 0, 0x40, 0x44, 0x48 ]), 4, str(rng.randrange(3)),
+                "arr[%d]" % rng.randrange(6), "int", owner))
+        elif op < 0.6:
+            model.retire_owner(owner)
+        elif op < 0.7:
+            model.apply_delta([], [ base ])
+        elif op < 0.85:
+            copies.append((model.copy(), model.snapshot(expand_lazy=True)))
+        elif len(copies) > 0:
+            (prev, prev_snapshot) = rng.choice(copies)
+            (added, changed, removed) = model.diff(prev)
+            expected = diff_snapshots(prev_snapshot, model.snapshot(expand_lazy=True))
+            assert sort_rows(added) == sort_rows(expected[0])
+            assert sort_rows(changed) == sort_rows(expected[1])
+            assert sort_rows(removed) == sort_rows([ prev_snapshot[a] for a in expected[2] ])
@@ -0,0 +1,62 @@
+#----------------------------------------------------------------------
+# SqliteWriter against TsvDeltaWriter, and TSV -> SQLite -> TSV
+#----------------------------------------------------------------------
+import io
+import random
+import sqlite3
+
+from memory_model import *
+from output_capture import OutputRing
+from sqlite_export import *
+
+graphs = [
+    { "roots": [ [ "stack main", "p", 16 ] ], "edges": [ [ 16, 24, "next", 32 ] ], "nodes": [], "truncated": False },
+    { "roots": [ [ "stack main", "p", 16 ] ], "edges": [], "nodes": [], "truncated": False },
+]
+
+# run a random program for n_steps, giving the model after each step to
+# every writer. Returns the snapshot at each step
+def write_steps(writers, n_steps=40, seed=0):
+    rng = random.Random(seed)
+    model = MemoryModel()
+    output = OutputRing()
+    snapshots = list()
+    for step in range(n_steps):
+        for i in range(rng.randrange(4)):
+            address = rng.randrange(32) * 8
+            section = rng.choice([ "stack main", "stack f", "globals" ])
+            model.add(MemoryValue(section, address, 8, str(rng.randrange(5)), "v%d" % address, "long", section))
+        if rng.random() < 0.2:
+            model.retire_owner("stack f")
+        if rng.random() < 0.3:
+            output.append(step, rng.choice([ "stdout", "stderr" ]), "line %d\tof\\output\n" % step)
+        graph = rng.choice(graphs)
+        for writer in writers:
+            writer.write_step(step, model, output, graph)
+        snapshots.append(sorted(model.snapshot().values()))
+    return snapshots
+
+def test_matches_tsv(tmp_path):
+    tsv = io.StringIO()
+    db_path = str(tmp_path / "dump.db")
+    writer = SqliteWriter(db_path)
+    snapshots = write_steps([ TsvDeltaWriter(tsv), writer ])
+    writer.close()
+
+    db = sqlite3.connect(db_path)
+    for (step, snapshot) in enumerate(snapshots):
+        assert sorted(snapshot_at(db, step)) == snapshot
+    out = io.StringIO()
+    sqlite_to_tsv(db, out)
+    assert out.getvalue() == tsv.getvalue()
+
+def test_tsv_round_trip(tmp_path):
+    tsv = io.StringIO()
+    write_steps([ TsvDeltaWriter(tsv) ], seed=1)
+    db_path = str(tmp_path / "dump.db")
+    tsv_to_sqlite(io.StringIO(tsv.getvalue()), db_path)
+    assert is_sqlite_file(db_path)
+
+    out = io.StringIO()
+    sqlite_to_tsv(sqlite3.connect(db_path), out)
+    assert out.getvalue() == tsv.getvalue()